@@ -2,12 +2,16 @@ from flask import Flask
 from flask_migrate import Migrate
 from flask_jwt_extended import JWTManager
 from config import Config
-from models import db
+from models import db, upgrade_schema
 from flask_socketio import SocketIO
 import dramatiq
+import redis
 from dramatiq.brokers.redis import RedisBroker
 import os
 import logging
+import json_provider
+import compression
+import audit
 
 app = Flask(__name__)
 logging.basicConfig(
@@ -18,6 +22,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 socketio = SocketIO(app, cors_allowed_origins="*", message_queue='redis://localhost:6379')  # Поддержка CORS для клиента
 redis_broker = RedisBroker(host="localhost", port=6379)
+redis_client = redis.Redis(host="localhost", port=6379)
 dramatiq.set_broker(redis_broker)
 jwt = JWTManager(app)
 #migrate = Migrate()
@@ -27,6 +32,9 @@ def create_app():
     app.config.from_object(Config)
 
     db.init_app(app)
+    json_provider.init_app(app)
+    compression.init_app(app)
+    audit.init_app(app)
     #migrate.init_app(app, db)
 
     with app.app_context():
@@ -36,6 +44,7 @@ def create_app():
 
         # Create database tables
         db.create_all()
+        upgrade_schema()
 
     from routes.auth import auth_bp
     from routes.messages import messages_bp
@@ -0,0 +1,162 @@
+"""
+Неблокирующая запись журнала аудита (таблица Log).
+
+Записи не добавляются в сессию запроса и не требуют отдельного коммита: audit.log кладет
+запись в ограниченную очередь процесса (AUDIT_QUEUE_MAX), а фоновый поток пишет очередь
+в БД одним многострочным INSERT, когда накопилось AUDIT_BATCH_SIZE записей или прошло
+AUDIT_FLUSH_INTERVAL секунд с первой записи пачки.
+
+audit.log_after_commit - для записей о самой операции: запись попадает в очередь только
+после коммита текущей транзакции сессии и отбрасывается при откате, как и раньше, когда
+Log добавлялся в ту же транзакцию.
+
+Если очередь заполнена дольше AUDIT_ENQUEUE_TIMEOUT секунд, запрос пишет свою запись сам,
+синхронно - память ограничена, а записи не теряются. При остановке процесса (atexit) поток
+останавливается и остаток очереди дописывается.
+"""
+import os
+import time
+import queue
+import atexit
+import threading
+from datetime import datetime
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+from models import db, Log
+
+
+class AuditSink:
+    def __init__(self):
+        self.app = None
+        self.queue = None
+        self.thread = None
+        self.pid = None
+        self.stopping = threading.Event()
+        self.lock = threading.Lock()
+
+    def init_app(self, app):
+        self.app = app
+        atexit.register(self.close)
+
+    def ensure_started(self):
+        # Поток запускается при первой записи в каждом процессе: воркеры gunicorn получают
+        # копию модуля через fork, а потоки при fork не копируются
+        if self.thread is not None and self.pid == os.getpid():
+            return
+        with self.lock:
+            if self.thread is None or self.pid != os.getpid():
+                self.pid = os.getpid()
+                self.queue = queue.Queue(maxsize=self.app.config['AUDIT_QUEUE_MAX'])
+                self.stopping = threading.Event()
+                self.thread = threading.Thread(target=self.run, name='audit-sink', daemon=True)
+                self.thread.start()
+
+    def put(self, entry):
+        self.ensure_started()
+        try:
+            self.queue.put(entry, timeout=self.app.config['AUDIT_ENQUEUE_TIMEOUT'])
+        except queue.Full:
+            # Поток не успевает за потоком записей - запрос платит за свою запись сам
+            self.write([entry])
+
+    def take_batch(self):
+        config = self.app.config
+        try:
+            rows = [self.queue.get(timeout=config['AUDIT_FLUSH_INTERVAL'])]
+        except queue.Empty:
+            return []
+        deadline = time.monotonic() + config['AUDIT_FLUSH_INTERVAL']
+        while len(rows) < config['AUDIT_BATCH_SIZE']:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                rows.append(self.queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return rows
+
+    def run(self):
+        while not self.stopping.is_set():
+            rows = self.take_batch()
+            if rows:
+                self.write(rows)
+
+    def write(self, rows):
+        with self.app.app_context():
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(Log.__table__.insert().values(rows))
+            except Exception as e:
+                # Одна некорректная запись не должна уносить всю пачку
+                self.app.logger.error(f"Журнал аудита: пачка из {len(rows)} записей не записана: {e}")
+                for row in rows:
+                    try:
+                        with db.engine.begin() as connection:
+                            connection.execute(Log.__table__.insert().values(row))
+                    except Exception as row_error:
+                        self.app.logger.error(f"Журнал аудита: запись потеряна {row}: {row_error}")
+
+    def drain(self):
+        rows = []
+        while True:
+            try:
+                rows.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        batch_size = self.app.config['AUDIT_BATCH_SIZE']
+        for start in range(0, len(rows), batch_size):
+            self.write(rows[start:start + batch_size])
+
+    def close(self):
+        if self.thread is None or self.pid != os.getpid():
+            return
+        self.stopping.set()
+        self.thread.join(timeout=self.app.config['AUDIT_FLUSH_INTERVAL'] + 5)
+        self.drain()
+
+
+sink = AuditSink()
+
+
+def init_app(app):
+    sink.init_app(app)
+
+
+def make_entry(id_user, action, id_dialog=None, id_group=None, content=None, is_successful=True):
+    return {
+        'id_user': id_user,
+        'id_dialog': id_dialog,
+        'id_group': id_group,
+        # Время события, а не записи пачки; формат - как у Log.timestamp
+        'timestamp': datetime.now().strftime("%H:%M, %d %b %Y"),
+        'action': action,
+        'content': content,
+        'is_successful': is_successful
+    }
+
+
+def log(id_user, action, id_dialog=None, id_group=None, content=None, is_successful=True):
+    """
+    Запись аудита, не связанная с транзакцией запроса (отказы, ошибки, уже закоммиченные операции).
+    """
+    sink.put(make_entry(id_user, action, id_dialog, id_group, content, is_successful))
+
+
+def log_after_commit(id_user, action, id_dialog=None, id_group=None, content=None, is_successful=True):
+    """
+    Запись аудита об операции текущей транзакции: уходит в очередь после ее коммита.
+    """
+    db.session.info.setdefault('audit_entries', []).append(
+        make_entry(id_user, action, id_dialog, id_group, content, is_successful))
+
+
+@event.listens_for(Session, 'after_commit')
+def enqueue_committed(session):
+    for entry in session.info.pop('audit_entries', []):
+        sink.put(entry)
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_entries(session):
+    session.info.pop('audit_entries', None)
@@ -0,0 +1,65 @@
+"""
+Сколько байт аватарок уходит клиенту на одну отрисовку списка чатов: оригиналы против WebP-вариантов.
+
+Берет аватарки из каталога (по умолчанию uploads/avatars), моделирует список из --conversations
+чатов и считает суммарный объем для оригиналов и для каждого размера варианта. Нужен Pillow.
+
+    python bench_avatar_variants.py --folder uploads/avatars --conversations 50 --sizes 64 128 512
+"""
+import io
+import os
+import random
+import argparse
+from PIL import Image, ImageOps
+
+IMAGE_EXTENSIONS = {'.jpg', '.jpeg', '.png', '.webp', '.gif'}
+
+
+def collect_avatars(folder):
+    avatars = []
+    for root, dirs, files in os.walk(folder):
+        dirs[:] = [d for d in dirs if d != 'variants']
+        avatars += [os.path.join(root, f) for f in files if os.path.splitext(f)[1].lower() in IMAGE_EXTENSIONS]
+    return avatars
+
+
+def variant_bytes(path, size, quality):
+    with Image.open(path) as image:
+        image = ImageOps.exif_transpose(image)
+        if image.mode not in ('RGB', 'RGBA'):
+            image = image.convert('RGBA')
+        buffer = io.BytesIO()
+        ImageOps.fit(image, (size, size), Image.LANCZOS).save(buffer, 'WEBP', quality=quality, method=4)
+        return buffer.tell()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--folder', default='uploads/avatars')
+    parser.add_argument('--conversations', type=int, default=50)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[64, 128, 512])
+    parser.add_argument('--quality', type=int, default=80)
+    args = parser.parse_args()
+
+    avatars = collect_avatars(args.folder)
+    if not avatars:
+        print(f'No avatars in {args.folder}')
+        return
+
+    render = [random.choice(avatars) for _ in range(args.conversations)]
+    original = sum(os.path.getsize(path) for path in render)
+    print(f'{args.conversations} conversations, {len(avatars)} distinct avatars')
+    print(f'{"original":>10}: {original / 1024:10.1f} KiB')
+
+    for size in args.sizes:
+        cache = {}
+        total = 0
+        for path in render:
+            if path not in cache:
+                cache[path] = variant_bytes(path, size, args.quality)
+            total += cache[path]
+        print(f'{f"{size}px webp":>10}: {total / 1024:10.1f} KiB  ({total / original * 100:.1f}% of original)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""
+Задержка отправки альбома: поштучные /upload/photo + /upload/photo/preview против одного /upload/batch.
+
+Работает против запущенного сервера. Сетевая задержка моделируется паузой --rtt перед каждым
+HTTP-запросом (один круг на запрос поверх keep-alive). Для честной картины можно вместо этого
+включить задержку на интерфейсе: tc qdisc add dev lo root netem delay 100ms, и запускать с --rtt 0.
+
+    python bench_batch_upload.py --url http://localhost:5000 --token <JWT> --dialog 1 --photos 10 --rtt 0.15
+"""
+import os
+import time
+import argparse
+import statistics
+import requests
+
+
+def make_album(count, size):
+    return [(f'bench_{i}.jpg', os.urandom(size), os.urandom(size // 10)) for i in range(count)]
+
+
+def send_single(session, args, album):
+    for name, original, preview in album:
+        time.sleep(args.rtt)
+        session.post(f'{args.url}/upload/photo/{args.dialog}/{args.is_group}', files={'file': (name, original)}).raise_for_status()
+        time.sleep(args.rtt)
+        session.post(f'{args.url}/upload/photo/preview/{args.dialog}/{args.is_group}', files={'file': (f'preview_{name}', preview)}).raise_for_status()
+
+
+def send_batch(session, args, album):
+    files = [('file', (name, original)) for name, original, _ in album]
+    files += [('preview', (f'preview_{name}', preview)) for name, _, preview in album]
+    time.sleep(args.rtt)
+    session.post(f'{args.url}/upload/batch/{args.dialog}/{args.is_group}', data={'type': 'photo'}, files=files).raise_for_status()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--token', required=True)
+    parser.add_argument('--dialog', type=int, required=True)
+    parser.add_argument('--is-group', type=int, default=0)
+    parser.add_argument('--photos', type=int, default=10)
+    parser.add_argument('--size', type=int, default=300 * 1024, help='размер оригинала, байт')
+    parser.add_argument('--rtt', type=float, default=0.15, help='моделируемый RTT, секунды')
+    parser.add_argument('--repeat', type=int, default=5)
+    args = parser.parse_args()
+
+    session = requests.Session()
+    session.headers['Authorization'] = f'Bearer {args.token}'
+
+    for label, send in [('single', send_single), ('batch', send_batch)]:
+        timings = []
+        for _ in range(args.repeat):
+            album = make_album(args.photos, args.size)  # Новое содержимое, чтобы не мерить дедупликацию
+            start = time.perf_counter()
+            send(session, args, album)
+            timings.append(time.perf_counter() - start)
+        print(f'{label:>6}: median {statistics.median(timings) * 1000:.0f} ms, min {min(timings) * 1000:.0f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,109 @@
+"""
+Время кодирования и объем JSON-ответов со списком сообщений: стандартный провайдер Flask
+против orjson, без сжатия и со сжатием gzip / brotli.
+
+Без --url кодирует синтетическую страницу из --size сообщений с зашифрованным текстом (base64,
+как у клиентов) --rounds раз и печатает время на страницу и размер тела. С --url и --token
+дополнительно запрашивает реальный эндпоинт с разными Accept-Encoding и печатает байты в сети.
+
+    python bench_json_encoding.py --size 100 --rounds 500
+    python bench_json_encoding.py --url http://localhost:5000/messages/1?size=100 --token <JWT>
+"""
+import os
+import gzip
+import time
+import base64
+import random
+import argparse
+import requests
+from flask import Flask
+from flask.json.provider import DefaultJSONProvider
+import message_payload
+from json_provider import OrjsonProvider, orjson
+from config import Config
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+
+def synthetic_page(size):
+    now = int(time.time() * 1000)
+    messages = []
+    for i in range(size):
+        ciphertext = base64.b64encode(os.urandom(random.randint(48, 600))).decode()
+        messages.append({
+            'id': 100000 + i, 'id_sender': random.choice((1, 2)), 'text': ciphertext, 'images': None,
+            'voice': None, 'file': None, 'code': None, 'code_language': None, 'is_edited': False,
+            'is_read': i < size - 5, 'is_forwarded': False, 'is_url': False, 'reference_to_message_id': None,
+            'username_author_original': None, 'waveform': None, 'timestamp': now - (size - i) * 60000
+        })
+    return messages
+
+
+def encode_time(provider, page, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        body = provider.response(page).get_data()
+    return (time.perf_counter() - started) / rounds, body
+
+
+def compress_time(name, compress, body, rounds):
+    started = time.perf_counter()
+    for _ in range(rounds):
+        compressed = compress(body)
+    elapsed = (time.perf_counter() - started) / rounds
+    print(f'{name:>22}: {elapsed * 1000:.3f} ms, {len(compressed)} байт')
+
+
+def local_bench(args):
+    app = Flask(__name__)
+    app.config.from_object(Config)
+    page = synthetic_page(args.size)
+    providers = [('stdlib', DefaultJSONProvider(app))]
+    if orjson is not None:
+        providers.append(('orjson', OrjsonProvider(app)))
+    else:
+        print('orjson не установлен, сравнение только со стандартным провайдером')
+
+    body = b''
+    for name, provider in providers:
+        for layout, data in (('dict', page), ('columnar', message_payload.to_columnar(page, message_payload.MESSAGE_FIELDS))):
+            elapsed, body = encode_time(provider, data, args.rounds)
+            print(f'{name + " " + layout:>22}: {elapsed * 1000:.3f} ms, {len(body)} байт')
+
+    level, quality = Config.COMPRESS_GZIP_LEVEL, Config.COMPRESS_BROTLI_QUALITY
+    compress_time(f'gzip {level}', lambda data: gzip.compress(data, compresslevel=level, mtime=0), body, args.rounds)
+    if brotli is not None:
+        compress_time(f'brotli {quality}', lambda data: brotli.compress(data, quality=quality), body, args.rounds)
+
+
+def remote_bench(args):
+    session = requests.Session()
+    session.headers['Authorization'] = f'Bearer {args.token}'
+    for encoding in ('identity', 'gzip', 'br'):
+        started = time.perf_counter()
+        # stream=True: читаем сырое тело, иначе requests распакует его и размер будет исходным
+        response = session.get(args.url, headers={'Accept-Encoding': encoding}, stream=True)
+        wire = response.raw.read(decode_content=False)
+        elapsed = time.perf_counter() - started
+        print(f'{encoding:>22}: {elapsed * 1000:.1f} ms, {len(wire)} байт в сети, '
+              f'Content-Encoding: {response.headers.get("Content-Encoding", "-")}')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--size', type=int, default=100)
+    parser.add_argument('--rounds', type=int, default=500)
+    parser.add_argument('--url')
+    parser.add_argument('--token')
+    args = parser.parse_args()
+
+    local_bench(args)
+    if args.url:
+        remote_bench(args)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,101 @@
+"""
+Проверка кэширования медиа и экономия трафика: 304 на If-None-Match, 206 на Range,
+заголовки Cache-Control: private, immutable.
+
+Работает против запущенного сервера. Сначала проверяет ответы на один URL медиа (код выхода 1,
+если проверка не прошла), затем проигрывает --views просмотров файла, из которых каждый
+--drop-every-й скачивается с обрывом на середине и докачивается. Печатает байты в сети без
+кэширования (каждый просмотр и повтор - полное скачивание) и с ним (повтор - 304, докачка - Range).
+
+    python bench_media_cache.py --url http://localhost:5000/files/files/1/report.pdf/0 --token <JWT> --views 20
+"""
+import sys
+import argparse
+import requests
+
+
+def check(label, condition, detail=''):
+    print(f'{"ok" if condition else "FAIL":>4}  {label}' + (f' ({detail})' if detail else ''))
+    return condition
+
+
+def wire_size(response):
+    # Тело без распаковки: столько байт прошло по сети
+    return len(response.raw.read(decode_content=False))
+
+
+def check_headers(session, url):
+    """
+    Возвращает (все ли проверки прошли, ETag, размер файла).
+    """
+    full = session.get(url, stream=True)
+    size = wire_size(full)
+    etag = full.headers.get('ETag')
+    cache_control = full.headers.get('Cache-Control', '')
+    passed = check('GET 200', full.status_code == 200, str(full.status_code))
+    passed &= check('ETag', bool(etag), etag or '-')
+    passed &= check('Cache-Control: private, immutable', 'immutable' in cache_control and 'private' in cache_control, cache_control)
+    passed &= check('Accept-Ranges: bytes', full.headers.get('Accept-Ranges') == 'bytes', full.headers.get('Accept-Ranges', '-'))
+
+    if etag:
+        revalidate = session.get(url, headers={'If-None-Match': etag}, stream=True)
+        body = wire_size(revalidate)
+        passed &= check('If-None-Match -> 304 без тела', revalidate.status_code == 304 and body == 0,
+                        f'{revalidate.status_code}, {body} байт')
+
+    offset = size // 2
+    partial = session.get(url, headers={'Range': f'bytes={offset}-'}, stream=True)
+    body = wire_size(partial)
+    expected_range = f'bytes {offset}-{size - 1}/{size}'
+    passed &= check('Range -> 206', partial.status_code == 206, str(partial.status_code))
+    passed &= check('Content-Range и длина части', partial.headers.get('Content-Range') == expected_range and body == size - offset,
+                    f'{partial.headers.get("Content-Range", "-")}, {body} байт')
+    return passed, etag, size
+
+
+def replay(session, url, etag, size, views, drop_every):
+    """
+    Байты по сети за views просмотров: (без кэширования, с кэшированием).
+    """
+    plain, cached = 0, 0
+    for view in range(views):
+        dropped = drop_every and view % drop_every == 0
+        if dropped:
+            # Без Range оборванное скачивание начинается заново: половина + полный файл
+            plain += size // 2 + size
+        else:
+            plain += size
+
+        if view == 0 or dropped:
+            # Первое скачивание или докачка после обрыва: половина файла, остаток по Range
+            received = size // 2 if dropped else 0
+            headers = {'Range': f'bytes={received}-'} if received else {}
+            cached += received + wire_size(session.get(url, headers=headers, stream=True))
+        else:
+            revalidate = session.get(url, headers={'If-None-Match': etag}, stream=True)
+            cached += wire_size(revalidate)
+    return plain, cached
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', required=True)
+    parser.add_argument('--token', required=True)
+    parser.add_argument('--views', type=int, default=20)
+    parser.add_argument('--drop-every', type=int, default=5, help='каждый N-й просмотр обрывается на середине')
+    args = parser.parse_args()
+
+    session = requests.Session()
+    session.headers['Authorization'] = f'Bearer {args.token}'
+
+    passed, etag, size = check_headers(session, args.url)
+    if etag:
+        plain, cached = replay(session, args.url, etag, size, args.views, args.drop_every)
+        saved = plain - cached
+        print(f'{args.views} просмотров файла {size} байт: без кэширования {plain} байт, с кэшированием {cached} байт, '
+              f'сэкономлено {saved} байт ({saved / plain * 100 if plain else 0:.0f}%)')
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,91 @@
+"""
+Параллельное скачивание медиа: режимы MEDIA_DELIVERY direct / x-accel / x-sendfile.
+
+Работает против запущенного сервера (за nginx для x-accel). --clients потоков --duration секунд
+качают --media-url. Печатает скачиваний в секунду, МБ/с и задержку полного скачивания. Параллельно
+раз в 100 мс запрашивается --probe-url (легкий API-эндпоинт, например /conversations): его задержка
+показывает, заняты ли воркеры приложения отдачей файлов. Режим меняется в конфиге сервера между
+прогонами, скрипт печатает его по заголовкам ответа.
+
+    python bench_media_delivery.py --media-url http://localhost/files/files/1/big.pdf/0 \
+        --probe-url http://localhost/conversations --token <JWT> --clients 50 --duration 30
+"""
+import time
+import argparse
+import threading
+import statistics
+import requests
+
+
+def percentile(values, share):
+    values = sorted(values) or [0]
+    return values[min(int(len(values) * share), len(values) - 1)]
+
+
+def download_loop(args, deadline, results, lock):
+    session = requests.Session()
+    session.headers['Authorization'] = f'Bearer {args.token}'
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        received = 0
+        with session.get(args.media_url, stream=True) as response:
+            response.raise_for_status()
+            for chunk in response.iter_content(256 * 1024):
+                received += len(chunk)
+        with lock:
+            results.append((time.perf_counter() - started, received))
+
+
+def probe_loop(args, deadline, latencies):
+    session = requests.Session()
+    session.headers['Authorization'] = f'Bearer {args.token}'
+    while time.monotonic() < deadline:
+        started = time.perf_counter()
+        session.get(args.probe_url).raise_for_status()
+        latencies.append(time.perf_counter() - started)
+        time.sleep(0.1)
+
+
+def delivery_mode(args):
+    # Ответ приложения при x-accel приходит от nginx, поэтому режим видно только косвенно
+    response = requests.head(args.media_url, headers={'Authorization': f'Bearer {args.token}'})
+    return response.headers.get('Server', '-'), response.headers.get('Content-Length', '-')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--media-url', required=True)
+    parser.add_argument('--probe-url')
+    parser.add_argument('--token', required=True)
+    parser.add_argument('--clients', type=int, default=50)
+    parser.add_argument('--duration', type=float, default=30)
+    args = parser.parse_args()
+
+    server, length = delivery_mode(args)
+    print(f'Server: {server}, Content-Length: {length}')
+
+    results, probes = [], []
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+    threads = [threading.Thread(target=download_loop, args=(args, deadline, results, lock)) for _ in range(args.clients)]
+    if args.probe_url:
+        threads.append(threading.Thread(target=probe_loop, args=(args, deadline, probes)))
+
+    start = time.monotonic()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.monotonic() - start
+
+    durations = [duration for duration, _ in results]
+    total = sum(size for _, size in results)
+    print(f'скачиваний: {len(results) / elapsed:.1f}/с, {total / elapsed / 1024 / 1024:.1f} МБ/с, '
+          f'p50 {statistics.median(durations or [0]) * 1000:.0f} мс, p95 {percentile(durations, 0.95) * 1000:.0f} мс')
+    if probes:
+        print(f'probe во время скачиваний: p50 {statistics.median(probes) * 1000:.1f} мс, '
+              f'p95 {percentile(probes, 0.95) * 1000:.1f} мс, max {max(probes) * 1000:.1f} мс')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,95 @@
+"""
+Нагрузочный тест heartbeat (PUT /update_last_session) и рассылки user_session_updated.
+
+Подключает --clients сокетов (токены по одному в строке в --tokens, у каждого клиента свой
+пользователь), каждый клиент раз в --interval секунд со случайным сдвигом отправляет heartbeat.
+Через --duration секунд печатает heartbeat в секунду, задержку heartbeat и число полученных
+клиентами событий user_session_updated в секунду - суммарно и на клиента. Для сравнения
+с глобальной рассылкой запускается против сборки до отложенной записи last_session.
+Нужны python-socketio[asyncio_client] и aiohttp; на машине генератора поднять лимит файлов (ulimit -n).
+
+    python bench_presence.py --url http://localhost:5000 --tokens tokens.txt --clients 5000 \
+        --interval 30 --duration 120
+"""
+import time
+import random
+import asyncio
+import argparse
+import statistics
+import aiohttp
+import socketio
+
+
+class Stats:
+    def __init__(self):
+        self.received = 0
+        self.heartbeats = 0
+        self.latencies = []
+
+
+async def run_client(args, token, stats, started, http):
+    client = socketio.AsyncClient(reconnection=False)
+
+    @client.on('user_session_updated')
+    async def on_session_updated(data):
+        stats.received += 1
+
+    headers = {'Authorization': f'Bearer {token}'}
+    await client.connect(args.url, headers=headers, transports=['websocket'])
+    await started.wait()
+    await asyncio.sleep(random.uniform(0, args.interval))
+
+    deadline = time.monotonic() + args.duration
+    while time.monotonic() < deadline:
+        request_started = time.perf_counter()
+        async with http.put(f'{args.url}/update_last_session', headers=headers) as response:
+            await response.read()
+        stats.latencies.append(time.perf_counter() - request_started)
+        stats.heartbeats += 1
+        await asyncio.sleep(args.interval)
+    await client.disconnect()
+
+
+async def main_async(args):
+    with open(args.tokens) as tokens_file:
+        tokens = [line.strip() for line in tokens_file if line.strip()][:args.clients]
+    stats = Stats()
+    started = asyncio.Event()
+    connector = aiohttp.TCPConnector(limit=args.http_concurrency)
+
+    async with aiohttp.ClientSession(connector=connector) as http:
+        tasks = []
+        for token in tokens:
+            tasks.append(asyncio.create_task(run_client(args, token, stats, started, http)))
+            # Подключаемся волнами, чтобы не упереться в backlog сервера
+            if len(tasks) % 200 == 0:
+                await asyncio.sleep(0.5)
+        await asyncio.sleep(2)
+        print(f'подключено клиентов: {len(tasks)}')
+
+        start = time.monotonic()
+        started.set()
+        await asyncio.gather(*tasks, return_exceptions=True)
+        elapsed = time.monotonic() - start
+
+    latencies = sorted(stats.latencies) or [0]
+    print(f'heartbeat: {stats.heartbeats / elapsed:.1f}/с, p50 {statistics.median(latencies) * 1000:.1f} мс, '
+          f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} мс')
+    print(f'user_session_updated: {stats.received / elapsed:.1f} сообщений/с, '
+          f'{stats.received / elapsed / max(len(tokens), 1):.2f} на клиента в секунду')
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--tokens', required=True, help='файл с JWT, по одному на строку')
+    parser.add_argument('--clients', type=int, default=5000)
+    parser.add_argument('--interval', type=float, default=30, help='секунды между heartbeat клиента')
+    parser.add_argument('--duration', type=float, default=120)
+    parser.add_argument('--http-concurrency', type=int, default=200)
+    args = parser.parse_args()
+    asyncio.run(main_async(args))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,58 @@
+"""
+Пропускная способность и задержка отправки сообщений на один воркер.
+
+Работает против запущенного сервера (gunicorn с одним воркером): --concurrency потоков шлют
+сообщения в диалог или группу, в конце печатаются сообщений/с и перцентили задержки.
+Для сравнения "до/после" запускается на двух версиях сервера с одинаковыми параметрами.
+
+    python bench_send_message.py --url http://localhost:5000 --token <JWT> --dialog 1 --messages 2000 --concurrency 8
+"""
+import time
+import argparse
+import threading
+import statistics
+import requests
+
+
+def worker(args, count, latencies, errors):
+    session = requests.Session()
+    session.headers['Authorization'] = f'Bearer {args.token}'
+    url = f'{args.url}/group/{args.dialog}/messages' if args.is_group else f'{args.url}/messages/{args.dialog}'
+    for i in range(count):
+        start = time.perf_counter()
+        response = session.post(url, json={'text': f'bench {i}'})
+        latencies.append(time.perf_counter() - start)
+        if response.status_code != 201:
+            errors.append(response.status_code)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--token', required=True)
+    parser.add_argument('--dialog', type=int, required=True, help='id диалога или группы')
+    parser.add_argument('--is-group', action='store_true')
+    parser.add_argument('--messages', type=int, default=2000)
+    parser.add_argument('--concurrency', type=int, default=8)
+    args = parser.parse_args()
+
+    latencies, errors = [], []
+    per_thread = args.messages // args.concurrency
+    threads = [threading.Thread(target=worker, args=(args, per_thread, latencies, errors)) for _ in range(args.concurrency)]
+
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    latencies.sort()
+    print(f'{len(latencies)} messages in {elapsed:.1f} s: {len(latencies) / elapsed:.0f} msg/s, errors: {len(errors)}')
+    print(f'latency p50 {statistics.median(latencies) * 1000:.1f} ms, '
+          f'p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms, '
+          f'p99 {latencies[int(len(latencies) * 0.99)] * 1000:.1f} ms')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,76 @@
+"""
+Сравнение плоской и шардированной раскладки каталога загрузок.
+
+Создает N пустых файлов в плоском каталоге и в каталоге с шардами по префиксу md5 от имени,
+затем меряет время os.path.exists (попадание и промах) и листинга.
+
+    python bench_upload_layout.py --sizes 1000 10000 100000 --depth 1 --width 2
+"""
+import os
+import time
+import uuid
+import random
+import hashlib
+import argparse
+import tempfile
+
+
+def shard_path(directory, filename, depth, width):
+    digest = hashlib.md5(filename.encode()).hexdigest()
+    shards = [digest[i * width:(i + 1) * width] for i in range(depth)]
+    return os.path.join(directory, *shards, filename)
+
+
+def fill(directory, names, depth, width):
+    for name in names:
+        path = shard_path(directory, name, depth, width)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'wb').close()
+
+
+def measure(func, repeat):
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat * 1e6  # мкс
+
+
+def bench(size, depth, width, lookups):
+    names = [f'{uuid.uuid4().hex}.jpg' for _ in range(size)]
+    sample = random.sample(names, min(lookups, size))
+    missing = [f'{uuid.uuid4().hex}.jpg' for _ in range(len(sample))]
+
+    results = {}
+    with tempfile.TemporaryDirectory() as root:
+        for layout, layout_depth in [('flat', 0), ('sharded', depth)]:
+            directory = os.path.join(root, layout)
+            os.makedirs(directory)
+            fill(directory, names, layout_depth, width)
+
+            hits = iter(sample * 2)
+            misses = iter(missing * 2)
+            results[layout] = {
+                'exists_hit': measure(lambda: os.path.exists(shard_path(directory, next(hits), layout_depth, width)), len(sample)),
+                'exists_miss': measure(lambda: os.path.exists(shard_path(directory, next(misses), layout_depth, width)), len(missing)),
+                # Листинг одного каталога: для шардов - одного подкаталога (так работает поиск превью по префиксу)
+                'listdir': measure(lambda: os.listdir(os.path.dirname(shard_path(directory, sample[0], layout_depth, width))), 5)
+            }
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--sizes', type=int, nargs='+', default=[1000, 10000, 100000])
+    parser.add_argument('--depth', type=int, default=1)
+    parser.add_argument('--width', type=int, default=2)
+    parser.add_argument('--lookups', type=int, default=1000)
+    args = parser.parse_args()
+
+    print(f"{'files':>8} {'layout':>8} {'exists hit, us':>15} {'exists miss, us':>16} {'listdir, us':>12}")
+    for size in args.sizes:
+        for layout, row in bench(size, args.depth, args.width, args.lookups).items():
+            print(f"{size:>8} {layout:>8} {row['exists_hit']:>15.1f} {row['exists_miss']:>16.1f} {row['listdir']:>12.1f}")
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,148 @@
+"""
+Пропускная способность и пиковая память сервера: загрузка большого файла одним multipart-запросом
+(/upload/file) против возобновляемой сессии (/upload/session) кусками по --chunk байт.
+
+Работает против запущенного сервера. С --pid (процесс сервера или воркера на той же машине) во время
+каждой загрузки раз в 50 мс читается VmRSS из /proc и печатается прирост пика над исходным значением.
+--drop-every N моделирует обрыв связи: после каждых N кусков клиент открывает новое соединение,
+узнает offset через GET и продолжает с него.
+
+    python bench_upload_sessions.py --url http://localhost:5000 --token <JWT> --dialog 1 --size-mb 200 \
+        --chunk 8388608 --pid $(pgrep -f "python app.py" | head -1)
+"""
+import os
+import time
+import uuid
+import hashlib
+import argparse
+import tempfile
+import threading
+import requests
+
+
+class RssSampler:
+    """
+    Пиковый RSS процесса pid за время работы (из /proc/<pid>/status), в байтах.
+    """
+    def __init__(self, pid):
+        self.pid = pid
+        self.peak = 0
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(target=self.run, daemon=True)
+
+    def rss(self):
+        with open(f'/proc/{self.pid}/status') as status:
+            for line in status:
+                if line.startswith('VmRSS:'):
+                    return int(line.split()[1]) * 1024
+        return 0
+
+    def run(self):
+        while not self.stopping.is_set():
+            self.peak = max(self.peak, self.rss())
+            time.sleep(0.05)
+
+    def __enter__(self):
+        self.baseline = self.rss()
+        self.thread.start()
+        return self
+
+    def __exit__(self, *exc):
+        self.stopping.set()
+        self.thread.join()
+
+
+def make_file(size):
+    """
+    Случайный файл на диске (а не в памяти клиента). Возвращает (путь, sha256).
+    """
+    sha = hashlib.sha256()
+    handle, path = tempfile.mkstemp(suffix='.pdf')
+    with os.fdopen(handle, 'wb') as out:
+        remaining = size
+        while remaining:
+            chunk = os.urandom(min(remaining, 1024 * 1024))
+            sha.update(chunk)
+            out.write(chunk)
+            remaining -= len(chunk)
+    return path, sha.hexdigest()
+
+
+def new_session(args):
+    session = requests.Session()
+    session.headers['Authorization'] = f'Bearer {args.token}'
+    return session
+
+
+def upload_multipart(args, path, checksum, name):
+    with open(path, 'rb') as f:
+        response = new_session(args).post(f'{args.url}/upload/file/{args.dialog}/{args.is_group}', files={'file': (name, f)})
+    response.raise_for_status()
+    return 1
+
+
+def upload_session(args, path, checksum, name):
+    size = os.path.getsize(path)
+    http = new_session(args)
+    response = http.post(f'{args.url}/upload/session/{args.dialog}/{args.is_group}',
+                         json={'type': 'file', 'filename': name, 'size': size, 'sha256': checksum})
+    response.raise_for_status()
+    session_id = response.json()['session_id']
+
+    offset, chunks, reconnects = 0, 0, 0
+    with open(path, 'rb') as f:
+        while offset < size:
+            if args.drop_every and chunks and chunks % args.drop_every == 0:
+                # Обрыв: новое соединение, позицию спрашиваем у сервера
+                http.close()
+                http = new_session(args)
+                offset = http.get(f'{args.url}/upload/session/{session_id}').json()['offset']
+                reconnects += 1
+            f.seek(offset)
+            chunk = f.read(args.chunk)
+            response = http.put(f'{args.url}/upload/session/{session_id}', params={'offset': offset}, data=chunk)
+            response.raise_for_status()
+            offset = response.json()['offset']
+            chunks += 1
+
+    http.post(f'{args.url}/upload/session/{session_id}/finalize').raise_for_status()
+    return chunks + reconnects + 2
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--url', default='http://localhost:5000')
+    parser.add_argument('--token', required=True)
+    parser.add_argument('--dialog', type=int, required=True)
+    parser.add_argument('--is-group', type=int, default=0)
+    parser.add_argument('--size-mb', type=int, default=200)
+    parser.add_argument('--chunk', type=int, default=8 * 1024 * 1024, help='размер куска сессии, байт')
+    parser.add_argument('--drop-every', type=int, default=0, help='обрыв соединения после каждых N кусков')
+    parser.add_argument('--pid', type=int, help='процесс сервера для замера RSS')
+    args = parser.parse_args()
+
+    size = args.size_mb * 1024 * 1024
+    for label, upload in [('multipart', upload_multipart), ('session', upload_session)]:
+        # Новое содержимое на каждый прогон, чтобы не мерить дедупликацию
+        path, checksum = make_file(size)
+        name = f'bench_{uuid.uuid4().hex[:8]}.pdf'
+        try:
+            sampler = RssSampler(args.pid) if args.pid else None
+            start = time.perf_counter()
+            if sampler:
+                with sampler:
+                    requests_made = upload(args, path, checksum, name)
+            else:
+                requests_made = upload(args, path, checksum, name)
+            elapsed = time.perf_counter() - start
+        finally:
+            os.remove(path)
+
+        line = f'{label:>9}: {elapsed:.2f} s, {size / elapsed / 1024 / 1024:.1f} MB/s, запросов {requests_made}'
+        if sampler:
+            line += f', пик RSS сервера +{(sampler.peak - sampler.baseline) / 1024 / 1024:.1f} MB'
+        print(line)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,134 @@
+"""
+Проверка S3Storage: put, put_file, link, open, stat, delete, exists и list.
+
+По умолчанию работает с локальной подменой S3 из moto (pip install moto), без сети. С --endpoint
+проверяет настоящий S3-совместимый сервер, например MinIO (бакет создается, если его нет).
+Код выхода 1, если хотя бы одна проверка не прошла.
+
+    python check_s3_storage.py
+    python check_s3_storage.py --endpoint http://localhost:9000 --bucket messenger-check \
+        --access-key minioadmin --secret-key minioadmin
+"""
+import io
+import os
+import sys
+import uuid
+import argparse
+import tempfile
+import threading
+from contextlib import nullcontext
+from storage import S3Storage, boto3
+
+try:
+    from moto import mock_aws
+except ImportError:
+    mock_aws = None
+
+BASE = '/srv/uploads'
+
+
+def check(label, condition, detail=''):
+    print(f'{"ok" if condition else "FAIL":>4}  {label}' + (f' ({detail})' if detail else ''))
+    return condition
+
+
+def run_checks(storage, concurrent):
+    prefix = os.path.join(BASE, 'check', uuid.uuid4().hex)
+    path = os.path.join(prefix, 'a.bin')
+    data = os.urandom(300 * 1024)
+    passed = True
+
+    passed &= check('exists до записи', not storage.exists(path))
+    passed &= check('stat до записи', storage.stat(path) is None)
+    passed &= check('put возвращает размер', storage.put(path, io.BytesIO(data)) == len(data))
+    passed &= check('exists после записи', storage.exists(path))
+    stat = storage.stat(path)
+    passed &= check('stat: size и etag', bool(stat) and stat['size'] == len(data) and bool(stat['etag']), str(stat))
+    with storage.open(path) as stream:
+        passed &= check('open читает записанное', stream.read() == data)
+
+    handle, local_file = tempfile.mkstemp()
+    with os.fdopen(handle, 'wb') as out:
+        out.write(b'blob')
+    blob = os.path.join(prefix, 'blobs', 'b.bin')
+    storage.put_file(local_file, blob)
+    passed &= check('put_file загружает и удаляет локальный файл', storage.exists(blob) and not os.path.exists(local_file))
+    handle, local_file = tempfile.mkstemp()
+    os.close(handle)
+    storage.put_file(local_file, blob)
+    with storage.open(blob) as stream:
+        passed &= check('put_file не перезаписывает существующий ключ', stream.read() == b'blob' and not os.path.exists(local_file))
+
+    target = os.path.join(prefix, 'link', 'a.bin')
+    storage.link(path, target)
+    with storage.open(target) as stream:
+        passed &= check('link копирует содержимое', stream.read() == data)
+    try:
+        storage.link(blob, target)
+        passed &= check('link на занятое имя - FileExistsError', False)
+    except FileExistsError:
+        with storage.open(target) as stream:
+            passed &= check('link на занятое имя - FileExistsError, содержимое прежнее', stream.read() == data)
+
+    empty = os.path.join(prefix, 'empty.bin')
+    storage.put(empty, io.BytesIO(b''))
+    storage.link(empty, os.path.join(prefix, 'link', 'empty.bin'))
+    passed &= check('link пустого объекта', storage.stat(os.path.join(prefix, 'link', 'empty.bin'))['size'] == 0)
+
+    # Одновременные ссылки на одно имя: ровно одна успешна. moto проверяет If-None-Match
+    # без блокировки, поэтому проверка имеет смысл только на настоящем сервере
+    if concurrent:
+        race_target = os.path.join(prefix, 'link', 'race.bin')
+        outcomes = []
+
+        def race():
+            try:
+                storage.link(path, race_target)
+                outcomes.append('linked')
+            except FileExistsError:
+                outcomes.append('exists')
+
+        threads = [threading.Thread(target=race) for _ in range(8)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        passed &= check('параллельный link: одна ссылка, остальные FileExistsError', outcomes.count('linked') == 1, str(outcomes))
+    else:
+        print('skip  параллельный link (только с --endpoint)')
+
+    passed &= check('list', sorted(storage.list(prefix)) == ['a.bin', 'empty.bin'], str(storage.list(prefix)))
+    passed &= check('delete существующего', storage.delete(path) is True and not storage.exists(path))
+    passed &= check('delete отсутствующего', storage.delete(path) is False)
+    passed &= check('link после удаления источника остается', storage.exists(target))
+    return passed
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.strip().splitlines()[0])
+    parser.add_argument('--endpoint', help='S3-совместимый сервер; без него - moto')
+    parser.add_argument('--bucket', default='messenger-check')
+    parser.add_argument('--region', default='us-east-1')
+    parser.add_argument('--access-key', default='testing')
+    parser.add_argument('--secret-key', default='testing')
+    args = parser.parse_args()
+
+    if boto3 is None:
+        sys.exit('нужен boto3')
+    if not args.endpoint and mock_aws is None:
+        sys.exit('нужен moto (pip install moto) или --endpoint')
+
+    with mock_aws() if not args.endpoint else nullcontext():
+        storage = S3Storage(BASE, args.bucket, endpoint_url=args.endpoint, region=args.region,
+                            access_key=args.access_key, secret_key=args.secret_key)
+        try:
+            storage.client.create_bucket(Bucket=args.bucket)
+        except storage.client.exceptions.BucketAlreadyOwnedByYou:
+            pass
+        passed = run_checks(storage, concurrent=bool(args.endpoint))
+
+    sys.exit(0 if passed else 1)
+
+
+if __name__ == '__main__':
+    main()
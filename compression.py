@@ -0,0 +1,84 @@
+"""
+Сжатие JSON-ответов по Accept-Encoding (brotli, если установлен пакет Brotli, иначе gzip).
+
+Сжимаются ответы с типом из COMPRESS_MIMETYPES не меньше COMPRESS_MIN_SIZE байт: короткие
+ответы сжатие только удлиняет. Потоковые ответы (json_provider.stream_array) сжимаются по
+частям, без сборки тела в памяти. Файлы (send_file, X-Accel-Redirect) и уже сжатые ответы
+не трогаются. Сильный ETag у сжатого ответа становится слабым (W/), как у gzip в nginx:
+байты тела другие, а один сильный валидатор не может описывать разные представления.
+Условные ответы приложения сами выдают слабые ETag и сравнивают If-None-Match слабо.
+"""
+import gzip
+import zlib
+from flask import request
+
+try:
+    import brotli
+except ImportError:  # Без Brotli отдается только gzip
+    brotli = None
+
+
+def choose_encoding(accept_encodings):
+    if brotli is not None and accept_encodings.quality('br') > 0:
+        return 'br'
+    if accept_encodings.quality('gzip') > 0:
+        return 'gzip'
+    return None
+
+
+def compress(body, encoding, config):
+    if encoding == 'br':
+        return brotli.compress(body, quality=config['COMPRESS_BROTLI_QUALITY'])
+    return gzip.compress(body, compresslevel=config['COMPRESS_GZIP_LEVEL'], mtime=0)
+
+
+def compress_stream(chunks, encoding, config):
+    if encoding == 'br':
+        compressor = brotli.Compressor(quality=config['COMPRESS_BROTLI_QUALITY'])
+        for chunk in chunks:
+            data = compressor.process(chunk)
+            if data:
+                yield data
+        yield compressor.finish()
+        return
+
+    # wbits 16 + MAX_WBITS - формат gzip (заголовок и CRC), а не zlib
+    compressor = zlib.compressobj(config['COMPRESS_GZIP_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def init_app(app):
+    config = app.config
+    if not config['COMPRESS_ENABLED']:
+        return
+
+    @app.after_request
+    def compress_response(response):
+        if (response.status_code < 200 or response.status_code >= 300 or response.status_code == 204
+                or response.direct_passthrough
+                or 'Content-Encoding' in response.headers
+                or response.mimetype not in config['COMPRESS_MIMETYPES']):
+            return response
+
+        response.vary.add('Accept-Encoding')
+        encoding = choose_encoding(request.accept_encodings)
+        if encoding is None:
+            return response
+
+        if response.is_streamed:
+            response.response = compress_stream(response.response, encoding, config)
+            response.headers.pop('Content-Length', None)
+        else:
+            body = response.get_data()
+            if len(body) < config['COMPRESS_MIN_SIZE']:
+                return response
+            response.set_data(compress(body, encoding, config))
+        response.headers['Content-Encoding'] = encoding
+        etag, weak = response.get_etag()
+        if etag and not weak:
+            response.set_etag(etag, weak=True)
+        return response
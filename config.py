@@ -12,3 +12,71 @@ class Config:
     UPLOAD_FOLDER_FILES = 'files'
     UPLOAD_FOLDER_DIALOGS = 'dialogs'
     UPLOAD_FOLDER_GROUPS = 'groups'
+    UPLOAD_FOLDER_BLOBS = 'blobs'
+    # Раскладка каталогов загрузок: файлы раскладываются по подкаталогам по префиксу md5 от имени.
+    # 0 - старый плоский каталог; 1 уровень по 2 символа = 256 подкаталогов
+    UPLOAD_SHARD_DEPTH = int(os.getenv('UPLOAD_SHARD_DEPTH', 1))
+    UPLOAD_SHARD_WIDTH = int(os.getenv('UPLOAD_SHARD_WIDTH', 2))
+    UPLOAD_SESSION_TTL = int(os.getenv('UPLOAD_SESSION_TTL', 24 * 60 * 60))  # секунды без активности до удаления сессии
+    # Отдача медиа: direct - сам Flask, x-accel - Nginx X-Accel-Redirect, x-sendfile - X-Sendfile (Apache/lighttpd)
+    MEDIA_DELIVERY = os.getenv('MEDIA_DELIVERY', 'direct')
+    MEDIA_ACCEL_PREFIX = os.getenv('MEDIA_ACCEL_PREFIX', '/protected_uploads')
+    MEDIA_CACHE_MAX_AGE = int(os.getenv('MEDIA_CACHE_MAX_AGE', 365 * 24 * 60 * 60))
+    # Хранилище файлов: local - диск (UPLOAD_FOLDER_BASE), s3 - S3-совместимый бакет (AWS, MinIO)
+    STORAGE_BACKEND = os.getenv('STORAGE_BACKEND', 'local')
+    S3_BUCKET = os.getenv('S3_BUCKET')
+    S3_ENDPOINT_URL = os.getenv('S3_ENDPOINT_URL')  # для MinIO, например http://minio:9000
+    S3_REGION = os.getenv('S3_REGION')
+    S3_ACCESS_KEY = os.getenv('S3_ACCESS_KEY')
+    S3_SECRET_KEY = os.getenv('S3_SECRET_KEY')
+    UPLOAD_MAX_SIZE = int(os.getenv('UPLOAD_MAX_SIZE', 2 * 1024 * 1024 * 1024))
+    # Сборка файлов, на которые не ссылается ни одно сообщение: quarantine - перенос в uploads/quarantine, delete - удаление
+    UPLOAD_GC_MODE = os.getenv('UPLOAD_GC_MODE', 'quarantine')
+    UPLOAD_GC_GRACE = int(os.getenv('UPLOAD_GC_GRACE', 24 * 60 * 60))  # секунды после загрузки, когда файл еще не трогаем
+    UPLOAD_GC_BATCH = int(os.getenv('UPLOAD_GC_BATCH', 500))
+    # Уменьшенные копии аватарок (WebP), отдаются по /avatars/<filename>?size=N
+    AVATAR_SIZES = [int(size) for size in os.getenv('AVATAR_SIZES', '64,128,512').split(',')]
+    AVATAR_VARIANT_QUALITY = int(os.getenv('AVATAR_VARIANT_QUALITY', 80))
+    AVATAR_VARIANT_CACHE_MAX = int(os.getenv('AVATAR_VARIANT_CACHE_MAX', 10000))  # путей вариантов в памяти процесса
+    AVATAR_VARIANT_RETRY = int(os.getenv('AVATAR_VARIANT_RETRY', 3600))  # секунд до повторной генерации после ошибки
+    # Relay событий из outbox (python outbox.py)
+    OUTBOX_BATCH_SIZE = int(os.getenv('OUTBOX_BATCH_SIZE', 200))
+    OUTBOX_POLL_INTERVAL = float(os.getenv('OUTBOX_POLL_INTERVAL', 1.0))  # секунды ожидания NOTIFY
+    OUTBOX_METRICS_INTERVAL = int(os.getenv('OUTBOX_METRICS_INTERVAL', 60))
+    OUTBOX_PUSH_WORKERS = int(os.getenv('OUTBOX_PUSH_WORKERS', 8))
+    EVENT_REPLAY_MAXLEN = int(os.getenv('EVENT_REPLAY_MAXLEN', 1000))  # событий на чат в журнале досылки
+    EVENT_REPLAY_TTL = int(os.getenv('EVENT_REPLAY_TTL', 7 * 24 * 3600))  # секунды хранения журнала неактивного чата
+    SYNC_PAGE_SIZE = int(os.getenv('SYNC_PAGE_SIZE', 500))  # записей ленты изменений на один ответ /sync
+    SYNC_RETENTION = int(os.getenv('SYNC_RETENTION', 30 * 24 * 3600))  # секунды хранения изменений и tombstones
+    SYNC_PURGE_INTERVAL = int(os.getenv('SYNC_PURGE_INTERVAL', 3600))
+    CONVERSATIONS_PAGE_SIZE = int(os.getenv('CONVERSATIONS_PAGE_SIZE', 30))  # первый экран списка чатов
+    CONVERSATIONS_PAGE_MAX = int(os.getenv('CONVERSATIONS_PAGE_MAX', 100))
+    RECENT_MESSAGES_CACHE_SIZE = int(os.getenv('RECENT_MESSAGES_CACHE_SIZE', 50))  # последних сообщений на чат в Redis
+    RECENT_MESSAGES_TTL = int(os.getenv('RECENT_MESSAGES_TTL', 3600))
+    RECENT_MESSAGES_STATS_INTERVAL = int(os.getenv('RECENT_MESSAGES_STATS_INTERVAL', 10))
+    UPLOAD_BATCH_MAX_FILES = int(os.getenv('UPLOAD_BATCH_MAX_FILES', 20))  # оригиналов в одном запросе /upload/batch
+    # Кодирование и сжатие JSON-ответов: orjson (если установлен) или stdlib
+    JSON_PROVIDER = os.getenv('JSON_PROVIDER', 'orjson')
+    JSON_STREAM_MIN_ITEMS = int(os.getenv('JSON_STREAM_MIN_ITEMS', 2000))  # списки длиннее отдаются потоком
+    JSON_STREAM_CHUNK = int(os.getenv('JSON_STREAM_CHUNK', 500))  # элементов на кусок потока
+    COMPRESS_ENABLED = os.getenv('COMPRESS_ENABLED', 'true').lower() == 'true'  # false, если сжимает Nginx
+    COMPRESS_MIN_SIZE = int(os.getenv('COMPRESS_MIN_SIZE', 1024))  # байт, меньшие ответы не сжимаются
+    COMPRESS_MIMETYPES = {'application/json', 'application/x-ndjson'}
+    COMPRESS_GZIP_LEVEL = int(os.getenv('COMPRESS_GZIP_LEVEL', 6))
+    COMPRESS_BROTLI_QUALITY = int(os.getenv('COMPRESS_BROTLI_QUALITY', 4))
+    EXPORT_CHUNK = int(os.getenv('EXPORT_CHUNK', 1000))  # строк серверного курсора на пачку выгрузки истории
+    EXPORT_CHANGES_PAGE = int(os.getenv('EXPORT_CHANGES_PAGE', 2000))  # записей ленты изменений на одну дозагрузку
+    USER_BATCH_MAX = int(os.getenv('USER_BATCH_MAX', 200))  # пользователей в одном запросе /users/batch, /users/keys
+    # Срок кэширования публичных ключей клиентом. Ключ меняется при входе с нового устройства (POST /user/key),
+    # поэтому срок ограничен часом: дальше клиент перепроверяет ключи по ETag
+    USER_KEYS_MAX_AGE = int(os.getenv('USER_KEYS_MAX_AGE', 3600))
+    # Время последней активности: heartbeat копится в Redis и пишется в БД пачками (см. presence.py)
+    LAST_SESSION_FLUSH_INTERVAL = int(os.getenv('LAST_SESSION_FLUSH_INTERVAL', 30))
+    LAST_SESSION_FLUSH_BATCH = int(os.getenv('LAST_SESSION_FLUSH_BATCH', 1000))
+    LAST_SESSION_FLUSH_LOCK_TIMEOUT = int(os.getenv('LAST_SESSION_FLUSH_LOCK_TIMEOUT', 60))  # продлевается после каждой пачки
+    PRESENCE_BROADCAST_INTERVAL = int(os.getenv('PRESENCE_BROADCAST_INTERVAL', 60))  # секунды между user_session_updated
+    # Журнал аудита (Log): очередь процесса и пакетная запись фоновым потоком (см. audit.py)
+    AUDIT_QUEUE_MAX = int(os.getenv('AUDIT_QUEUE_MAX', 10000))  # записей в очереди процесса
+    AUDIT_BATCH_SIZE = int(os.getenv('AUDIT_BATCH_SIZE', 500))  # записей в одном INSERT
+    AUDIT_FLUSH_INTERVAL = float(os.getenv('AUDIT_FLUSH_INTERVAL', 1.0))  # секунды ожидания неполной пачки
+    AUDIT_ENQUEUE_TIMEOUT = float(os.getenv('AUDIT_ENQUEUE_TIMEOUT', 0.05))  # ожидание места в очереди до синхронной записи
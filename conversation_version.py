@@ -0,0 +1,93 @@
+"""
+Версии списка чатов пользователя для условных запросов GET /conversations (ETag / 304).
+
+Изменения чатов отмечаются в сессии (sync_log.record делает это для всех событий сообщений,
+настроек и состава), перед коммитом отмечаются участники, а после коммита их счетчики
+conversations_version:<user_id> в Redis увеличиваются одним pipeline. Увеличение только после
+коммита гарантирует, что по новой версии никогда не закэшируется старое состояние.
+"""
+import time
+from sqlalchemy import text, event
+from sqlalchemy.orm import Session
+
+
+def version_key(user_id):
+    return f'conversations_version:{user_id}'
+
+
+def mark_changed(session, scope, conv_id):
+    session.info.setdefault('changed_conversations', set()).add((scope, conv_id))
+
+
+def mark_users(session, user_ids):
+    session.info.setdefault('changed_users', set()).update(user_ids)
+
+
+def mark_profile(session, user_id):
+    """
+    Имя и аватар пользователя видны в списках чатов его собеседников и участников его групп.
+    """
+    session.info.setdefault('changed_profiles', set()).add(user_id)
+
+
+def current(redis_client, user_id):
+    """
+    Текущая версия списка чатов. Начальное значение - время в мс, чтобы после потери ключа
+    в Redis версии не повторяли уже выданные клиентам ETag.
+    """
+    key = version_key(user_id)
+    version = redis_client.get(key)
+    if version is None:
+        redis_client.set(key, int(time.time() * 1000), nx=True)
+        version = redis_client.get(key)
+    return int(version)
+
+
+@event.listens_for(Session, 'before_commit')
+def resolve_members(session):
+    conversations = session.info.pop('changed_conversations', set())
+    profiles = session.info.pop('changed_profiles', set())
+    users = session.info.setdefault('changed_users', set())
+
+    dialog_ids = [conv_id for scope, conv_id in conversations if scope == 'dialog']
+    group_ids = [conv_id for scope, conv_id in conversations if scope == 'group']
+    if dialog_ids:
+        for row in session.execute(text('SELECT id_user1, id_user2 FROM dialog WHERE id = ANY(:ids)'), {'ids': dialog_ids}):
+            users.update(row)
+    if group_ids:
+        users.update(session.execute(text('SELECT user_id FROM group_member WHERE group_id = ANY(:ids)'),
+                                     {'ids': group_ids}).scalars())
+    if profiles:
+        users.update(session.execute(text('''
+            SELECT CASE WHEN id_user1 = ANY(:ids) THEN id_user2 ELSE id_user1 END
+            FROM dialog WHERE id_user1 = ANY(:ids) OR id_user2 = ANY(:ids)
+            UNION
+            SELECT other.user_id FROM group_member own
+            JOIN group_member other ON other.group_id = own.group_id
+            WHERE own.user_id = ANY(:ids)
+        '''), {'ids': list(profiles)}).scalars())
+
+
+@event.listens_for(Session, 'after_commit')
+def bump_versions(session):
+    users = session.info.pop('changed_users', None)
+    if not users:
+        return
+    from app import redis_client, logger
+
+    try:
+        pipe = redis_client.pipeline(transaction=False)
+        for user_id in users:
+            # SET NX на случай потерянного ключа: INCR от нуля дал бы уже выданные версии
+            pipe.set(version_key(user_id), int(time.time() * 1000), nx=True)
+            pipe.incr(version_key(user_id))
+        pipe.execute()
+    except Exception as e:
+        # Коммит уже выполнен: без увеличения версии клиент увидит изменения при следующем изменении чата
+        logger.error(f"Не удалось обновить версии списков чатов: {e}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_changes(session):
+    for key in ('changed_conversations', 'changed_users', 'changed_profiles'):
+        session.info.pop(key, None)
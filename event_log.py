@@ -0,0 +1,106 @@
+"""
+Журнал событий чатов для досылки после переподключения сокета.
+
+Каждое событие комнаты dialog_<id> / group_<id> получает номер seq из счетчика event_seq
+строки чата. Номер выдается в транзакции изменения (строка блокируется до коммита), поэтому
+внутри чата номера растут в порядке коммитов без пропусков. Relay (outbox.py) складывает
+события в Redis Stream чата с ID "<seq>-0" и ограничением длины EVENT_REPLAY_MAXLEN.
+"""
+import json
+import redis
+from flask import current_app
+from sqlalchemy import text
+from models import db
+
+CONVERSATION_TABLES = {'dialog': 'dialog', 'group': '"group"'}
+
+
+def parse_room(room):
+    """
+    'dialog_5' -> ('dialog', 5). Для прочих комнат (user_<id>, глобальные) - (None, None).
+    """
+    scope, _, conv_id = (room or '').partition('_')
+    if scope not in CONVERSATION_TABLES or not conv_id.isdigit():
+        return None, None
+    return scope, int(conv_id)
+
+
+def stream_key(room):
+    return f'conversation_events:{room}'
+
+
+def next_seq(room):
+    """
+    Выдает следующий номер события чата в текущей транзакции. None, если комната не чат.
+    """
+    scope, conv_id = parse_room(room)
+    if not scope:
+        return None
+    return db.session.execute(
+        text(f'UPDATE {CONVERSATION_TABLES[scope]} SET event_seq = event_seq + 1 WHERE id = :id RETURNING event_seq'),
+        {'id': conv_id}
+    ).scalar()
+
+
+def current_seq(room):
+    scope, conv_id = parse_room(room)
+    return db.session.execute(
+        text(f'SELECT event_seq FROM {CONVERSATION_TABLES[scope]} WHERE id = :id'), {'id': conv_id}
+    ).scalar()
+
+
+def append_events(redis_client, events):
+    """
+    Добавляет пачку событий [(room, seq, event, payload)] в журналы чатов одним pipeline.
+    Повторная доставка того же seq (at-least-once в relay) отклоняется Redis как ID не больше
+    последнего и не создает дубликат.
+    """
+    config = current_app.config
+    pipe = redis_client.pipeline(transaction=False)
+    for room, seq, event_name, payload in events:
+        pipe.xadd(stream_key(room), {'event': event_name, 'payload': json.dumps(payload)},
+                  id=f'{seq}-0', maxlen=config['EVENT_REPLAY_MAXLEN'], approximate=True)
+        pipe.expire(stream_key(room), config['EVENT_REPLAY_TTL'])
+    results = pipe.execute(raise_on_error=False)
+    for result in results:
+        if isinstance(result, Exception) and not isinstance(result, redis.ResponseError):
+            raise result
+
+
+def entry_seq(entry_id):
+    return int(entry_id.split(b'-')[0])
+
+
+def replay(redis_client, room, last_seq):
+    """
+    События чата после last_seq: {'seq': текущий номер, 'events': [...], 'full_resync': bool}.
+    full_resync=True, если часть пропущенных событий уже вытеснена из журнала (или номер клиента
+    не от этого чата) - тогда клиент перезагружает историю целиком. События, которые уже
+    закоммичены, но еще не дошли через relay, в ответ не попадают и придут в комнату обычным путем.
+    """
+    seq = current_seq(room)
+    db.session.commit()
+    if seq is None:
+        return None
+
+    if last_seq > seq:
+        return {'seq': seq, 'events': [], 'full_resync': True}
+    if last_seq == seq:
+        return {'seq': seq, 'events': [], 'full_resync': False}
+
+    key = stream_key(room)
+    oldest = redis_client.xrange(key, count=1)
+    if not oldest or entry_seq(oldest[0][0]) > last_seq + 1:
+        return {'seq': seq, 'events': [], 'full_resync': True}
+
+    events = []
+    for entry_id, fields in redis_client.xrange(key, min=f'{last_seq + 1}-0', max='+'):
+        # Дыра в номерах возможна только при нескольких relay (событие отклонено как запоздавшее)
+        if entry_seq(entry_id) != last_seq + len(events) + 1:
+            return {'seq': seq, 'events': [], 'full_resync': True}
+        events.append({
+            'seq': entry_seq(entry_id),
+            'event': fields[b'event'].decode(),
+            'payload': json.loads(fields[b'payload'])
+        })
+    return {'seq': seq, 'events': events, 'full_resync': False}
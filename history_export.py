@@ -0,0 +1,149 @@
+"""
+Выгрузка текстовых сообщений чата для локального поиска на клиенте (сообщения зашифрованы,
+поэтому искать может только клиент).
+
+Ответ - NDJSON, по одному объекту в строке:
+    {"type": "reset"}                    - клиент очищает индекс чата (полная выгрузка)
+    {"type": "message", "id": ..., ...}  - добавить или обновить сообщение
+    {"type": "deleted", "ids": [...]}    - убрать сообщения из индекса
+    {"type": "end", "next": <token>, "has_more": bool} - последняя строка
+
+Полная выгрузка читает таблицу сообщений серверным курсором пачками по EXPORT_CHUNK строк,
+поэтому память процесса не зависит от размера чата. Токен next - тот же курсор ленты изменений
+(sync_log), что и у /sync: следующий запрос с since получает только новые, измененные
+и удаленные с тех пор сообщения, не больше EXPORT_CHANGES_PAGE записей ленты за раз.
+Ответ без строки end оборван - клиент повторяет запрос с тем же since.
+"""
+from flask import current_app, stream_with_context
+from sqlalchemy import text
+from models import db
+import json_provider
+import message_payload
+import sync_log
+
+EXPORT_FIELDS = ('id', 'id_sender', 'text', 'is_edited', 'timestamp')
+INDEXED_KINDS = ('new', 'edited', 'deleted', 'all_deleted')
+
+
+def table_name(scope, conv_id):
+    return f'messages_{scope}_{conv_id}'
+
+
+def line(obj):
+    return json_provider.encode(obj) + b'\n'
+
+
+def message_lines(messages):
+    return b''.join(line({'type': 'message', **message}) for message in messages)
+
+
+def full_export(scope, conv_id, chunk_size):
+    # xmin до начала чтения: все, что закоммичено позже, придет по токену (возможно повторно)
+    xmin = sync_log.snapshot_xmin()
+    yield line({'type': 'reset'})
+
+    query = text(f'''
+        SELECT {message_payload.select_columns(EXPORT_FIELDS)}
+        FROM {table_name(scope, conv_id)}
+        WHERE text IS NOT NULL
+        ORDER BY id
+    ''')
+    result = db.session.connection().execution_options(stream_results=True, max_row_buffer=chunk_size).execute(query)
+    for rows in result.partitions(chunk_size):
+        yield message_lines(message_payload.serialize(rows, EXPORT_FIELDS))
+
+    yield line({'type': 'end', 'next': sync_log.make_token(xmin, 0), 'has_more': False})
+
+
+def fetch_changes(scope, conv_id, txid, change_id, xmin, limit):
+    return db.session.execute(text('''
+        SELECT id, txid, kind, message_ids
+        FROM conversation_change
+        WHERE scope = :scope AND conv_id = :conv_id AND user_id IS NULL
+          AND (txid, id) > (:txid, :change_id)
+          AND txid < :xmin
+          AND kind = ANY(:kinds)
+        ORDER BY txid, id
+        LIMIT :limit
+    '''), {'scope': scope, 'conv_id': conv_id, 'txid': txid, 'change_id': change_id, 'xmin': xmin,
+           'kinds': list(INDEXED_KINDS), 'limit': limit}).mappings().all()
+
+
+def collapse(rows):
+    """
+    Записи ленты -> (reset, id для перечитывания, удаленные id). Сообщение, созданное
+    и удаленное за время отсутствия клиента, попадает только в удаленные.
+    """
+    reset = False
+    changed, deleted = {}, {}
+    for row in rows:
+        message_ids = row['message_ids'] or []
+        if row['kind'] in ('new', 'edited'):
+            changed.update(dict.fromkeys(message_ids))
+        elif row['kind'] == 'deleted':
+            for message_id in message_ids:
+                changed.pop(message_id, None)
+                deleted[message_id] = None
+        elif row['kind'] == 'all_deleted':
+            reset = True
+            changed.clear()
+            deleted.clear()
+    return reset, list(changed), list(deleted)
+
+
+def incremental_export(scope, conv_id, txid, change_id, chunk_size):
+    limit = current_app.config['EXPORT_CHANGES_PAGE']
+    xmin = sync_log.snapshot_xmin()
+    rows = fetch_changes(scope, conv_id, txid, change_id, xmin, limit)
+    reset, changed, deleted = collapse(rows)
+
+    if reset:
+        yield line({'type': 'reset'})
+    if deleted:
+        yield line({'type': 'deleted', 'ids': deleted})
+
+    query = text(f'''
+        SELECT {message_payload.select_columns(EXPORT_FIELDS)}
+        FROM {table_name(scope, conv_id)}
+        WHERE id = ANY(:ids)
+        ORDER BY id
+    ''')
+    for start in range(0, len(changed), chunk_size):
+        ids = changed[start:start + chunk_size]
+        messages = message_payload.serialize(db.session.execute(query, {'ids': ids}), EXPORT_FIELDS)
+        # Сообщение, у которого при редактировании убрали текст, из индекса удаляется
+        indexed = [message for message in messages if message['text'] is not None]
+        found = {message['id'] for message in indexed}
+        missing = [message_id for message_id in ids if message_id not in found]
+        if indexed:
+            yield message_lines(indexed)
+        if missing:
+            yield line({'type': 'deleted', 'ids': missing})
+
+    has_more = len(rows) == limit
+    if has_more:
+        token = sync_log.make_token(rows[-1]['txid'], rows[-1]['id'])
+    else:
+        token = sync_log.make_token(xmin, 0)
+    yield line({'type': 'end', 'next': token, 'has_more': has_more})
+
+
+def export_response(scope, conv_id, since):
+    """
+    Потоковый NDJSON-ответ. since - разобранный токен (txid, change_id, issued_at) или None.
+    Устаревший токен приводит к полной выгрузке, начинающейся с reset.
+    """
+    chunk_size = current_app.config['EXPORT_CHUNK']
+    if since and not sync_log.is_expired(since[2]):
+        lines = incremental_export(scope, conv_id, since[0], since[1], chunk_size)
+    else:
+        lines = full_export(scope, conv_id, chunk_size)
+
+    def generate():
+        try:
+            yield from lines
+        finally:
+            # Серверный курсор и транзакция живут до конца отдачи ответа
+            db.session.rollback()
+
+    return current_app.response_class(stream_with_context(generate()), mimetype='application/x-ndjson')
@@ -0,0 +1,90 @@
+"""
+Кодирование JSON-ответов приложения.
+
+JSON_PROVIDER = 'orjson' подключает OrjsonProvider: jsonify и app.json кодируют через orjson
+сразу в байты ответа, без промежуточной str. Ключи сортируются, как в стандартном провайдере
+Flask, а datetime, Decimal и прочие типы, которых нет в orjson, уходят в тот же default,
+поэтому ответы совпадают по содержимому. Единственное отличие - не-ASCII символы пишутся
+в UTF-8, а не escape-последовательностями \\uXXXX (кириллица занимает 2 байта вместо 6).
+Без установленного orjson или при JSON_PROVIDER = 'stdlib' остается стандартный провайдер.
+
+stream_array отдает очень длинные списки кусками по JSON_STREAM_CHUNK элементов, не собирая
+весь ответ в памяти.
+"""
+from flask import current_app, stream_with_context
+from flask.json.provider import DefaultJSONProvider
+
+try:
+    import orjson
+except ImportError:  # Без orjson используется стандартный json
+    orjson = None
+
+
+class OrjsonProvider(DefaultJSONProvider):
+    def option(self):
+        # datetime передаем в default, чтобы формат дат совпадал со стандартным провайдером (RFC 822)
+        option = orjson.OPT_NON_STR_KEYS | orjson.OPT_PASSTHROUGH_DATETIME
+        if self.sort_keys:
+            option |= orjson.OPT_SORT_KEYS
+        return option
+
+    def dumps_bytes(self, obj):
+        return orjson.dumps(obj, default=self.default, option=self.option())
+
+    def dumps(self, obj, **kwargs):
+        if kwargs:
+            # indent, separators и т.п. - параметры json.dumps
+            return super().dumps(obj, **kwargs)
+        return self.dumps_bytes(obj).decode()
+
+    def loads(self, s, **kwargs):
+        if kwargs:
+            return super().loads(s, **kwargs)
+        return orjson.loads(s)
+
+    def response(self, *args, **kwargs):
+        if (self.compact is None and self._app.debug) or self.compact is False:
+            return super().response(*args, **kwargs)
+        obj = self._prepare_response_obj(args, kwargs)
+        return self._app.response_class(self.dumps_bytes(obj) + b'\n', mimetype=self.mimetype)
+
+
+def init_app(app):
+    if app.config['JSON_PROVIDER'] == 'orjson':
+        if orjson is None:
+            app.logger.warning('orjson не установлен, JSON кодируется стандартным провайдером')
+            return
+        app.json = OrjsonProvider(app)
+
+
+def encode(obj):
+    provider = current_app.json
+    if isinstance(provider, OrjsonProvider):
+        return provider.dumps_bytes(obj)
+    return provider.dumps(obj, separators=(',', ':')).encode()
+
+
+def stream_array(items):
+    """
+    Ответ со списком items, закодированным по частям. Вызывающий код решает, когда это
+    выгоднее jsonify (обычно при len(items) >= JSON_STREAM_MIN_ITEMS).
+    """
+    chunk_size = current_app.config['JSON_STREAM_CHUNK']
+
+    def generate():
+        yield b'['
+        for start in range(0, len(items), chunk_size):
+            chunk = encode(items[start:start + chunk_size])[1:-1]
+            yield chunk if start == 0 else b',' + chunk
+        yield b']\n'
+
+    return current_app.response_class(stream_with_context(generate()), mimetype=current_app.json.mimetype)
+
+
+def array_response(items):
+    """
+    jsonify для коротких списков и stream_array для списков от JSON_STREAM_MIN_ITEMS элементов.
+    """
+    if len(items) >= current_app.config['JSON_STREAM_MIN_ITEMS']:
+        return stream_array(items)
+    return current_app.json.response(items)
@@ -0,0 +1,488 @@
+import os
+import uuid
+import hashlib
+from flask import current_app
+from sqlalchemy import text, event
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import func
+from models import db, MediaRef
+from storage import get_storage
+from storage_usage import record_usage
+
+CHUNK_SIZE = 64 * 1024
+
+
+def blobs_folder():
+    return os.path.join(current_app.config['UPLOAD_FOLDER_BASE'], current_app.config['UPLOAD_FOLDER_BLOBS'])
+
+
+def blob_path(digest):
+    """
+    Путь к блобу в контентно-адресуемом хранилище: blobs/ab/cd/abcd...
+    """
+    return os.path.join(blobs_folder(), digest[:2], digest[2:4], digest)
+
+
+def shard_path(directory, filename):
+    """
+    Путь к файлу в шардированной раскладке: каталог/ab/имя, где ab - префикс md5 от имени.
+    Глубина и ширина задаются UPLOAD_SHARD_DEPTH / UPLOAD_SHARD_WIDTH, при глубине 0 - плоский каталог.
+    """
+    depth = current_app.config['UPLOAD_SHARD_DEPTH']
+    width = current_app.config['UPLOAD_SHARD_WIDTH']
+    digest = hashlib.md5(filename.encode()).hexdigest()
+    shards = [digest[i * width:(i + 1) * width] for i in range(depth)]
+    return os.path.join(directory, *shards, filename)
+
+
+def candidate_paths(directory, filename):
+    """
+    Где может лежать файл: сначала шардированный путь, затем старый плоский каталог.
+    """
+    sharded = shard_path(directory, filename)
+    legacy = os.path.join(directory, filename)
+    return [sharded] if sharded == legacy else [sharded, legacy]
+
+
+def staging_folder():
+    """
+    Локальный каталог для временных файлов, пока считается хэш (при любом бэкенде).
+    """
+    folder = os.path.join(blobs_folder(), 'tmp')
+    os.makedirs(folder, exist_ok=True)
+    return folder
+
+
+def write_stream(stream, file_path):
+    """
+    Пишет поток на диск кусками и одновременно считает sha256.
+    Возвращает (digest, size).
+    """
+    sha = hashlib.sha256()
+    size = 0
+    with open(file_path, 'wb') as out:
+        while True:
+            chunk = stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+            out.write(chunk)
+            size += len(chunk)
+    return sha.hexdigest(), size
+
+
+def hash_file(file_path):
+    """
+    Считает sha256 файла на диске. Возвращает (digest, size).
+    """
+    sha = hashlib.sha256()
+    size = 0
+    with open(file_path, 'rb') as f:
+        while True:
+            chunk = f.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            sha.update(chunk)
+            size += len(chunk)
+    return sha.hexdigest(), size
+
+
+def _link_unique(source, directory, filename, digest, allow_original=True, exact=False):
+    """
+    Создает ссылку на блоб в каталоге диалога. При конфликте имени добавляет
+    суффикс из хэша содержимого, а не перебирает (1), (2)...
+    С exact=True имя не меняется, занятое имя - FileExistsError.
+    """
+    storage = get_storage()
+
+    def try_link(candidate):
+        paths = candidate_paths(directory, candidate)
+        # Имя занято файлом, который еще не перенесен из плоского каталога
+        if len(paths) > 1 and storage.exists(paths[1]):
+            return False
+        try:
+            storage.link(source, paths[0])
+            return True
+        except FileExistsError:
+            return False
+
+    if exact:
+        if try_link(filename):
+            return filename
+        raise FileExistsError(filename)
+
+    name, extension = os.path.splitext(filename)
+    candidates = [f"{name}({digest[:8]}){extension}"]
+    if allow_original:
+        candidates.insert(0, filename)
+    for candidate in candidates:
+        if try_link(candidate):
+            return candidate
+
+    # Тот же файл уже загружен под этим именем - берем случайный суффикс
+    while True:
+        candidate = f"{name}({uuid.uuid4().hex[:8]}){extension}"
+        if try_link(candidate):
+            return candidate
+
+
+def lock_blob(connection, digest):
+    """
+    Блокировка блоба до конца транзакции: захват ссылки и удаление файла блоба не пересекаются.
+    """
+    connection.execute(text('SELECT pg_advisory_xact_lock(hashtext(:hash))'), {'hash': digest})
+
+
+def acquire_blob(digest, size):
+    """
+    Регистрирует блоб (или увеличивает счетчик ссылок на существующий).
+    Блокировка держится до коммита, поэтому освобождение последней ссылки в другой
+    транзакции не удалит файл блоба, пока ссылка не записана.
+    """
+    lock_blob(db.session, digest)
+    db.session.execute(text('''
+        INSERT INTO media_blob (hash, size, ref_count, created_at)
+        VALUES (:hash, :size, 1, NOW())
+        ON CONFLICT (hash) DO UPDATE SET ref_count = media_blob.ref_count + 1
+    '''), {'hash': digest, 'size': size})
+    # При откате файл блоба удаляется, если строка блоба так и не появилась
+    db.session.info.setdefault('acquired_blobs', []).append(digest)
+
+
+def add_link(digest, size, directory, filename, user_id=None, exact=False, commit=True):
+    """
+    Записывает ссылку на блоб, счетчик которого уже увеличен в текущей транзакции, и коммитит.
+    Размер учитывается в счетчиках места чата и пользователя user_id.
+    С commit=False коммит выполняет вызывающий код вместе со своими изменениями.
+    """
+    # Имя, под которым раньше лежало другое содержимое, не переиспользуем:
+    # клиенты кэшируют медиа по URL навсегда (Cache-Control: immutable)
+    previous = MediaRef.query.filter_by(path=directory, filename=filename).first()
+    allow_original = previous is None or previous.blob_hash == digest
+
+    unique_filename = _link_unique(blob_path(digest), directory, filename, digest, allow_original, exact)
+    # При откате созданная ссылка в хранилище удаляется
+    db.session.info.setdefault('linked_files', []).append(shard_path(directory, unique_filename))
+
+    ref = MediaRef.query.filter_by(path=directory, filename=unique_filename).first()
+    if ref:
+        ref.blob_hash = digest
+        ref.size = size
+        ref.uploaded_by = user_id
+        ref.created_at = func.now()
+    else:
+        db.session.add(MediaRef(path=directory, filename=unique_filename, blob_hash=digest, size=size, uploaded_by=user_id))
+    record_usage(directory, user_id, size)
+    if commit:
+        db.session.commit()
+    else:
+        db.session.flush()
+
+    return unique_filename
+
+
+def abandon_blob(digest):
+    """
+    Откатывает незавершенный захват блоба. Файл блоба, на который ссылок так и не появилось,
+    и созданные ссылки убирает обработчик отката.
+    """
+    db.session.rollback()
+
+
+def link_blob(digest, size, directory, filename, user_id=None, commit=True):
+    """
+    Добавляет ссылку на существующий блоб в каталог directory и увеличивает счетчик ссылок.
+    """
+    # Сначала увеличиваем счетчик, чтобы параллельное удаление не убрало блоб из-под нас
+    acquire_blob(digest, size)
+    try:
+        return add_link(digest, size, directory, filename, user_id, commit=commit)
+    except Exception:
+        abandon_blob(digest)
+        raise
+
+
+def ingest_file(tmp_path, digest, size, directory, filename, user_id=None, exact=False, commit=True):
+    """
+    Перемещает уже посчитанный временный файл в хранилище блобов (или удаляет его,
+    если такое содержимое уже есть) и создает ссылку в каталоге диалога.
+    С exact=True файл доступен только под именем filename (превью называются по оригиналу);
+    если под этим именем уже есть файл, новый не сохраняется.
+    С commit=False ссылка коммитится вместе с транзакцией вызывающего кода, при ошибке
+    транзакция откатывается целиком.
+    """
+    if exact and MediaRef.query.filter(MediaRef.path == directory, MediaRef.filename == filename,
+                                       MediaRef.blob_hash.isnot(None)).first():
+        os.remove(tmp_path)
+        return filename
+
+    # Ссылку захватываем до того, как временный файл будет удален как дубликат существующего блоба
+    acquire_blob(digest, size)
+    try:
+        get_storage().put_file(tmp_path, blob_path(digest))
+        return add_link(digest, size, directory, filename, user_id, exact, commit)
+    except FileExistsError:
+        abandon_blob(digest)
+        if exact:
+            # Параллельная загрузка того же превью успела раньше
+            return filename
+        raise
+    except Exception:
+        abandon_blob(digest)
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+
+def save_stream(stream, directory, filename, user_id=None, exact=False, commit=True):
+    """
+    Сохраняет загружаемый поток: считает хэш во время записи, дедуплицирует и
+    возвращает имя файла, под которым он доступен в каталоге directory.
+    """
+    tmp_path = os.path.join(staging_folder(), uuid.uuid4().hex)
+
+    try:
+        digest, size = write_stream(stream, tmp_path)
+    except Exception:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        raise
+
+    return ingest_file(tmp_path, digest, size, directory, filename, user_id, exact, commit)
+
+
+def link_existing(source_directory, filename, directory, user_id=None, target_filename=None, commit=True):
+    """
+    Делает файл из одного каталога доступным в другом без повторной загрузки: новая ссылка
+    на тот же блоб (хардлинк / серверное копирование). Возвращает имя в новом каталоге или None.
+    С commit=False ссылка коммитится вместе с транзакцией вызывающего кода.
+    """
+    target_filename = target_filename or filename
+    ref = MediaRef.query.filter_by(path=source_directory, filename=filename).first()
+    if ref and ref.blob_hash:
+        size = ref.size
+        if size is None:
+            size = db.session.execute(text('SELECT size FROM media_blob WHERE hash = :hash'), {'hash': ref.blob_hash}).scalar()
+        return link_blob(ref.blob_hash, size, directory, target_filename, user_id, commit)
+
+    # Файл загружен до появления хранилища блобов - заводим блоб по ходу копирования
+    file_path = lookup(source_directory, filename)
+    if not file_path:
+        return None
+    stream = get_storage().open(file_path)
+    try:
+        return save_stream(stream, directory, target_filename, user_id, commit=commit)
+    finally:
+        stream.close()
+
+
+def lookup(directory, filename):
+    """
+    Возвращает путь к файлу по старому имени: сначала сам файл в каталоге,
+    затем блоб из карты совместимости. None, если файла нет.
+    """
+    storage = get_storage()
+    for file_path in candidate_paths(directory, filename):
+        if storage.exists(file_path):
+            return file_path
+
+    ref = MediaRef.query.filter_by(path=directory, filename=filename).first()
+    if ref and ref.blob_hash:
+        path = blob_path(ref.blob_hash)
+        if storage.exists(path):
+            return path
+    return None
+
+
+def release(directory, filename):
+    """
+    Удаляет ссылку на файл и уменьшает счетчик ссылок блоба. Когда ссылок не остается,
+    файл блоба удаляется после коммита. Имя остается в карте как занятое. Коммит выполняет
+    вызывающий код.
+    Возвращает True, если файл существовал.
+    """
+    storage = get_storage()
+    ref = MediaRef.query.filter_by(path=directory, filename=filename).first()
+
+    if not ref or not ref.blob_hash:
+        # Файл загружен до появления хранилища блобов - размер для счетчиков берем из хранилища
+        stats = [storage.stat(path) for path in candidate_paths(directory, filename)]
+        legacy_size = sum(stat['size'] for stat in stats if stat)
+
+    existed = False
+    for file_path in candidate_paths(directory, filename):
+        existed = storage.delete(file_path) or existed
+
+    if not ref or not ref.blob_hash:
+        if existed:
+            record_usage(directory, None, -legacy_size, -1)
+            if not ref:
+                # Запоминаем имя как занятое
+                db.session.add(MediaRef(path=directory, filename=filename, blob_hash=None))
+        return existed
+
+    digest = ref.blob_hash
+    size = ref.size
+    if size is None:
+        size = db.session.execute(text('SELECT size FROM media_blob WHERE hash = :hash'), {'hash': digest}).scalar() or 0
+    record_usage(directory, ref.uploaded_by, -size, -1)
+
+    ref.blob_hash = None
+    db.session.flush()  # Ссылка должна отвязаться до удаления строки блоба (внешний ключ)
+    lock_blob(db.session, digest)
+    db.session.execute(text('UPDATE media_blob SET ref_count = ref_count - 1 WHERE hash = :hash'), {'hash': digest})
+    deleted = db.session.execute(
+        text('DELETE FROM media_blob WHERE hash = :hash AND ref_count <= 0 RETURNING hash'),
+        {'hash': digest}
+    ).scalar()
+
+    if deleted:
+        # Файл нужен, пока удаление строки не закоммичено: при откате ссылка остается живой
+        db.session.info.setdefault('released_blobs', []).append(digest)
+
+    return True
+
+
+def delete_unreferenced_blob(digest):
+    """
+    Удаляет файл блоба, если строки блоба нет. Под той же блокировкой, что и acquire_blob,
+    поэтому ссылка, захваченная после освобождения, файл сохраняет.
+    """
+    with db.engine.begin() as connection:
+        lock_blob(connection, digest)
+        exists = connection.execute(text('SELECT 1 FROM media_blob WHERE hash = :hash'), {'hash': digest}).scalar()
+        if not exists:
+            get_storage().delete(blob_path(digest))
+
+
+@event.listens_for(Session, 'after_commit')
+def delete_released_blobs(session):
+    session.info.pop('acquired_blobs', None)
+    session.info.pop('linked_files', None)
+    for digest in session.info.pop('released_blobs', []):
+        try:
+            delete_unreferenced_blob(digest)
+        except Exception as e:
+            current_app.logger.error(f"Блоб {digest} не удален: {e}")
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_released_blobs(session):
+    """
+    Откат: освобожденные блобы остаются живыми, а ссылки и файлы блобов, захваченные
+    в откаченной транзакции, убираются.
+    """
+    session.info.pop('released_blobs', None)
+    storage = get_storage()
+    for file_path in session.info.pop('linked_files', []):
+        try:
+            storage.delete(file_path)
+        except Exception as e:
+            current_app.logger.error(f"Ссылка {file_path} не удалена: {e}")
+    for digest in session.info.pop('acquired_blobs', []):
+        try:
+            delete_unreferenced_blob(digest)
+        except Exception as e:
+            current_app.logger.error(f"Блоб {digest} не удален: {e}")
+
+
+def list_files(directory):
+    """
+    Имена файлов каталога при любой раскладке: живые ссылки из карты совместимости
+    плюс файлы, которые еще лежат в плоском каталоге. Обход шардов не нужен.
+    """
+    names = set(get_storage().list(directory))
+    rows = db.session.execute(
+        text('SELECT filename FROM media_ref WHERE path = :path AND blob_hash IS NOT NULL'),
+        {'path': directory}
+    )
+    names.update(row.filename for row in rows)
+    return list(names)
+
+
+def iter_files(directory, batch_size):
+    """
+    Имена файлов каталога пачками по batch_size, не держа весь список в памяти: сначала живые
+    ссылки из карты совместимости по возрастанию имени, затем файлы из плоского каталога без ссылок.
+    """
+    after = ''
+    while True:
+        names = db.session.execute(text('''
+            SELECT filename FROM media_ref
+            WHERE path = :path AND blob_hash IS NOT NULL AND filename > :after
+            ORDER BY filename
+            LIMIT :limit
+        '''), {'path': directory, 'after': after, 'limit': batch_size}).scalars().all()
+        if names:
+            yield names
+        if len(names) < batch_size:
+            break
+        after = names[-1]
+
+    def without_refs(names):
+        linked = set(db.session.execute(text('''
+            SELECT filename FROM media_ref
+            WHERE path = :path AND blob_hash IS NOT NULL AND filename = ANY(:names)
+        '''), {'path': directory, 'names': names}).scalars())
+        return [name for name in names if name not in linked]
+
+    batch = []
+    for name in get_storage().iter_names(directory):
+        batch.append(name)
+        if len(batch) == batch_size:
+            yield without_refs(batch)
+            batch = []
+    if batch:
+        yield without_refs(batch)
+
+
+def migrate_file(directory, filename):
+    """
+    Переносит файл из плоского каталога в шардированный. Файлы, загруженные до появления
+    хранилища блобов, заодно попадают в него. Возвращает True, если файл перенесен.
+    """
+    storage = get_storage()
+    paths = candidate_paths(directory, filename)
+    if len(paths) == 1 or not storage.exists(paths[1]):
+        return False
+    target, legacy = paths
+
+    ref = MediaRef.query.filter_by(path=directory, filename=filename).first()
+    if ref and ref.blob_hash:
+        source = legacy
+    else:
+        tmp_path = os.path.join(staging_folder(), uuid.uuid4().hex)
+        stream = storage.open(legacy)
+        try:
+            digest, size = write_stream(stream, tmp_path)
+        finally:
+            stream.close()
+        acquire_blob(digest, size)
+        storage.put_file(tmp_path, blob_path(digest))
+        if ref:
+            ref.blob_hash = digest
+            ref.size = size
+        else:
+            db.session.add(MediaRef(path=directory, filename=filename, blob_hash=digest, size=size))
+        source = blob_path(digest)
+
+    try:
+        storage.link(source, target)
+    except FileExistsError:
+        pass  # Повторный запуск после сбоя - ссылка уже создана
+    db.session.commit()
+
+    # Старый путь убираем последним, чтобы чтение всегда находило файл
+    storage.delete(legacy)
+    return True
+
+
+def link_age(directory, filename, file_path):
+    """
+    Время появления файла под этим именем: из карты ссылок, для старых файлов - mtime в хранилище.
+    """
+    ref = MediaRef.query.filter_by(path=directory, filename=filename).first()
+    if ref and ref.blob_hash and ref.created_at:
+        return ref.created_at.timestamp()
+    stat = get_storage().stat(file_path)
+    return stat['mtime'] if stat else None
@@ -0,0 +1,146 @@
+"""
+Кэш последних сообщений чата для первой страницы истории (get_messages / get_group_messages без before).
+
+Запись recent_messages:<room> в Redis хранит RECENT_MESSAGES_CACHE_SIZE последних сообщений
+в хронологическом порядке и номер события чата seq (event_seq диалога / группы), которому она
+соответствует. Запись верна, только если ее seq равен текущему event_seq чата, поэтому любое
+изменение, прошедшее через outbox, делает ее устаревшей в той же транзакции. Relay после
+отправки событий применяет их к записи (new_message, message_edited, messages_deleted,
+messages_read, messages_all_deleted) и переносит ее на новый seq, так что горячий чат не теряет кэш.
+Все операции применения идемпотентны: повторная доставка события не портит запись.
+"""
+import json
+import time
+from flask import current_app
+
+APPLIED_EVENTS = {'new_message', 'message_edited', 'messages_deleted', 'messages_read', 'messages_all_deleted'}
+STATS_KEY = 'recent_messages:stats'
+
+
+def cache_key(room):
+    return f'recent_messages:{room}'
+
+
+def get_recent(redis_client, room, seq, size):
+    """
+    Последние size сообщений из кэша или None, если записи нет, она устарела или короче size.
+    """
+    entry = redis_client.get(cache_key(room))
+    if entry is None:
+        return None
+    entry = json.loads(entry)
+    if entry['seq'] != seq:
+        return None
+    messages = entry['messages']
+    if len(messages) < size and not entry['complete']:
+        return None
+    return messages[-size:] if size > 0 else []
+
+
+def store_recent(redis_client, room, seq, messages, complete):
+    """
+    Сохраняет последние сообщения (хронологический порядок). complete - в чате нет более старых сообщений.
+    """
+    config = current_app.config
+    cache_size = config['RECENT_MESSAGES_CACHE_SIZE']
+    entry = {'seq': seq, 'complete': complete and len(messages) <= cache_size, 'messages': messages[-cache_size:]}
+    redis_client.set(cache_key(room), json.dumps(entry), ex=config['RECENT_MESSAGES_TTL'])
+
+
+def apply_event(entry, event_name, payload):
+    messages = entry['messages']
+    if event_name == 'new_message':
+        message = {key: value for key, value in payload.items() if key != 'seq'}
+        if all(existing['id'] != message['id'] for existing in messages):
+            messages.append(message)
+            messages.sort(key=lambda existing: (existing['timestamp'], existing['id']))
+    elif event_name == 'message_edited':
+        for index, existing in enumerate(messages):
+            if existing['id'] == payload['id']:
+                messages[index] = {key: payload.get(key, value) for key, value in existing.items()}
+    elif event_name == 'messages_deleted':
+        deleted = set(payload['deleted_message_ids'])
+        entry['messages'] = [existing for existing in messages if existing['id'] not in deleted]
+    elif event_name == 'messages_read':
+        read = set(payload['messages_read_ids'])
+        for existing in messages:
+            if existing['id'] in read:
+                existing['is_read'] = True
+    elif event_name == 'messages_all_deleted':
+        entry['messages'] = []
+        entry['complete'] = True
+
+
+def apply_events(redis_client, events):
+    """
+    Применяет пачку отправленных relay событий [(room, seq, event, payload)] к кэшам чатов.
+    Событие применяется, только если запись отстает ровно на одно событие; иначе запись
+    оставляется как есть - она уже устарела и будет перечитана из БД при следующем запросе.
+    """
+    config = current_app.config
+    by_room = {}
+    for room, seq, event_name, payload in events:
+        by_room.setdefault(room, []).append((seq, event_name, payload))
+
+    keys = [cache_key(room) for room in by_room]
+    entries = redis_client.mget(keys)
+    pipe = redis_client.pipeline(transaction=False)
+    for (room, room_events), entry in zip(by_room.items(), entries):
+        if entry is None:
+            continue
+        entry = json.loads(entry)
+        applied = False
+        for seq, event_name, payload in sorted(room_events, key=lambda event: event[0]):
+            if seq != entry['seq'] + 1:
+                continue
+            if event_name in APPLIED_EVENTS:
+                apply_event(entry, event_name, payload)
+            entry['seq'] = seq
+            applied = True
+        if applied:
+            if len(entry['messages']) > config['RECENT_MESSAGES_CACHE_SIZE']:
+                # Старейшие сообщения вытеснены - запись больше не содержит всю историю
+                entry['messages'] = entry['messages'][-config['RECENT_MESSAGES_CACHE_SIZE']:]
+                entry['complete'] = False
+            pipe.set(cache_key(room), json.dumps(entry), ex=config['RECENT_MESSAGES_TTL'])
+    pipe.execute()
+
+
+class CacheMetrics:
+    """
+    Счетчики попаданий и задержки первой страницы в процессе, сбрасываются в Redis
+    (hash recent_messages:stats) не чаще раза в RECENT_MESSAGES_STATS_INTERVAL секунд.
+    """
+    def __init__(self):
+        self.reset()
+
+    def reset(self):
+        self.counters = {'hits': 0, 'misses': 0, 'hit_us': 0, 'miss_us': 0}
+        self.flushed_at = time.monotonic()
+
+    def record(self, redis_client, hit, elapsed):
+        kind = 'hit' if hit else 'miss'
+        self.counters[f'{kind}s'] += 1
+        self.counters[f'{kind}_us'] += int(elapsed * 1_000_000)
+        if time.monotonic() - self.flushed_at >= current_app.config['RECENT_MESSAGES_STATS_INTERVAL']:
+            counters = self.counters
+            self.reset()
+            pipe = redis_client.pipeline(transaction=False)
+            for field, value in counters.items():
+                pipe.hincrby(STATS_KEY, field, value)
+            pipe.execute()
+
+
+metrics = CacheMetrics()
+
+
+def read_stats(redis_client):
+    stats = {key.decode(): int(value) for key, value in redis_client.hgetall(STATS_KEY).items()}
+    hits, misses = stats.get('hits', 0), stats.get('misses', 0)
+    return {
+        'hits': hits,
+        'misses': misses,
+        'hit_ratio': round(hits / (hits + misses), 4) if hits + misses else None,
+        'avg_hit_ms': round(stats.get('hit_us', 0) / hits / 1000, 3) if hits else None,
+        'avg_miss_ms': round(stats.get('miss_us', 0) / misses / 1000, 3) if misses else None
+    }
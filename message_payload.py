@@ -0,0 +1,110 @@
+"""
+Общая проекция и сериализация сообщений чатов (messages_dialog_<id> / messages_group_<id>).
+
+Запросы выбирают только нужные эндпоинту колонки (select_columns с набором полей эндпоинта:
+MESSAGE_FIELDS, SEARCH_FIELDS, REFERENCE_FIELDS, INSERTED_FIELDS), а время сообщения
+переводится в миллисекунды эпохи прямо в SQL, поэтому строка результата уже готова к отдаче
+клиенту и превращается в словарь одним zip без поштучной обработки полей в Python.
+Для длинных страниц есть колоночный формат (?format=columnar): массивы значений по полям
+вместо словаря на каждое сообщение. С ?include_references=1 страница истории дополняется
+картой сообщений, на которые отвечают ее сообщения (fetch_references).
+"""
+from sqlalchemy import text
+from models import db
+
+# Полный набор полей сообщения: страницы истории, сообщение по id, события new_message и message_edited
+MESSAGE_FIELDS = (
+    'id', 'id_sender', 'text', 'images', 'voice', 'file', 'code', 'code_language',
+    'is_edited', 'is_read', 'is_forwarded', 'is_url', 'reference_to_message_id',
+    'username_author_original', 'waveform', 'timestamp'
+)
+
+# Поиск отдает все текстовые сообщения чата: клиенту нужен текст и переход к сообщению по id
+SEARCH_FIELDS = ('id', 'id_sender', 'text', 'is_url', 'is_forwarded', 'username_author_original', 'timestamp')
+
+# Цитата в ответе: автор и содержимое без флагов и волны голосового
+REFERENCE_FIELDS = (
+    'id', 'id_sender', 'text', 'images', 'voice', 'file', 'code', 'code_language',
+    'username_author_original', 'timestamp'
+)
+
+# Колонки, которые при отправке заполняет база; остальное сервер только что записал сам
+INSERTED_FIELDS = ('id', 'timestamp')
+
+TIMESTAMP_MS = 'FLOOR(EXTRACT(EPOCH FROM {prefix}timestamp) * 1000)::bigint AS timestamp'
+
+
+def select_columns(fields, prefix=''):
+    """
+    Список колонок для SELECT / RETURNING. prefix - алиас таблицы с точкой ('m.').
+    """
+    return ', '.join(
+        TIMESTAMP_MS.format(prefix=prefix) if field == 'timestamp' else f'{prefix}{field}'
+        for field in fields
+    )
+
+
+def serialize(rows, fields):
+    """
+    Строки результата запроса с select_columns(fields) -> список словарей сообщений.
+    """
+    return [dict(zip(fields, row)) for row in rows]
+
+
+def serialize_row(row, fields):
+    return dict(zip(fields, row))
+
+
+def inserted_message(row, values):
+    """
+    Полное сообщение после INSERT ... RETURNING select_columns(INSERTED_FIELDS):
+    колонки из базы плюс вставленные значения values (ключи - имена колонок).
+    """
+    generated = serialize_row(row, INSERTED_FIELDS)
+    return {field: generated[field] if field in generated else values.get(field) for field in MESSAGE_FIELDS}
+
+
+def to_columnar(messages, fields):
+    """
+    Список словарей сообщений -> {'count': n, 'fields': [...], 'columns': {поле: [значения]}}.
+    """
+    return {
+        'count': len(messages),
+        'fields': list(fields),
+        'columns': {field: [message[field] for message in messages] for field in fields}
+    }
+
+
+def wants_columnar(args):
+    return args.get('format') == 'columnar'
+
+
+def wants_references(args):
+    return args.get('include_references', '').lower() in ('1', 'true')
+
+
+def fetch_references(table_name, messages):
+    """
+    Сообщения чата, на которые отвечают сообщения страницы, одним запросом: {str(id): сообщение}.
+    Сообщения, которые уже есть на странице, не повторяются; удаленных в карте нет.
+    """
+    on_page = {message['id'] for message in messages}
+    ids = {message['reference_to_message_id'] for message in messages} - on_page - {None}
+    if not ids:
+        return {}
+    query = text(f'SELECT {select_columns(REFERENCE_FIELDS)} FROM {table_name} WHERE id = ANY(:ids)')
+    rows = db.session.execute(query, {'ids': list(ids)})
+    return {str(message['id']): message for message in serialize(rows, REFERENCE_FIELDS)}
+
+
+def render(messages, args, fields, references=None):
+    """
+    Тело ответа со списком сообщений в формате, запрошенном параметром format.
+    С references список оборачивается в {'messages': [...], 'references': {...}}.
+    """
+    body = to_columnar(messages, fields) if wants_columnar(args) else messages
+    if references is None:
+        return body
+    if isinstance(body, list):
+        body = {'messages': body}
+    return {**body, 'references': references}
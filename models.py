@@ -6,46 +6,72 @@ from datetime import datetime
 db = SQLAlchemy()
 
 
-def increment_message_count(dialog_id=None, group_id=None):
-    if dialog_id:
-        dialog = Dialog.query.get(dialog_id)
-        if dialog:
-            dialog.count_msg += 1
-            db.session.commit()
-
-    if group_id:
-        group = Group.query.get(group_id)
-        if group:
-            group.count_msg += 1
-            db.session.commit()
-
-
 def decrement_message_count(dialog_id=None, group_id=None, count=1):
+    # Атомарно и без коммита: счетчик меняется в транзакции удаления сообщений
     if dialog_id:
-        dialog = Dialog.query.get(dialog_id)
-        if dialog and dialog.count_msg > 0:
-            dialog.count_msg -= count
-            db.session.commit()
+        db.session.execute(text('UPDATE dialog SET count_msg = GREATEST(count_msg - :count, 0) WHERE id = :id'),
+                           {'count': count, 'id': dialog_id})
 
     if group_id:
-        group = Group.query.get(group_id)
-        if group and group.count_msg > 0:
-            group.count_msg -= count
-            db.session.commit()
+        db.session.execute(text('UPDATE "group" SET count_msg = GREATEST(count_msg - :count, 0) WHERE id = :id'),
+                           {'count': count, 'id': group_id})
 
 
 def do_zero_message_count(dialog_id=None, group_id=None):
+    # Без коммита: счетчик обнуляется в транзакции удаления всех сообщений
     if dialog_id:
-        dialog = Dialog.query.get(dialog_id)
-        if dialog and dialog.count_msg > 0:
-            dialog.count_msg = 0
-            db.session.commit()
+        db.session.execute(text('UPDATE dialog SET count_msg = 0 WHERE id = :id'), {'id': dialog_id})
 
     if group_id:
-        group = Group.query.get(group_id)
-        if group and group.count_msg > 0:
-            group.count_msg = 0
-            db.session.commit()
+        db.session.execute(text('UPDATE "group" SET count_msg = 0 WHERE id = :id'), {'id': group_id})
+
+
+def upgrade_schema():
+    """
+    Добавляет колонки, появившиеся в уже существующих таблицах (db.create_all создает только новые таблицы).
+    """
+    columns = [
+        ('media_ref', 'size', 'BIGINT'),
+        ('media_ref', 'uploaded_by', 'INTEGER'),
+        ('media_ref', 'created_at', 'TIMESTAMP DEFAULT NOW()'),
+        ('dialog', 'event_seq', 'BIGINT NOT NULL DEFAULT 0'),
+        ('"group"', 'event_seq', 'BIGINT NOT NULL DEFAULT 0'),
+        ('dialog', 'last_activity', 'TIMESTAMPTZ'),
+        ('"group"', 'last_activity', 'TIMESTAMPTZ'),
+    ]
+    for table, column, column_type in columns:
+        db.session.execute(text(f'ALTER TABLE {table} ADD COLUMN IF NOT EXISTS {column} {column_type}'))
+    db.session.commit()
+
+    backfill_last_activity()
+
+    indexes = [
+        # Список чатов с пагинацией по последней активности (GET /conversations?limit=)
+        'CREATE INDEX IF NOT EXISTS ix_dialog_user1_activity ON dialog (id_user1, last_activity DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS ix_dialog_user2_activity ON dialog (id_user2, last_activity DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS ix_group_activity ON "group" (last_activity DESC, id DESC)',
+        'CREATE INDEX IF NOT EXISTS ix_group_member_user ON group_member (user_id, group_id)',
+    ]
+    for index in indexes:
+        db.session.execute(text(index))
+    db.session.commit()
+
+
+def backfill_last_activity():
+    """
+    Заполняет last_activity существующих чатов временем последнего сообщения (один раз после добавления колонки).
+    """
+    for table, prefix in (('dialog', 'messages_dialog'), ('"group"', 'messages_group')):
+        conv_ids = db.session.execute(text(f'SELECT id FROM {table} WHERE last_activity IS NULL')).scalars().all()
+        for conv_id in conv_ids:
+            if db.session.execute(text('SELECT to_regclass(:name)'), {'name': f'{prefix}_{conv_id}'}).scalar():
+                last_message = f'(SELECT MAX(timestamp) FROM {prefix}_{conv_id})'
+            else:
+                last_message = 'NULL'
+            db.session.execute(text(f'UPDATE {table} SET last_activity = COALESCE({last_message}, NOW()) WHERE id = :id'),
+                               {'id': conv_id})
+        db.session.execute(text(f'ALTER TABLE {table} ALTER COLUMN last_activity SET DEFAULT NOW()'))
+        db.session.commit()
 
 
 def create_message_table(conv_id, is_group=False):
@@ -173,21 +199,17 @@ def add_unread_message_for_all_members(group_id, message_id, sender_id):
 def delete_unread_status_for_messages(group_id, message_ids):
     """
     Удаляет записи о непрочитанных сообщениях для указанных ID сообщений.
+    Коммит выполняет вызывающий код вместе с удалением сообщений.
     """
-    try:
-        status_table_name = f"message_read_status_group_{group_id}"
-        
-        # Формируем SQL-запрос для удаления записей
-        query = text(f"""
-            DELETE FROM {status_table_name}
-            WHERE message_id IN :message_ids;
-        """)
-        
-        db.session.execute(query, {'message_ids': tuple(message_ids)})
-        db.session.commit()
-    except Exception as e:
-        print(f"Ошибка при удалении записей о непрочитанных сообщениях: {e}")
-        db.session.rollback()
+    status_table_name = f"message_read_status_group_{group_id}"
+
+    # Формируем SQL-запрос для удаления записей
+    query = text(f"""
+        DELETE FROM {status_table_name}
+        WHERE message_id IN :message_ids;
+    """)
+
+    db.session.execute(query, {'message_ids': tuple(message_ids)})
 
 
 class User(db.Model):
@@ -215,6 +237,8 @@ class Dialog(db.Model):
     count_msg = db.Column(db.Integer, default=0)
     can_delete = db.Column(db.Boolean, default=False)
     auto_delete_interval = db.Column(db.Integer, default=0)
+    event_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')  # номер последнего события чата
+    last_activity = db.Column(db.DateTime(timezone=True), server_default=func.now())  # время последнего сообщения
 
     __table_args__ = (db.UniqueConstraint('id_user1', 'id_user2', name='unique_dialog_users'),)
 
@@ -227,6 +251,8 @@ class Group(db.Model):
     count_msg = db.Column(db.Integer, default=0)
     can_delete = db.Column(db.Boolean, default=False)
     auto_delete_interval = db.Column(db.Integer, default=0)
+    event_seq = db.Column(db.BigInteger, nullable=False, default=0, server_default='0')  # номер последнего события чата
+    last_activity = db.Column(db.DateTime(timezone=True), server_default=func.now())  # время последнего сообщения
 
 
 class GroupMember(db.Model):
@@ -263,6 +289,83 @@ class GitlabSubs(db.Model):
     user = db.relationship("User", backref="gitlab_subs")
 
 
+class MediaBlob(db.Model):
+    hash = db.Column(db.String(64), primary_key=True)  # sha256 содержимого
+    size = db.Column(db.BigInteger, nullable=False)
+    ref_count = db.Column(db.Integer, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, server_default=func.now())
+
+
+class MediaRef(db.Model):
+    # Карта совместимости: старый путь (каталог + имя файла) -> блоб.
+    # После удаления файла строка остается с blob_hash = NULL, чтобы имя не заняли другим содержимым
+    id = db.Column(db.Integer, primary_key=True)
+    path = db.Column(db.String(512), nullable=False)
+    filename = db.Column(db.String(256), nullable=False)
+    blob_hash = db.Column(db.String(64), db.ForeignKey('media_blob.hash'), nullable=True)
+    size = db.Column(db.BigInteger, nullable=True)
+    uploaded_by = db.Column(db.Integer, nullable=True)
+    created_at = db.Column(db.DateTime, server_default=func.now())  # mtime у хардлинка общий с блобом, возраст ссылки берем отсюда
+
+    __table_args__ = (db.UniqueConstraint('path', 'filename', name='unique_media_ref'),)
+
+
+class StorageUsage(db.Model):
+    # Счетчики занятого места: scope - dialog / group / user, media_type - photos / audio / files / avatars / news
+    id = db.Column(db.Integer, primary_key=True)
+    scope = db.Column(db.String(16), nullable=False)
+    scope_id = db.Column(db.Integer, nullable=False)
+    media_type = db.Column(db.String(16), nullable=False)
+    bytes = db.Column(db.BigInteger, nullable=False, default=0)
+    files = db.Column(db.Integer, nullable=False, default=0)
+    updated_at = db.Column(db.DateTime, server_default=func.now())
+
+    __table_args__ = (db.UniqueConstraint('scope', 'scope_id', 'media_type', name='unique_storage_usage'),)
+
+
+class UploadSession(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id'), nullable=False)
+    dialog_id = db.Column(db.Integer, nullable=False)
+    is_group = db.Column(db.Boolean, default=False, nullable=False)
+    folder = db.Column(db.String(16), nullable=False)  # PHOTOS / AUDIO / FILES
+    filename = db.Column(db.String(256), nullable=False)
+    size = db.Column(db.BigInteger, nullable=False)
+    checksum = db.Column(db.String(64), nullable=False)  # sha256 от клиента
+    received = db.Column(db.BigInteger, nullable=False, default=0)
+    created_at = db.Column(db.DateTime, server_default=func.now())
+    expires_at = db.Column(db.DateTime(timezone=True), nullable=False)
+
+
+class OutboxEvent(db.Model):
+    # События, которые уходят клиентам после коммита (см. outbox.py)
+    id = db.Column(db.BigInteger, primary_key=True)
+    kind = db.Column(db.String(16), nullable=False)  # socket / push
+    event = db.Column(db.String(64), nullable=False)
+    room = db.Column(db.String(64), nullable=True)
+    payload = db.Column(db.JSON, nullable=False)
+    created_at = db.Column(db.DateTime, server_default=func.now())
+
+
+class ConversationChange(db.Model):
+    # Лента изменений чатов для GET /sync (см. sync_log.py). user_id задан у записей,
+    # адресованных одному пользователю (удаление чата, исключение из группы)
+    id = db.Column(db.BigInteger, primary_key=True)
+    txid = db.Column(db.BigInteger, nullable=False, server_default=text('(pg_current_xact_id()::text::bigint)'))
+    scope = db.Column(db.String(16), nullable=False)  # dialog / group
+    conv_id = db.Column(db.Integer, nullable=False)
+    user_id = db.Column(db.Integer, nullable=True)
+    kind = db.Column(db.String(16), nullable=False)  # new / edited / deleted / read / all_deleted / metadata / removed
+    message_ids = db.Column(db.ARRAY(db.BigInteger), nullable=True)
+    created_at = db.Column(db.DateTime, server_default=func.now())
+
+    __table_args__ = (
+        db.Index('ix_conversation_change_conv', 'scope', 'conv_id', 'txid', 'id'),
+        db.Index('ix_conversation_change_user', 'user_id', 'txid', 'id'),
+        db.Index('ix_conversation_change_created_at', 'created_at'),
+    )
+
+
 class Log(db.Model):
     id = db.Column(db.Integer, primary_key=True)
     id_user = db.Column(db.Integer, nullable=False)
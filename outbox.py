@@ -0,0 +1,168 @@
+"""
+Transactional outbox для событий Socket.IO и push-уведомлений.
+
+Обработчики пишут событие в таблицу outbox_event в той же транзакции, что и изменение данных
+(outbox.emit / outbox.push_wakeup), а отдельный процесс (python outbox.py) после коммита
+пачками переносит события в очередь Socket.IO в Redis и в FCM. Доставка - at-least-once:
+событие удаляется из таблицы только после отправки.
+"""
+import time
+import select
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import text, event
+from sqlalchemy.orm import Session
+from models import db, OutboxEvent
+import event_log
+import sync_log
+import message_cache
+
+NOTIFY_CHANNEL = 'outbox_event'
+
+
+def emit(event_name, payload, room=None):
+    """
+    Событие Socket.IO для комнаты room. Уйдет клиентам после коммита транзакции вызывающего кода.
+    События комнат чатов получают номер seq для досылки после переподключения (см. event_log)
+    и попадают в ленту изменений GET /sync (см. sync_log).
+    """
+    seq = event_log.next_seq(room)
+    if seq is not None:
+        payload = {**payload, 'seq': seq}
+        sync_log.record_event(room, event_name, payload)
+    db.session.add(OutboxEvent(kind='socket', event=event_name, room=room, payload=payload))
+    db.session.info['outbox_pending'] = True
+
+
+def push_wakeup(fcm_token):
+    """
+    Push-уведомление FCM для пробуждения клиента. Уйдет после коммита.
+    """
+    if not fcm_token:
+        return
+    db.session.add(OutboxEvent(kind='push', event='wakeup', payload={'fcm_token': fcm_token}))
+    db.session.info['outbox_pending'] = True
+
+
+@event.listens_for(Session, 'before_commit')
+def notify_relay(session):
+    # NOTIFY доставляется только при коммите - relay просыпается сразу, не дожидаясь опроса
+    if session.info.pop('outbox_pending', False):
+        session.execute(text(f"SELECT pg_notify('{NOTIFY_CHANNEL}', '')"))
+
+
+@event.listens_for(Session, 'after_rollback')
+def forget_pending(session):
+    session.info.pop('outbox_pending', None)
+
+
+class RelayMetrics:
+    def __init__(self):
+        self.started = time.monotonic()
+        self.relayed = {'socket': 0, 'push': 0}
+        self.batches = 0
+        self.max_lag = 0.0
+
+    def record(self, rows):
+        self.batches += 1
+        now = time.time()
+        for row in rows:
+            self.relayed[row['kind']] = self.relayed.get(row['kind'], 0) + 1
+            self.max_lag = max(self.max_lag, now - row['created_at'].timestamp())
+
+    def report(self, logger, backlog):
+        elapsed = time.monotonic() - self.started
+        total = sum(self.relayed.values())
+        logger.info(
+            f"Outbox: {total} событий за {elapsed:.0f} с ({total / elapsed:.1f}/с), "
+            f"socket {self.relayed['socket']}, push {self.relayed['push']}, пачек {self.batches}, "
+            f"макс. задержка {self.max_lag * 1000:.0f} мс, в очереди {backlog}"
+        )
+        self.__init__()
+
+
+def relay_batch(socketio, redis_client, push_pool, send_push_wakeup, batch_size):
+    """
+    Переносит одну пачку событий. SKIP LOCKED позволяет запускать несколько relay параллельно
+    (порядок событий тогда гарантируется только внутри одного процесса).
+    """
+    rows = db.session.execute(text('''
+        SELECT id, kind, event, room, payload, created_at
+        FROM outbox_event
+        ORDER BY id
+        LIMIT :limit
+        FOR UPDATE SKIP LOCKED
+    '''), {'limit': batch_size}).mappings().all()
+    if not rows:
+        db.session.commit()
+        return rows
+
+    # Сначала журнал досылки: клиент, получивший событие, может сразу просить resume от его seq
+    journal = [(row['room'], row['payload']['seq'], row['event'], row['payload'])
+               for row in rows if row['kind'] == 'socket' and 'seq' in row['payload']]
+    if journal:
+        event_log.append_events(redis_client, journal)
+
+    pushes = []
+    for row in rows:
+        if row['kind'] == 'socket':
+            socketio.emit(row['event'], row['payload'], room=row['room'])
+        elif row['kind'] == 'push':
+            pushes.append(push_pool.submit(send_push_wakeup, row['payload']['fcm_token']))
+    for push in pushes:
+        push.result()
+
+    # Переносим кэши последних сообщений на новые seq, чтобы горячие чаты не читались из БД заново
+    if journal:
+        message_cache.apply_events(redis_client, journal)
+
+    # Удаляем только после отправки: при падении между ними события уйдут повторно
+    db.session.execute(text('DELETE FROM outbox_event WHERE id = ANY(:ids)'), {'ids': [row['id'] for row in rows]})
+    db.session.commit()
+    return rows
+
+
+def run_relay():
+    from app import app, socketio, redis_client, logger
+    from fcm import send_push_wakeup
+
+    with app.app_context():
+        config = app.config
+        batch_size = config['OUTBOX_BATCH_SIZE']
+        poll_interval = config['OUTBOX_POLL_INTERVAL']
+        metrics_interval = config['OUTBOX_METRICS_INTERVAL']
+
+        listener = db.engine.raw_connection().dbapi_connection
+        listener.set_isolation_level(0)  # autocommit, иначе LISTEN не получает уведомлений
+        listener.cursor().execute(f'LISTEN {NOTIFY_CHANNEL}')
+
+        push_pool = ThreadPoolExecutor(max_workers=config['OUTBOX_PUSH_WORKERS'])
+        metrics = RelayMetrics()
+        last_report = time.monotonic()
+        logger.info('Outbox relay запущен')
+
+        while True:
+            try:
+                rows = relay_batch(socketio, redis_client, push_pool, send_push_wakeup, batch_size)
+                if rows:
+                    metrics.record(rows)
+            except Exception as e:
+                db.session.rollback()
+                logger.error(f'Outbox: ошибка доставки, повтор через {poll_interval} с: {e}')
+                time.sleep(poll_interval)
+                continue
+
+            if time.monotonic() - last_report >= metrics_interval:
+                backlog = db.session.execute(text('SELECT COUNT(*) FROM outbox_event')).scalar()
+                db.session.commit()
+                metrics.report(logger, backlog)
+                last_report = time.monotonic()
+
+            # Пачка была полной - сразу берем следующую, иначе ждем NOTIFY или таймаут опроса
+            if len(rows) < batch_size:
+                select.select([listener], [], [], poll_interval)
+                listener.poll()
+                listener.notifies.clear()
+
+
+if __name__ == '__main__':
+    run_relay()
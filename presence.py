@@ -0,0 +1,126 @@
+"""
+Время последней активности пользователей (User.last_session) с отложенной записью.
+
+Heartbeat (PUT /update_last_session) не пишет в PostgreSQL, а кладет время в hash Redis
+last_session:pending. Задача flush_last_sessions раз в LAST_SESSION_FLUSH_INTERVAL секунд
+переименовывает hash в last_session:flushing и записывает все отметки пачками одним UPDATE
+на пачку, не уменьшая уже записанное время. Чтение (pending_sessions) накладывает еще не
+записанные отметки на значения из БД.
+
+Событие user_session_updated уходит только в персональные комнаты собеседников
+по диалогам и участников общих групп, и не чаще раза в PRESENCE_BROADCAST_INTERVAL секунд
+на пользователя: первый heartbeat после перерыва (переход в онлайн) рассылается всегда.
+"""
+import redis
+from flask import current_app
+from sqlalchemy import text
+from models import db
+
+PENDING_KEY = 'last_session:pending'
+FLUSHING_KEY = 'last_session:flushing'
+FLUSH_SCHEDULED_KEY = 'last_session:flush_scheduled'
+FLUSH_LOCK_KEY = 'last_session:flush_lock'
+
+
+def broadcast_key(user_id):
+    return f'presence:broadcast:{user_id}'
+
+
+def record_heartbeat(redis_client, user_id, now_ms):
+    """
+    Запоминает heartbeat. Возвращает (рассылать ли событие, запланировать ли запись в БД).
+    """
+    config = current_app.config
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hset(PENDING_KEY, user_id, now_ms)
+    pipe.set(broadcast_key(user_id), 1, nx=True, ex=config['PRESENCE_BROADCAST_INTERVAL'])
+    pipe.set(FLUSH_SCHEDULED_KEY, 1, nx=True, ex=config['LAST_SESSION_FLUSH_INTERVAL'])
+    _, broadcast, schedule_flush = pipe.execute()
+    return bool(broadcast), bool(schedule_flush)
+
+
+def contact_rooms(user_id):
+    """
+    Персональные комнаты пользователя, его собеседников и участников его групп.
+    """
+    contacts = db.session.execute(text('''
+        SELECT CASE WHEN id_user1 = :user_id THEN id_user2 ELSE id_user1 END
+        FROM dialog WHERE id_user1 = :user_id OR id_user2 = :user_id
+        UNION
+        SELECT other.user_id FROM group_member own
+        JOIN group_member other ON other.group_id = own.group_id
+        WHERE own.user_id = :user_id
+    '''), {'user_id': user_id}).scalars().all()
+    return [f'user_{contact}' for contact in {user_id, *contacts}]
+
+
+def pending_sessions(redis_client, user_ids):
+    """
+    Еще не записанные в БД отметки: {user_id: время в мс}.
+    """
+    if not user_ids:
+        return {}
+    pipe = redis_client.pipeline(transaction=False)
+    pipe.hmget(PENDING_KEY, user_ids)
+    pipe.hmget(FLUSHING_KEY, user_ids)
+    pending, flushing = pipe.execute()
+    result = {}
+    for user_id, *values in zip(user_ids, pending, flushing):
+        values = [int(value) for value in values if value is not None]
+        if values:
+            result[user_id] = max(values)
+    return result
+
+
+def last_session_ms(db_value, pending_ms):
+    db_ms = int(db_value.timestamp() * 1000) if db_value else None
+    if pending_ms is None:
+        return db_ms
+    return max(db_ms or 0, pending_ms)
+
+
+def flush(redis_client):
+    """
+    Записывает накопленные отметки в User.last_session. Возвращает число пользователей.
+    Если предыдущая запись оборвалась, сначала дописывается ее hash last_session:flushing.
+    Одновременно работает только одна запись (блокировка в Redis): иначе одна могла бы удалить
+    last_session:flushing, в который другая уже переименовала новые отметки.
+    """
+    config = current_app.config
+    lock = redis_client.lock(FLUSH_LOCK_KEY, timeout=config['LAST_SESSION_FLUSH_LOCK_TIMEOUT'], blocking=False)
+    if not lock.acquire():
+        return 0
+    try:
+        if not redis_client.exists(FLUSHING_KEY):
+            try:
+                redis_client.rename(PENDING_KEY, FLUSHING_KEY)
+            except redis.ResponseError:  # Новых отметок нет
+                return 0
+
+        pending = redis_client.hgetall(FLUSHING_KEY)
+        user_ids = [int(user_id) for user_id in pending]
+        timestamps = [int(value) for value in pending.values()]
+        batch_size = config['LAST_SESSION_FLUSH_BATCH']
+        # Колонка без часового пояса хранит время UTC, как и прежняя запись datetime.now(timezone.utc)
+        query = text('''
+            UPDATE public.user u SET last_session = to_timestamp(v.ms / 1000.0) AT TIME ZONE 'UTC'
+            FROM unnest(CAST(:user_ids AS INTEGER[]), CAST(:timestamps AS BIGINT[])) AS v(id, ms)
+            WHERE u.id = v.id
+              AND (u.last_session IS NULL OR u.last_session < to_timestamp(v.ms / 1000.0) AT TIME ZONE 'UTC')
+        ''')
+        for start in range(0, len(user_ids), batch_size):
+            db.session.execute(query, {
+                'user_ids': user_ids[start:start + batch_size],
+                'timestamps': timestamps[start:start + batch_size]
+            })
+            db.session.commit()
+            # Долгая запись не должна пережить блокировку
+            lock.reacquire()
+
+        redis_client.delete(FLUSHING_KEY)
+        return len(user_ids)
+    finally:
+        try:
+            lock.release()
+        except redis.exceptions.LockError:  # Блокировка истекла - ее уже может держать другая запись
+            pass
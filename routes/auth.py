@@ -2,12 +2,17 @@ from flask import Blueprint, request, jsonify
 from flask_jwt_extended import create_access_token, create_refresh_token, jwt_required, get_jwt_identity, decode_token
 from flask_socketio import emit, join_room, disconnect
 from werkzeug.security import generate_password_hash, check_password_hash
-from models import db, User, Log
+from models import db, User
 from .uploads import delete_avatar_file_if_exists
 from .keys import encrypt_symmetric_key_for_user
-from datetime import datetime, timezone, timedelta
-from app import socketio, logger
+from datetime import timedelta
+from app import socketio, redis_client, logger, dramatiq, app
+import conversation_version
+import audit
+import presence
 from jwt.exceptions import ExpiredSignatureError
+import hashlib
+import time
 
 auth_bp = Blueprint('auth', __name__)
 
@@ -78,6 +83,7 @@ def update_profile():
                 delete_avatar_file_if_exists(user.avatar)
             user.avatar = avatar
             logger.info(f"User {user.name} updated his avatar: {avatar}")
+        conversation_version.mark_profile(db.session, user_id)
         db.session.commit()
         return jsonify({'message': 'Profile updated successfully'}), 200
     except Exception as e:
@@ -91,9 +97,7 @@ def update_password():
         user_id = get_jwt_identity()
         user = User.query.get(user_id)
         if not user:
-            log = Log(id_user=user_id, action="update_password", content="Failed to change password(User not found)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, action="update_password", content="Failed to change password(User not found)", is_successful=False)
             return jsonify({"error": "User not found"}), 404
 
         data = request.get_json()
@@ -101,27 +105,20 @@ def update_password():
         new_password = data.get('new_password')
 
         if not check_password_hash(user.password, old_password):
-            log = Log(id_user=user_id, action="update_password", content="Failed to change password(Incorrect password)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, action="update_password", content="Failed to change password(Incorrect password)", is_successful=False)
             return jsonify({"error": "Incorrect password"}), 400
 
         if not new_password:
-            log = Log(id_user=user_id, action="update_password", content="Failed to change password(No new password provided)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, action="update_password", content="Failed to change password(No new password provided)", is_successful=False)
             return jsonify({"error": "No new password provided"}), 400
 
         user.password = generate_password_hash(new_password, method='pbkdf2:sha256')
-        log = Log(id_user=user_id, action="update_password", content="Password successfully updated")
-        db.session.add(log)
+        audit.log_after_commit(id_user=user_id, action="update_password", content="Password successfully updated")
         db.session.commit()
         return jsonify({"message": "Password updated successfully"}), 200
     except Exception as e:
         db.session.rollback()
-        log = Log(id_user=user_id, action="update_password", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, action="update_password", content=str(e)[:200], is_successful=False)
         return jsonify({"error": str(e)}), 500
 
 
@@ -130,24 +127,36 @@ def update_password():
 def update_last_session():
     user_id = get_jwt_identity()
     try:
-        user = User.query.get(user_id)
-        if not user:
+        # Проверка существования без загрузки строки: токен может пережить удаленного пользователя
+        if db.session.query(User.id).filter_by(id=user_id).scalar() is None:
             return jsonify({"error": "User not found"}), 404
 
-        user.last_session = datetime.now(timezone.utc)
-        db.session.commit()
+        # Отметка копится в Redis и пишется в БД пачкой задачей flush_last_sessions (см. presence)
+        last_session = int(time.time() * 1000)
+        broadcast, schedule_flush = presence.record_heartbeat(redis_client, user_id, last_session)
+        if schedule_flush:
+            flush_last_sessions.send_with_options(delay=app.config['LAST_SESSION_FLUSH_INTERVAL'] * 1000)
 
-        # Уведомление через WebSocket
-        socketio.emit('user_session_updated', {
-            'user_id': user_id,
-            'last_session': int(user.last_session.timestamp() * 1000)
-        }, room=None) # Отправка сообщения глобально
+        # Уведомление через WebSocket только собеседникам и участникам общих групп
+        if broadcast:
+            rooms = presence.contact_rooms(user_id)
+            socketio.emit('user_session_updated', {
+                'user_id': user_id,
+                'last_session': last_session
+            }, to=rooms)
 
         return jsonify({"message": "Last session time updated successfully"}), 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+@dramatiq.actor
+def flush_last_sessions():
+    with app.app_context():
+        flushed = presence.flush(redis_client)
+        logger.info(f"Время последней активности записано для {flushed} пользователей")
+
+
 @auth_bp.route('/last_session/<int:user_id>', methods=['GET'])
 @jwt_required()
 def get_last_session(user_id):
@@ -157,7 +166,8 @@ def get_last_session(user_id):
         if not user:
             return jsonify({"error": "User not found"}), 404
 
-        last_session = int(user.last_session.timestamp() * 1000)
+        pending = presence.pending_sessions(redis_client, [user_id]).get(user_id)
+        last_session = presence.last_session_ms(user.last_session, pending)
 
         return jsonify({"last_session": last_session}), 200
     except Exception as e:
@@ -200,12 +210,118 @@ def get_user_key(name):
         if not user:
             return jsonify({'error': 'User not found'}), 404
         
-        return jsonify({'public_key': user.public_key}), 200
+        return cached_keys_response({'public_key': user.public_key})
     except Exception as e:
         logger.error(f"Необработанная ошибка: {e}")
         return jsonify({'error': str(e)}), 500
 
 
+def parse_batch(value, as_int=True):
+    """
+    'a,b,c' -> список без повторов в исходном порядке. ValueError для пустого, слишком длинного
+    (больше USER_BATCH_MAX) или некорректного списка.
+    """
+    items = [item.strip() for item in (value or '').split(',') if item.strip()]
+    if as_int:
+        items = [int(item) for item in items]
+    items = list(dict.fromkeys(items))
+    if not items or len(items) > app.config['USER_BATCH_MAX']:
+        raise ValueError(f"From 1 to {app.config['USER_BATCH_MAX']} items are required")
+    return items
+
+
+def cached_keys_response(body):
+    """
+    Ответ с публичными ключами: ETag по содержимому и Cache-Control на USER_KEYS_MAX_AGE.
+    После истечения клиент перепроверяет ключи запросом с If-None-Match и получает 304 без тела.
+    """
+    etag = hashlib.sha1(app.json.dumps(body).encode()).hexdigest()
+    # Слабый валидатор: тело может уйти сжатым, а версия данных от этого не меняется
+    if request.if_none_match.contains_weak(etag):
+        response = app.response_class(status=304)
+    else:
+        response = jsonify(body)
+    response.set_etag(etag, weak=True)
+    response.headers['Cache-Control'] = f"private, max-age={app.config['USER_KEYS_MAX_AGE']}"
+    return response
+
+
+@auth_bp.route('/users/batch', methods=['GET'])
+@jwt_required()
+def get_users_batch():
+    """
+    Профили нескольких пользователей одним запросом: ?ids=1,2,3 (не больше USER_BATCH_MAX).
+    """
+    try:
+        try:
+            user_ids = parse_batch(request.args.get('ids'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        rows = db.session.query(User.id, User.name, User.username, User.avatar, User.public_key) \
+            .filter(User.id.in_(user_ids)).all()
+        users = [dict(row._mapping) for row in rows]
+        found = {user['id'] for user in users}
+
+        return jsonify({'users': users, 'missing': [user_id for user_id in user_ids if user_id not in found]}), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@auth_bp.route('/users/keys', methods=['GET'])
+@jwt_required()
+def get_users_keys():
+    """
+    Публичные ключи нескольких пользователей (например, для GroupMember.key при создании группы):
+    ?ids=1,2,3 -> {"keys": {"1": ...}} или ?names=a,b -> {"keys": {"a": ...}}.
+    """
+    try:
+        try:
+            if request.args.get('names'):
+                names = parse_batch(request.args['names'], as_int=False)
+                column, requested = User.name, names
+            else:
+                column, requested = User.id, parse_batch(request.args.get('ids'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        rows = db.session.query(column, User.public_key).filter(column.in_(requested)).all()
+        keys = {str(key): public_key for key, public_key in rows}
+
+        return cached_keys_response({
+            'keys': keys,
+            'missing': [key for key in requested if str(key) not in keys]
+        })
+    except Exception as e:
+        logger.error(f"Необработанная ошибка: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@auth_bp.route('/users/last_sessions', methods=['GET'])
+@jwt_required()
+def get_last_sessions():
+    """
+    Время последней активности нескольких пользователей: ?ids=1,2,3 -> {"last_sessions": {"1": ms}}.
+    """
+    try:
+        try:
+            user_ids = parse_batch(request.args.get('ids'))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+
+        rows = db.session.query(User.id, User.last_session).filter(User.id.in_(user_ids)).all()
+        pending = presence.pending_sessions(redis_client, user_ids)
+        last_sessions = {str(user_id): presence.last_session_ms(last_session, pending.get(user_id))
+                         for user_id, last_session in rows}
+
+        return jsonify({
+            'last_sessions': last_sessions,
+            'missing': [user_id for user_id in user_ids if str(user_id) not in last_sessions]
+        }), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
 @auth_bp.route('/user/keys', methods=['GET'])
 @jwt_required()
 def get_keys():
@@ -270,8 +386,7 @@ def set_vacation():
             user.vacation_start = None
             user.vacation_end = None
             logger.info(f"Отпуск пользователя {user_name} отменён")
-            log = Log(id_user=user.id, action="set_vacation", content=f"Отпуск был отменён")
-            db.session.add(log)
+            audit.log_after_commit(id_user=user.id, action="set_vacation", content=f"Отпуск был отменён")
             db.session.commit()
         else:
             if not vacation_start or not vacation_end:
@@ -283,9 +398,7 @@ def set_vacation():
             logger.info(f"Отпуск установлен для пользователя {user_name}: {vacation_start} - {vacation_end}")
 
         db.session.commit()
-        log = Log(id_user=user.id, action="set_vacation", content=f"Отпуск установлен на {vacation_start} - {vacation_end}")
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user.id, action="set_vacation", content=f"Отпуск установлен на {vacation_start} - {vacation_end}")
         return jsonify({'message': 'Operation completed successfully'}), 200
 
     except Exception as e:
@@ -373,9 +486,7 @@ def set_permission():
         user.permission = permission
         db.session.commit()
         logger.info("Права успешно обновлены: user=%s, permission=%s", name, permission)
-        log = Log(id_user=user.id, action="set_permission", content=f"Права успешно обновлены: {permission}")
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user.id, action="set_permission", content=f"Права успешно обновлены: {permission}")
         return jsonify({'message': 'Permission updated successfully'}), 200
 
     except Exception as e:
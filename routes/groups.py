@@ -1,15 +1,24 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity, decode_token
 from flask_socketio import emit, join_room, leave_room, disconnect
-from models import (db, Group, GroupMember, User, Log, increment_message_count, decrement_message_count, 
-                    create_message_table, add_unread_message_for_all_members, 
-                    delete_unread_status_for_messages, do_zero_message_count)
+from models import (db, Group, GroupMember, User, decrement_message_count, 
+                    create_message_table, delete_unread_status_for_messages, do_zero_message_count)
 from .uploads import delete_file_from_disk, delete_avatar_file_if_exists
-from app import socketio, logger, dramatiq, app
-from fcm import send_push_wakeup
+from app import socketio, redis_client, logger, dramatiq, app
+import outbox
+import audit
+import event_log
+import sync_log
+import conversation_version
+import message_cache
+import message_payload
+import json_provider
+import history_export
+import presence
 from jwt.exceptions import ExpiredSignatureError
 from sqlalchemy import text
 from datetime import timezone, datetime
+import time
 
 
 groups_bp = Blueprint('groups', __name__)
@@ -27,9 +36,7 @@ def create_group():
         owner_key = data.get('key')
 
         if not owner_key:
-            log = Log(id_user=user_id, action="create_group", content=f"Failed: User sent empty key", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, action="create_group", content=f"Failed: User sent empty key", is_successful=False)
             return jsonify({'error': 'Invalid key'}), 400
 
         # Создание новой группы
@@ -42,17 +49,15 @@ def create_group():
         db.session.add(new_member)
 
         create_message_table(new_group.id, is_group=True)
+        sync_log.record('group', new_group.id, 'metadata')
 
-        log = Log(id_user=user_id, action="create_group", content=f"Group created")
-        db.session.add(log)
+        audit.log_after_commit(id_user=user_id, action="create_group", content=f"Group created")
         db.session.commit()
 
         return jsonify({"id_group": new_group.id}), 200
     except Exception as e:
         db.session.rollback()  # Откат транзакции в случае ошибки
-        log = Log(id_user=user_id, action="create_group", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, action="create_group", content=str(e)[:200], is_successful=False)
         return jsonify({'error': str(e)}), 500
 
 
@@ -74,26 +79,48 @@ def send_group_message(group_id):
         username_author_original = data.get('username_author_original')
         waveform = data.get('waveform')
 
+        # Группа и ее участники (с данными для уведомлений) одним запросом
+        members = db.session.execute(text('''
+            SELECT g.name AS group_name, g.avatar AS group_avatar, u.id AS user_id, u.username, u.fcm_token
+            FROM "group" g
+            JOIN group_member gm ON gm.group_id = g.id
+            JOIN public.user u ON u.id = gm.user_id
+            WHERE g.id = :group_id
+        '''), {'group_id': group_id}).mappings().all()
+
         # Проверка на участие пользователя в группе
-        group = Group.query.get(group_id)
-        if not group:
-            return jsonify({"error": "Group not found"}), 404
-        if not GroupMember.query.filter_by(group_id=group_id, user_id=user_id).first():
+        sender = next((member for member in members if member['user_id'] == user_id), None)
+        if not sender:
+            if not members and not Group.query.get(group_id):
+                return jsonify({"error": "Group not found"}), 404
             return jsonify({"error": "You are not a member of this group"}), 403
 
         if file:  
-            log = Log(id_user=user_id, id_group=group_id, action="send_message", content=f"User sent a file: {file}")
-            db.session.add(log)
-            db.session.commit()
+            audit.log_after_commit(id_user=user_id, id_group=group_id, action="send_message", content=f"User sent a file: {file}")
 
-        # Вставка сообщения в партицированную таблицу
+        # Вставка сообщения, счетчик группы и статусы непрочитанного - одна команда в одной транзакции
         table_name = f'messages_group_{group_id}'
-        insert_message_query = text(f'''INSERT INTO {table_name} 
-        (id_sender, text, images, voice, file, code, code_language, is_edited, is_forwarded, is_url, reference_to_message_id, username_author_original, is_read, waveform)
-        VALUES (:id_sender, :text, :images, :voice, :file, :code, :code_language, :is_edited, :is_forwarded, :is_url, :reference_to_message_id, :username_author_original, :is_read, :waveform)
-        RETURNING id, timestamp;''')
-
-        result = db.session.execute(insert_message_query, {
+        status_table_name = f'message_read_status_group_{group_id}'
+        insert_message_query = text(f'''
+        WITH inserted AS (
+            INSERT INTO {table_name} 
+            (id_sender, text, images, voice, file, code, code_language, is_edited, is_forwarded, is_url, reference_to_message_id, username_author_original, is_read, waveform)
+            VALUES (:id_sender, :text, :images, :voice, :file, :code, :code_language, :is_edited, :is_forwarded, :is_url, :reference_to_message_id, :username_author_original, :is_read, :waveform)
+            RETURNING {message_payload.select_columns(message_payload.INSERTED_FIELDS)}
+        ),
+        counter AS (
+            UPDATE "group" SET count_msg = count_msg + 1, last_activity = NOW() WHERE id = :group_id
+        ),
+        unread AS (
+            INSERT INTO {status_table_name} (message_id, user_id)
+            SELECT inserted.id, gm.user_id
+            FROM inserted, group_member gm
+            WHERE gm.group_id = :group_id AND gm.user_id != :id_sender
+        )
+        SELECT * FROM inserted;''')
+
+        values = {
+            'group_id': group_id,
             'id_sender': user_id,
             'text': text_content,
             'images': images,
@@ -108,38 +135,15 @@ def send_group_message(group_id):
             'reference_to_message_id': reference_to_message_id,
             'username_author_original': username_author_original,
             'waveform': waveform
-        })
-        db.session.commit()
-
-        increment_message_count(group_id=group_id)
+        }
+        result = db.session.execute(insert_message_query, values)
+        new_message = message_payload.inserted_message(result.fetchone(), values)
+        message_id = new_message['id']
 
-        message_id, timestamp = result.fetchone()
+        # События уходят через outbox после коммита вместе с сообщением
+        outbox.emit('new_message', new_message, room=f'group_{group_id}')
 
-        add_unread_message_for_all_members(group_id, message_id, user_id)
-
-        socketio.emit('new_message', {
-            'id': message_id,
-            'id_sender': user_id,
-            'text': text_content,
-            'images': images,
-            'voice': voice,
-            'file': file,
-            'code': code,
-            'code_language': code_lang,
-            'is_edited': False,
-            'is_read': False,
-            'is_forwarded': is_forwarded,
-            'is_url': is_url,
-            'username_author_original': username_author_original,
-            'reference_to_message_id': reference_to_message_id,
-            'waveform': waveform,
-            'timestamp': int(timestamp.timestamp() * 1000)
-        }, room=f'group_{group_id}')
-
-        user = User.query.get(user_id)
-        group_members = GroupMember.query.filter_by(group_id=group_id).all()
-        member_ids = [member.user_id for member in group_members]
-        member_ids.remove(user_id)
+        other_members = [member for member in members if member['user_id'] != user_id]
 
         notification_data = {
             'chat_id': group_id,
@@ -150,22 +154,24 @@ def send_group_message(group_id):
             'file': file,
             'code_language': code_lang,
             'id_sender': user_id,
-            'sender_name': user.username,
-            'avatar': group.avatar,
+            'sender_name': sender['username'],
+            'avatar': sender['group_avatar'],
             'is_group': True,
-            'group_name': group.name
+            'group_name': sender['group_name']
         }
 
         # Для push-уведомлений
-        for id in member_ids:
+        for member in other_members:
+            id = member['user_id']
             if active_groups.get(id) != group_id:
-                socketio.emit('new_message_notification', notification_data, room=f'user_{id}')
+                outbox.emit('new_message_notification', notification_data, room=f'user_{id}')
                 # FCM-уведомление, если пользователь оффлайн
                 room_name = f"user_{id}"
                 is_online = room_name in socketio.server.manager.rooms.get("/", {})
                 if not is_online:
-                    other_user = User.query.get(id)
-                    socketio.start_background_task(send_push_wakeup, other_user.fcm_token)
+                    outbox.push_wakeup(member['fcm_token'])
+
+        db.session.commit()
 
         return jsonify({"message": "Message sent successfully"}), 201
     except Exception as e:
@@ -203,7 +209,7 @@ def get_group_messages(group_id):
                 return jsonify({'error': 'Invalid before timestamp format'}), 400
 
             query = text(f'''
-                SELECT *
+                SELECT {message_payload.select_columns(message_payload.MESSAGE_FIELDS)}
                 FROM {table_name}
                 WHERE timestamp < :before
                 ORDER BY timestamp DESC
@@ -213,59 +219,57 @@ def get_group_messages(group_id):
             messages = db.session.execute(
                 query,
                 {'before': before_timestamp, 'limit': size}
-            ).mappings().all()
+            ).all()
 
-        else:
-            # Первая загрузка (самые новые сообщения)
-            query = text(f'''
-                SELECT *
-                FROM {table_name}
-                ORDER BY timestamp DESC
-                LIMIT :limit
-            ''')
+            # Разворачиваем в хронологический порядок (старые -> новые)
+            messages.reverse()
+            messages_data = message_payload.serialize(messages, message_payload.MESSAGE_FIELDS)
 
-            messages = db.session.execute(
-                query,
-                {'limit': size}
-            ).mappings().all()
-
-        # Разворачиваем в хронологический порядок (старые -> новые)
-        messages.reverse()
-
-        if not messages:
-            return jsonify([]), 200
+        else:
+            # Первая загрузка (самые новые сообщения): сначала из кэша последних сообщений чата
+            started = time.perf_counter()
+            room = f'group_{group_id}'
+            messages_data = message_cache.get_recent(redis_client, room, group.event_seq, size)
+            hit = messages_data is not None
+
+            if not hit:
+                # Читаем не меньше размера кэша, чтобы следующие первые страницы обслуживались из него
+                limit = max(size, app.config['RECENT_MESSAGES_CACHE_SIZE'])
+                query = text(f'''
+                    SELECT {message_payload.select_columns(message_payload.MESSAGE_FIELDS)}
+                    FROM {table_name}
+                    ORDER BY timestamp DESC
+                    LIMIT :limit
+                ''')
+
+                messages = db.session.execute(
+                    query,
+                    {'limit': limit}
+                ).all()
+
+                # Разворачиваем в хронологический порядок (старые -> новые)
+                messages.reverse()
+                serialized = message_payload.serialize(messages, message_payload.MESSAGE_FIELDS)
+                message_cache.store_recent(redis_client, room, group.event_seq, serialized, complete=len(messages) < limit)
+                messages_data = serialized[-size:] if size > 0 else []
+
+            message_cache.metrics.record(redis_client, hit, time.perf_counter() - started)
 
-        unread_message_ids = set()
         if before_ms is None: # start page
             status_table_name = f"message_read_status_group_{group_id}"
             unread_query = text(f"SELECT message_id FROM {status_table_name} WHERE user_id = :user_id;")
-            unread_messages = db.session.execute(unread_query, {'user_id': user_id}).scalars().all()
-            unread_message_ids = set(unread_messages)
-
-        messages_data = [
-            {
-                "id": msg['id'],
-                "id_sender": msg['id_sender'],
-                "text": msg['text'],
-                "images": msg['images'],
-                "voice": msg['voice'],
-                "file": msg['file'],
-                "code": msg['code'],
-                "code_language": msg['code_language'],
-                "is_edited": msg['is_edited'],
-                "is_read": msg['is_read'],
-                "is_personal_unread": msg['id'] in unread_message_ids,
-                "is_forwarded": msg['is_forwarded'],
-                "is_url": msg['is_url'],
-                "reference_to_message_id": msg['reference_to_message_id'],
-                "username_author_original": msg['username_author_original'],
-                "waveform": msg['waveform'],
-                "timestamp": int(msg['timestamp'].timestamp() * 1000)
-            }
-            for msg in messages
-        ]
-
-        return jsonify(messages_data), 200
+            unread_message_ids = set(db.session.execute(unread_query, {'user_id': user_id}).scalars().all())
+            messages_data = [{**msg, "is_personal_unread": msg['id'] in unread_message_ids} for msg in messages_data]
+        else:
+            messages_data = [{**msg, "is_personal_unread": False} for msg in messages_data]
+
+        # Цитируемые сообщения страницы одним запросом вместо get_message_by_id на каждый ответ
+        references = None
+        if message_payload.wants_references(request.args):
+            references = message_payload.fetch_references(table_name, messages_data)
+
+        fields = message_payload.MESSAGE_FIELDS + ('is_personal_unread',)
+        return jsonify(message_payload.render(messages_data, request.args, fields, references)), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -288,11 +292,12 @@ def get_message_by_id(message_id):
         table_name = f'messages_group_{group_id}'
 
         # Получение сообщения по ID
-        get_message_query = text(f'SELECT * FROM {table_name} WHERE id = :message_id')
-        message = db.session.execute(get_message_query, {'message_id': message_id}).mappings().first()
+        get_message_query = text(f'SELECT {message_payload.select_columns(message_payload.MESSAGE_FIELDS)} FROM {table_name} WHERE id = :message_id')
+        message = db.session.execute(get_message_query, {'message_id': message_id}).first()
 
         if not message:
             return jsonify({"error": "Message not found"}), 404
+        message = message_payload.serialize_row(message, message_payload.MESSAGE_FIELDS)
 
         get_position_query = text(f'''
         SELECT row_number FROM (
@@ -301,27 +306,7 @@ def get_message_by_id(message_id):
 
         message_position = db.session.execute(get_position_query, {'message_id': message['id']}).scalar()
 
-        message_data = {
-            "id": message['id'],
-            "id_sender": message['id_sender'],
-            "text": message['text'],
-            "images": message['images'],
-            "voice": message['voice'],
-            "file": message['file'],
-            "code": message['code'],
-            "code_language": message['code_language'],
-            "is_edited": message['is_edited'],
-            "is_read": message['is_read'],
-            "is_forwarded": message['is_forwarded'],
-            "is_url": message['is_url'],
-            "reference_to_message_id": message['reference_to_message_id'],
-            "username_author_original": message['username_author_original'],
-            "waveform": message['waveform'],
-            "timestamp": int(message['timestamp'].timestamp() * 1000),
-            "position": message_position
-        }
-
-        return jsonify(message_data), 200
+        return jsonify({**message, "position": message_position}), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -337,18 +322,14 @@ def edit_group_message(message_id):
 
         table_name = f'messages_group_{group_id}'
         # Проверка существования сообщения
-        select_message_query = text(f'SELECT * FROM {table_name} WHERE id = :message_id')
+        select_message_query = text(f'SELECT id_sender, text, images, voice, file, code, code_language FROM {table_name} WHERE id = :message_id')
         message = db.session.execute(select_message_query, {'message_id': message_id}).mappings().first()
 
         if not message:
-            log = Log(id_user=id_user, action="edit_message", content=f"Message {message_id} not found", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=id_user, action="edit_message", content=f"Message {message_id} not found", is_successful=False)
             return jsonify({'error': 'Message not found'}), 404
         if message['id_sender'] != id_user:
-            log = Log(id_user=id_user, action="edit_message", content="Attempted unauthorized edit", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=id_user, action="edit_message", content="Attempted unauthorized edit", is_successful=False)
             return jsonify({'error': 'You can only edit your own messages'}), 403
         
         # Обновляем поля
@@ -386,30 +367,14 @@ def edit_group_message(message_id):
             updated = True
 
         if updated:
-            log = Log(id_user=id_user, id_group=group_id, action="edit_message", content=f"Message was edited, old message: text: {message.get('text', '')[:150] if message.get('text') else ''}, "
+            audit.log_after_commit(id_user=id_user, id_group=group_id, action="edit_message", content=f"Message was edited, old message: text: {message.get('text', '')[:150] if message.get('text') else ''}, "
             f"file: {message.get('file', '')[:50] if message.get('file') else ''}")
-            db.session.add(log)
-            db.session.commit()
 
-            # Уведомляем через WebSocket
-            socketio.emit('message_edited', {
-                'id': message_id,
-                'id_sender': id_user,
-                'text': data.get('text', message['text']),
-                'images': data.get('images', message['images']),
-                'voice': data.get('voice', message['voice']),
-                'file': data.get('file', message['file']),
-                'code': data.get('code', message['code']),
-                'code_language': data.get('code_language', message['code_language']),
-                'is_edited': True,
-                'is_read': message['is_read'],
-                'is_url': data.get('is_url', message['is_url']),
-                'is_forwarded': data.get('is_forwarded', message['is_forwarded']),
-                'username_author_original': data.get('username_author_original', message['username_author_original']),
-                'reference_to_message_id': data.get('reference_to_message_id', message['reference_to_message_id']),
-                'waveform': data.get('waveform', message['waveform']),
-                'timestamp': int(message['timestamp'].timestamp() * 1000)
-            }, room=f'group_{group_id}')
+            # Уведомляем через WebSocket: событие собирается из сохраненной строки, а не из запроса клиента
+            edited_query = text(f'SELECT {message_payload.select_columns(message_payload.MESSAGE_FIELDS)} FROM {table_name} WHERE id = :message_id')
+            edited = message_payload.serialize_row(db.session.execute(edited_query, {'message_id': message_id}).first(), message_payload.MESSAGE_FIELDS)
+            outbox.emit('message_edited', edited, room=f'group_{group_id}')
+            db.session.commit()
 
         return jsonify({"message": "Group message edited successfully"}), 200
     except Exception as e:
@@ -436,9 +401,7 @@ def delete_group_messages(group_id):
         message_ids = data.get('message_ids', [])
 
         if not message_ids:
-            log = Log(id_user=user_id, id_group=group_id, action="delete_message", content="Bad attempt to delete message(message IDs provided)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, id_group=group_id, action="delete_message", content="Bad attempt to delete message(message IDs provided)", is_successful=False)
             return jsonify({"error": "No message IDs provided"}), 400
 
         table_name = f'messages_group_{group_id}'
@@ -448,9 +411,7 @@ def delete_group_messages(group_id):
         messages = db.session.execute(select_messages_query, {'message_ids': tuple(message_ids)}).mappings().all()
 
         if not messages:
-            log = Log(id_user=user_id, id_group=group_id, action="delete_message", content="Bad attempt to delete message(Some messages not found)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, id_group=group_id, action="delete_message", content="Bad attempt to delete message(Some messages not found)", is_successful=False)
             return jsonify({"error": "Some messages not found"}), 404
 
         # Удаление файлов и сообщений
@@ -468,28 +429,25 @@ def delete_group_messages(group_id):
             if message['text']:
                 content += f" Deleted text message: {message['text']}"
 
-            log_entry = Log(id_user=user_id, id_group=group_id, action="delete_message", content=content[:255])
-            db.session.add(log_entry)
+            audit.log_after_commit(id_user=user_id, id_group=group_id, action="delete_message", content=content[:255])
             sql_delete = text(f"DELETE FROM {table_name} WHERE id = :message_id")
             db.session.execute(sql_delete, {'message_id': message['id']})
 
+        # Уведомляем участников через WebSocket
+        outbox.emit('messages_deleted', {
+            'deleted_message_ids': message_ids
+        }, room=f'group_{group_id}')
+
         decrement_message_count(group_id=group_id, count=len(messages))
 
         delete_unread_status_for_messages(group_id, message_ids)
 
         db.session.commit()
 
-        # Уведомляем участников через WebSocket
-        socketio.emit('messages_deleted', {
-            'deleted_message_ids': message_ids
-        }, room=f'group_{group_id}')
-
         return jsonify({"message": "Messages deleted successfully"}), 200
     except Exception as e:
         db.session.rollback()  # Откат транзакции в случае ошибки
-        log_entry = Log(id_user=user_id, id_group=group_id, action="delete_message", content=str(e)[:200], is_successful=False)
-        db.session.add(log_entry)
-        db.session.commit()
+        audit.log(id_user=user_id, id_group=group_id, action="delete_message", content=str(e)[:200], is_successful=False)
         return jsonify({"error": str(e)}), 500
 
 
@@ -510,7 +468,7 @@ def delete_group(group_id):
         table_name = f'messages_group_{group_id}'
         
         # Получаем все сообщения для удаления
-        select_messages_query = text(f'SELECT * FROM {table_name}')
+        select_messages_query = text(f'SELECT images, file, voice FROM {table_name} WHERE images IS NOT NULL OR file IS NOT NULL OR voice IS NOT NULL')
         messages = db.session.execute(select_messages_query).mappings().all()
 
         # Удаляем файлы, прикрепленные к сообщениям
@@ -526,13 +484,14 @@ def delete_group(group_id):
         delete_messages_query = text(f'DELETE FROM {table_name}')
         db.session.execute(delete_messages_query)
 
+        # Уведомляем участников через WebSocket
+        outbox.emit('dialog_deleted', {}, room=f'group_{group_id}')
+
         # Удаляем группу
         db.session.delete(group)
         db.session.commit()
 
-        log = Log(id_user=user_id, id_group=group_id, action="delete_group", content="Group successfully deleted")
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, id_group=group_id, action="delete_group", content="Group successfully deleted")
 
         status_table_name = f"message_read_status_group_{group_id}"
         # Формируем SQL-запрос для удаления таблицы
@@ -540,15 +499,10 @@ def delete_group(group_id):
         db.session.execute(query)
         db.session.commit()
 
-        # Уведомляем участников через WebSocket
-        socketio.emit('dialog_deleted', {}, room=f'group_{group_id}')
-
         return jsonify({"message": "Group deleted successfully"}), 200
     except Exception as e:
         db.session.rollback()
-        log = Log(id_user=user_id, id_group=group_id, action="delete_group", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, id_group=group_id, action="delete_group", content=str(e)[:200], is_successful=False)
         return jsonify({"error": str(e)}), 500
 
 
@@ -568,6 +522,7 @@ def edit_group_name(group_id):
             return jsonify({"error": "No name provided"}), 400
 
         group.name = new_name
+        sync_log.record('group', group_id, 'metadata')
         db.session.commit()
         return jsonify({"message": "Group name updated successfully"}), 200
     except Exception as e:
@@ -598,6 +553,8 @@ def add_user_to_group(group_id):
 
         new_member = GroupMember(group_id=group_id, user_id=user.id, key=group_key)
         db.session.add(new_member)
+        sync_log.record('group', group_id, 'metadata')
+        conversation_version.mark_users(db.session, [user.id])
         db.session.commit()
         return jsonify({'message': 'User added to group successfully'}), 201
     except Exception as e:
@@ -620,6 +577,8 @@ def remove_user_from_group(group_id, user_id):
             return jsonify({'error': 'User is not a member of the group'}), 404
 
         db.session.delete(member)
+        sync_log.record('group', group_id, 'removed', user_id=user_id)
+        sync_log.record('group', group_id, 'metadata')
         db.session.commit()
         return jsonify({'message': 'User removed from group successfully'}), 200
     except Exception as e:
@@ -657,7 +616,9 @@ def get_group_members(group_id):
         group_members = GroupMember.query.filter_by(group_id=group_id).all()
         member_ids = [member.user_id for member in group_members]
         members = User.query.filter(User.id.in_(member_ids)).all()
-        member_list = [{'id': member.id, 'name': member.name, 'username': member.username, 'avatar': member.avatar, 'last_session': int(member.last_session.timestamp() * 1000)} for member in members]
+        pending = presence.pending_sessions(redis_client, [member.id for member in members])
+        member_list = [{'id': member.id, 'name': member.name, 'username': member.username, 'avatar': member.avatar,
+                        'last_session': presence.last_session_ms(member.last_session, pending.get(member.id))} for member in members]
 
         return jsonify(member_list), 200
     except Exception as e:
@@ -689,6 +650,7 @@ def update_group_avatar(group_id):
                 delete_avatar_file_if_exists(group.avatar)
             group.avatar = avatar
             logger.info(f"User #{user_id} updated avatar in group: {group.name}")
+        sync_log.record('group', group_id, 'metadata')
         db.session.commit()
         return jsonify({"message": "Group avatar updated successfully"}), 200
     except Exception as e:
@@ -716,29 +678,27 @@ def delete_messages_task_group(message_ids, group_id):
                 if message['text']:
                     content += f" Deleted text message: {message['text']}"
 
-                log_entry = Log(id_user=-1, id_group=group_id, action="delete_message", content=content[:255])
-                db.session.add(log_entry) 
+                audit.log_after_commit(id_user=-1, id_group=group_id, action="delete_message", content=content[:255])
 
             # Удаление сообщений
             delete_messages_query = text(f'''DELETE FROM messages_group_{group_id} WHERE id IN :message_ids''')
             db.session.execute(delete_messages_query, {'message_ids': tuple(message_ids)})
-            db.session.commit()
 
             decrement_message_count(group_id=group_id, count=len(message_ids))
 
             delete_unread_status_for_messages(group_id, message_ids)
 
-            logger.info(f"Sending WebSocket message to room group_{group_id} with deleted message ids: {message_ids}")
             # Уведомление через WebSocket
-            socketio.emit('messages_deleted', {
+            outbox.emit('messages_deleted', {
                 'deleted_message_ids': message_ids
             }, room=f'group_{group_id}')
+            db.session.commit()
+
+            logger.info(f"Sending WebSocket message to room group_{group_id} with deleted message ids: {message_ids}")
 
         except Exception as e:
             db.session.rollback()
-            log_entry = Log(id_user=-1, id_group=group_id, action="delete_message", content=str(e)[:200], is_successful=False)
-            db.session.add(log_entry)
-            db.session.commit()
+            audit.log(id_user=-1, id_group=group_id, action="delete_message", content=str(e)[:200], is_successful=False)
             print(f"Error deleting messages: {str(e)}")
 
 
@@ -783,6 +743,12 @@ def mark_group_messages_as_read(group_id):
         """)
         db.session.execute(delete_unread_status_query, {'user_id': user_id, 'max_message_id': max_message_id})
 
+        if unread_messages:
+            # Уведомляем участников через WebSocket
+            outbox.emit('messages_read', {
+                'messages_read_ids': unread_messages
+            }, room=f'group_{group_id}')
+
         db.session.commit()
 
         if unread_messages:
@@ -803,11 +769,6 @@ def mark_group_messages_as_read(group_id):
                     delay=delete_interval_seconds * 1000  # Интервал в миллисекундах
                 )
 
-            # Уведомляем участников через WebSocket
-            socketio.emit('messages_read', {
-                'messages_read_ids': unread_messages
-            }, room=f'group_{group_id}')
-
         return jsonify({"message": "Group messages marked as read"}), 200
     except Exception as e:
         db.session.rollback()
@@ -825,6 +786,7 @@ def toggle_group_can_delete(group_id):
         if not GroupMember.query.filter_by(group_id=group_id, user_id=user_id).first():
             return jsonify({"error": "You are not a member of this group"}), 403
         group.can_delete = not group.can_delete
+        sync_log.record('group', group_id, 'metadata')
         db.session.commit()
         return jsonify({"message": "Group can_delete flag updated successfully", "can_delete": group.can_delete}), 200
     except Exception as e:
@@ -845,16 +807,14 @@ def update_group_auto_delete_interval(group_id):
         if not GroupMember.query.filter_by(group_id=group_id, user_id=user_id).first():
             return jsonify({"error": "You are not a member of this group"}), 403
 
-        log = Log(id_user=user_id, id_group=group_id, action="update_group_auto_delete_interval", content=f"Successfully updated interval to {auto_delete_interval}")
-        db.session.add(log)
+        audit.log_after_commit(id_user=user_id, id_group=group_id, action="update_group_auto_delete_interval", content=f"Successfully updated interval to {auto_delete_interval}")
         group.auto_delete_interval = auto_delete_interval
+        sync_log.record('group', group_id, 'metadata')
         db.session.commit()
         return jsonify({"message": "Group auto_delete_interval updated successfully", "auto_delete_interval": group.auto_delete_interval}), 200
     except Exception as e:
         db.session.rollback()
-        log = Log(id_user=user_id, id_group=group_id, action="update_group_auto_delete_interval", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, id_group=group_id, action="update_group_auto_delete_interval", content=str(e)[:200], is_successful=False)
         return jsonify({"error": str(e)}), 500
 
 
@@ -882,11 +842,6 @@ def delete_group_messages_all(group_id):
 
         delete_messages_query = text(f"DELETE FROM messages_group_{group_id}")
         db.session.execute(delete_messages_query)
-        db.session.commit()
-
-        log = Log(id_user=user_id, id_group=group_id, action="delete_group_messages", content="All messages successfully deleted")
-        db.session.add(log)
-        db.session.commit()
 
         do_zero_message_count(group_id=group_id)
 
@@ -894,17 +849,17 @@ def delete_group_messages_all(group_id):
         # Формируем SQL-запрос для очистки таблицы
         query = text(f"TRUNCATE TABLE {status_table_name};")
         db.session.execute(query)
-        db.session.commit()
 
         # Уведомление участников через WebSocket
-        socketio.emit('messages_all_deleted', {}, room=f'group_{group_id}')
+        outbox.emit('messages_all_deleted', {}, room=f'group_{group_id}')
+        db.session.commit()
+
+        audit.log(id_user=user_id, id_group=group_id, action="delete_group_messages", content="All messages successfully deleted")
 
         return jsonify({"message": "All messages in the group deleted successfully"}), 200
     except Exception as e:
         db.session.rollback()
-        log = Log(id_user=user_id, id_group=group_id, action="delete_group_messages", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, id_group=group_id, action="delete_group_messages", content=str(e)[:200], is_successful=False)
         return jsonify({"error": str(e)}), 500
 
 
@@ -923,32 +878,44 @@ def search_messages_in_group(group_id):
     table_name = f'messages_group_{group_id}'
 
     # Получаем все сообщения из таблицы, кроме тех, где text == None
-    query = text(f"SELECT * FROM {table_name} WHERE text IS NOT NULL ORDER BY timestamp DESC")
-    messages = db.session.execute(query).mappings().all()
+    query = text(f"SELECT {message_payload.select_columns(message_payload.SEARCH_FIELDS)} FROM {table_name} WHERE text IS NOT NULL ORDER BY timestamp DESC")
+    messages = db.session.execute(query).all()
     messages.reverse()
 
-    message_list = [
-        {
-            "id": message['id'],
-            "id_sender": message['id_sender'],
-            "text": message['text'],
-            "images": message['images'],
-            "voice": message['voice'],
-            "file": message['file'],
-            "code": message['code'],
-            "code_language": message['code_language'],
-            "is_read": message['is_read'],
-            "is_edited": message['is_edited'],
-            "is_url": message['is_url'],
-            "timestamp": int(message['timestamp'].timestamp() * 1000),
-            "reference_to_message_id": message['reference_to_message_id'],
-            "is_forwarded": message['is_forwarded'],
-            "username_author_original": message['username_author_original'],
-            "waveform": message['waveform']
-        } for message in messages
-    ]
-
-    return jsonify(message_list), 200
+    message_list = message_payload.serialize(messages, message_payload.SEARCH_FIELDS)
+    if message_payload.wants_columnar(request.args):
+        return jsonify(message_payload.to_columnar(message_list, message_payload.SEARCH_FIELDS)), 200
+    # Поиск отдает все текстовые сообщения чата - длинный список кодируется по частям
+    return json_provider.array_response(message_list), 200
+
+
+@groups_bp.route('/groups/<int:group_id>/messages/export', methods=['GET'])
+@jwt_required()
+def export_group_messages(group_id):
+    """
+    Потоковая NDJSON-выгрузка текстовых сообщений группы для локального поискового индекса
+    клиента (см. history_export). since - токен next из предыдущей выгрузки.
+    """
+    try:
+        user_id = get_jwt_identity()
+
+        group = Group.query.get(group_id)
+        if not group:
+            return jsonify({"error": "Group not found"}), 404
+        if not GroupMember.query.filter_by(group_id=group_id, user_id=user_id).first():
+            return jsonify({"error": "You are not a member of this group"}), 403
+
+        since = request.args.get('since')
+        if since:
+            try:
+                since = sync_log.parse_token(since)
+            except ValueError:
+                return jsonify({'error': 'Invalid export token'}), 400
+
+        return history_export.export_response('group', group_id, since)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
 
 
 @socketio.on('typing_group')
@@ -1073,3 +1040,42 @@ def handle_leave_dialog(data):
     except Exception as e:
         logger.info(f"Invalid token: {e}")
         disconnect()
+
+
+@socketio.on('resume_group')
+def handle_resume_group(data):
+    """
+    Досылает события группы, пропущенные за время разрыва соединения.
+    :param data: group_id и last_seq - номер последнего полученного клиентом события.
+    Ответ - событие 'resumed_group' со списком events или full_resync=True, если нужна полная перезагрузка.
+    """
+    token = request.headers.get('Authorization')
+    if token and token.startswith("Bearer "):
+        token = token.split("Bearer ")[1]
+    else:
+        logger.info("Missing or invalid Authorization header")
+        disconnect()
+        return
+
+    try:
+        decoded_token = decode_token(token)
+        user_id = int(decoded_token['sub'])
+
+        group_id = data.get('group_id')
+        last_seq = int(data.get('last_seq') or 0)
+
+        if not group_id or not GroupMember.query.filter_by(group_id=group_id, user_id=user_id).first():
+            emit('resumed_group', {'group_id': group_id, 'error': 'Access denied'})
+            return
+
+        result = event_log.replay(redis_client, f'group_{group_id}', last_seq)
+        if result is None:
+            emit('resumed_group', {'group_id': group_id, 'error': 'Not found'})
+            return
+        emit('resumed_group', {'group_id': group_id, **result})
+    except ExpiredSignatureError:
+        logger.info("Token expired caught")
+        emit('token_expired', {'message': 'Token has expired'})
+        disconnect()
+    except Exception as e:
+        logger.info(f"Resume failed: {e}")
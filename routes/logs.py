@@ -1,6 +1,7 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import db, Log
+from models import db
+import audit
 from sqlalchemy import text
 import re
 
@@ -22,25 +23,19 @@ def execute_log_query():
         sql_query = data.get('query')
 
         if not sql_query:
-            log = Log(id_user=user_id, action="get_logs", content="Failed to get logs(No SQL query provided)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, action="get_logs", content="Failed to get logs(No SQL query provided)", is_successful=False)
             return jsonify({"error": "No SQL query provided"}), 400
 
         # Проверка на наличие разрешенных таблиц
         allowed_tables = ['Log']  # Добавьте сюда разрешенные таблицы
         if not any(table in sql_query for table in allowed_tables):
-            log = Log(id_user=user_id, action="get_logs", content="Failed to get logs(Unauthorized table access)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, action="get_logs", content="Failed to get logs(Unauthorized table access)", is_successful=False)
             return jsonify({"error": "Unauthorized table access"}), 403
 
         # Простой паттерн для разрешенных запросов
         pattern = r'^(SELECT|SELECT DISTINCT) .* FROM \w+(\s+WHERE .*)?(\s+ORDER BY \w+ (ASC|DESC))?;?$'
         if not re.match(pattern, sql_query.strip(), re.IGNORECASE):
-            log = Log(id_user=user_id, action="get_logs", content="Failed to get logs(Invalid SQL query format)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, action="get_logs", content="Failed to get logs(Invalid SQL query format)", is_successful=False)
             return jsonify({"error": "Invalid SQL query format"}), 400
 
         # Выполняем запрос
@@ -51,14 +46,10 @@ def execute_log_query():
         logs_list = [dict(row) for row in rows]
 
         # Логируем выполненный запрос
-        log = Log(id_user=user_id, action="get_logs", content=f"Query successfully completed: {sql_query}"[:255])
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, action="get_logs", content=f"Query successfully completed: {sql_query}"[:255])
 
         return jsonify(logs_list), 200
 
     except Exception as e:
-        log = Log(id_user=user_id, action="get_logs", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, action="get_logs", content=str(e)[:200], is_successful=False)
         return jsonify({"error": str(e)}), 500
\ No newline at end of file
@@ -1,14 +1,25 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity, decode_token
 from flask_socketio import emit, join_room, leave_room, disconnect
-from models import (db, Dialog, User, Group, GroupMember, Log, increment_message_count,
+from models import (db, Dialog, User, Group, GroupMember,
                     decrement_message_count, create_message_table, get_unread_group_messages_count, do_zero_message_count)
-from .uploads import delete_file_from_disk
-from app import socketio, logger, dramatiq, app
-from fcm import send_push_wakeup
+from .uploads import delete_file_from_disk, forward_attachment, has_conversation_access, is_moderator
+from app import socketio, redis_client, logger, dramatiq, app
+import outbox
+import audit
+import event_log
+import sync_log
+import conversation_version
+import message_cache
+import message_payload
+import json_provider
+import history_export
 from jwt.exceptions import ExpiredSignatureError
 from sqlalchemy import text
 from datetime import timezone, datetime
+import time
+import base64
+import hashlib
 
 
 messages_bp = Blueprint('messages', __name__)
@@ -28,15 +39,11 @@ def create_dialog():
         other_user = User.query.filter_by(name=name).first()
 
         if not other_user:
-            log = Log(id_user=user_id, action="create_dialog", content=f"Failed: User '{name}' not found", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, action="create_dialog", content=f"Failed: User '{name}' not found", is_successful=False)
             return jsonify({'error': 'User not found'}), 404
         
         if not dialog_key1 or not dialog_key2:
-            log = Log(id_user=user_id, action="create_dialog", content=f"Failed: User sent empty key", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, action="create_dialog", content=f"Failed: User sent empty key", is_successful=False)
             return jsonify({'error': 'Invalid key'}), 400
 
         # Проверка на существование диалога
@@ -46,9 +53,7 @@ def create_dialog():
         ).first()
 
         if existing_dialog:
-            log = Log(id_user=user_id, action="create_dialog", content="Failed: Dialog already exists", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, action="create_dialog", content="Failed: Dialog already exists", is_successful=False)
             return jsonify({'error': 'Dialog already exists'}), 409
 
         # Создание нового диалога
@@ -57,17 +62,15 @@ def create_dialog():
         db.session.flush() # Используем flush для получения ID диалога
 
         create_message_table(new_dialog.id)
+        sync_log.record('dialog', new_dialog.id, 'metadata')
 
-        log = Log(id_user=user_id, action="create_dialog", content=f"Dialog created with {other_user.name}")
-        db.session.add(log)
+        audit.log_after_commit(id_user=user_id, action="create_dialog", content=f"Dialog created with {other_user.name}")
         db.session.commit()
 
         return jsonify({"id_dialog": new_dialog.id}), 200
     except Exception as e:
         db.session.rollback()
-        log = Log(id_user=user_id, action="create_dialog", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, action="create_dialog", content=str(e)[:200], is_successful=False)
         return jsonify({'error': str(e)}), 500
 
 
@@ -89,28 +92,41 @@ def send_message(id_dialog):
         username_author_original = data.get('username_author_original')
         waveform = data.get('waveform')
 
-        # Проверка на существование диалога
-        dialog = Dialog.query.get(id_dialog)
+        # Диалог, отправитель и собеседник одним запросом
+        dialog = db.session.execute(text('''
+            SELECT d.id_user1, d.id_user2, s.username AS sender_username, s.avatar AS sender_avatar,
+                   o.fcm_token AS other_fcm_token
+            FROM dialog d
+            JOIN public.user s ON s.id = :id_sender
+            LEFT JOIN public.user o ON o.id = CASE WHEN d.id_user1 = :id_sender THEN d.id_user2 ELSE d.id_user1 END
+            WHERE d.id = :id_dialog
+        '''), {'id_dialog': id_dialog, 'id_sender': id_sender}).mappings().first()
         if not dialog:
             return jsonify({"error": "Dialog not found"}), 404
 
         # Проверка на участие отправителя в диалоге
-        if dialog.id_user1 != id_sender and dialog.id_user2 != id_sender:
+        if dialog['id_user1'] != id_sender and dialog['id_user2'] != id_sender:
             return jsonify({"error": "You are not a participant in this dialog"}), 403
 
         if file:  
-            log = Log(id_user=id_sender, id_dialog=id_dialog, action="send_message", content=f"User sent a file: {file}")
-            db.session.add(log)
-            db.session.commit()
+            audit.log_after_commit(id_user=id_sender, id_dialog=id_dialog, action="send_message", content=f"User sent a file: {file}")
 
-        # Вставка сообщения в партицированную таблицу
+        # Вставка сообщения и счетчик диалога - одна команда в одной транзакции
         table_name = f'messages_dialog_{id_dialog}'
-        insert_message_query = text(f'''INSERT INTO {table_name} 
-        (id_sender, text, images, voice, file, code, code_language, is_edited, is_forwarded, is_url, reference_to_message_id, username_author_original, is_read, waveform)
-        VALUES (:id_sender, :text, :images, :voice, :file, :code, :code_language, :is_edited, :is_forwarded, :is_url, :reference_to_message_id, :username_author_original, :is_read, :waveform)
-        RETURNING id, timestamp;''')
-
-        result = db.session.execute(insert_message_query, {
+        insert_message_query = text(f'''
+        WITH inserted AS (
+            INSERT INTO {table_name} 
+            (id_sender, text, images, voice, file, code, code_language, is_edited, is_forwarded, is_url, reference_to_message_id, username_author_original, is_read, waveform)
+            VALUES (:id_sender, :text, :images, :voice, :file, :code, :code_language, :is_edited, :is_forwarded, :is_url, :reference_to_message_id, :username_author_original, :is_read, :waveform)
+            RETURNING {message_payload.select_columns(message_payload.INSERTED_FIELDS)}
+        ),
+        counter AS (
+            UPDATE dialog SET count_msg = count_msg + 1, last_activity = NOW() WHERE id = :id_dialog
+        )
+        SELECT * FROM inserted;''')
+
+        values = {
+            'id_dialog': id_dialog,
             'id_sender': id_sender,
             'text': text_content,
             'images': images,
@@ -125,38 +141,19 @@ def send_message(id_dialog):
             'reference_to_message_id': reference_to_message_id,
             'username_author_original': username_author_original,
             'waveform': waveform
-        })
-        db.session.commit()
-
-        increment_message_count(dialog_id=id_dialog)
-
-        message_id, timestamp = result.fetchone()
+        }
+        result = db.session.execute(insert_message_query, values)
+        new_message = message_payload.inserted_message(result.fetchone(), values)
+        message_id = new_message['id']
 
-        socketio.emit('new_message', {
-            'id': message_id,
-            'id_sender': id_sender,
-            'text': text_content,
-            'images': images,
-            'voice': voice,
-            'file': file,
-            'code': code,
-            'code_language': code_lang,
-            'is_edited': False,
-            'is_read': False,
-            'is_forwarded': is_forwarded,
-            'is_url': is_url,
-            'username_author_original': username_author_original,
-            'reference_to_message_id': reference_to_message_id,
-            'waveform': waveform,
-            'timestamp': int(timestamp.timestamp() * 1000)
-        }, room=f'dialog_{id_dialog}')
+        # События уходят через outbox после коммита вместе с сообщением
+        outbox.emit('new_message', new_message, room=f'dialog_{id_dialog}')
 
-        user = User.query.get(id_sender)
-        other_user_id = dialog.id_user1 if dialog.id_user1 != id_sender else dialog.id_user2
+        other_user_id = dialog['id_user1'] if dialog['id_user1'] != id_sender else dialog['id_user2']
 
         # Для push-уведомлений
         if active_dialogs.get(other_user_id) != id_dialog:
-            socketio.emit('new_message_notification', {
+            outbox.emit('new_message_notification', {
                 'chat_id': id_dialog,
                 'message_id': message_id,
                 'text': text_content,
@@ -165,8 +162,8 @@ def send_message(id_dialog):
                 'file': file,
                 'code_language': code_lang,
                 'id_sender': id_sender,
-                'sender_name': user.username,
-                'avatar': user.avatar,
+                'sender_name': dialog['sender_username'],
+                'avatar': dialog['sender_avatar'],
                 'is_group': False,
                 'group_name': None
             }, room=f'user_{other_user_id}')
@@ -176,8 +173,9 @@ def send_message(id_dialog):
             is_online = room_name in socketio.server.manager.rooms.get("/", {})
 
             if not is_online:
-                other_user = User.query.get(other_user_id)
-                socketio.start_background_task(send_push_wakeup, other_user.fcm_token)
+                outbox.push_wakeup(dialog['other_fcm_token'])
+
+        db.session.commit()
 
         return jsonify({"message": "Message sent successfully"}), 201
     except Exception as e:
@@ -186,6 +184,135 @@ def send_message(id_dialog):
         return jsonify({'error': str(e)}), 500
 
 
+# Поле сообщения -> папка загрузок вложения
+FORWARD_ATTACHMENT_FOLDERS = {'images': 'PHOTOS', 'voice': 'AUDIO', 'file': 'FILES'}
+
+
+@messages_bp.route('/messages/forward', methods=['POST'])
+@jwt_required()
+def forward_messages():
+    """
+    Пересылка сообщений в другой диалог или группу. Вложения привязываются к целевому чату
+    на сервере (новые ссылки на те же блобы), сообщения вставляются одним INSERT ... SELECT.
+    Текст зашифрован ключом исходного чата, поэтому клиент может передать перешифрованные
+    тексты в texts: {id сообщения: текст}.
+    """
+    try:
+        user_id = get_jwt_identity()
+        data = request.get_json()
+        source_id = data.get('source_id')
+        source_is_group = 1 if data.get('source_is_group') else 0
+        target_id = data.get('target_id')
+        target_is_group = 1 if data.get('target_is_group') else 0
+        message_ids = data.get('message_ids', [])
+        texts = data.get('texts') or {}
+
+        if not source_id or not target_id or not message_ids:
+            return jsonify({'error': 'source_id, target_id and message_ids are required'}), 400
+
+        if not has_conversation_access(user_id, source_id, source_is_group) or \
+                not has_conversation_access(user_id, target_id, target_is_group):
+            return jsonify({'error': 'You are not a participant in this conversation'}), 403
+
+        source_table = f"messages_group_{source_id}" if source_is_group else f"messages_dialog_{source_id}"
+        target_table = f"messages_group_{target_id}" if target_is_group else f"messages_dialog_{target_id}"
+
+        messages = db.session.execute(
+            text(f'SELECT id, images, voice, file FROM {source_table} WHERE id = ANY(:message_ids)'),
+            {'message_ids': message_ids}
+        ).mappings().all()
+        if not messages:
+            return jsonify({'error': 'Messages not found'}), 404
+
+        # Вложения: новые ссылки в целевом чате; при конфликте имени файл получает другое имя.
+        # Ссылки коммитятся вместе с сообщениями, при откате их файлы убирает media_store
+        renames = {}
+        for message in messages:
+            for column, folder in FORWARD_ATTACHMENT_FOLDERS.items():
+                names = message[column] if column == 'images' else [message[column]]
+                for name in names or []:
+                    if not name or (folder, name) in renames:
+                        continue
+                    new_name = forward_attachment(folder, name, source_id, source_is_group == 1,
+                                                  target_id, target_is_group == 1, user_id)
+                    renames[(folder, name)] = new_name or name
+
+        # Сообщения, счетчик и last_activity чата и непрочитанные у участников группы - одна команда
+        counter_table = '"group"' if target_is_group else 'dialog'
+        unread = ''
+        if target_is_group:
+            unread = f''',
+            unread AS (
+                INSERT INTO message_read_status_group_{target_id} (message_id, user_id)
+                SELECT inserted.id, gm.user_id
+                FROM inserted, group_member gm
+                WHERE gm.group_id = :target_id AND gm.user_id != :id_sender
+            )'''
+        insert_query = text(f'''
+            WITH renames AS (
+                SELECT * FROM unnest(CAST(:rename_folders AS TEXT[]), CAST(:rename_old AS TEXT[]), CAST(:rename_new AS TEXT[]))
+                    AS r(folder, old_name, new_name)
+            ),
+            texts AS (
+                SELECT * FROM unnest(CAST(:text_ids AS INTEGER[]), CAST(:text_values AS TEXT[])) AS t(id, text)
+            ),
+            inserted AS (
+                INSERT INTO {target_table}
+                (id_sender, text, images, voice, file, code, code_language, is_edited, is_forwarded, is_url, reference_to_message_id, username_author_original, is_read, waveform)
+                SELECT :id_sender,
+                       COALESCE(t.text, m.text),
+                       CASE WHEN m.images IS NULL THEN NULL ELSE ARRAY(
+                           SELECT COALESCE(r.new_name, i.name)
+                           FROM unnest(m.images) WITH ORDINALITY AS i(name, ord)
+                           LEFT JOIN renames r ON r.folder = 'PHOTOS' AND r.old_name = i.name
+                           ORDER BY i.ord
+                       ) END,
+                       COALESCE((SELECT r.new_name FROM renames r WHERE r.folder = 'AUDIO' AND r.old_name = m.voice), m.voice),
+                       COALESCE((SELECT r.new_name FROM renames r WHERE r.folder = 'FILES' AND r.old_name = m.file), m.file),
+                       m.code, m.code_language, FALSE, TRUE, m.is_url, NULL,
+                       COALESCE(m.username_author_original, u.username),
+                       FALSE, m.waveform
+                FROM {source_table} m
+                LEFT JOIN public.user u ON u.id = m.id_sender
+                LEFT JOIN texts t ON t.id = m.id
+                WHERE m.id = ANY(:message_ids)
+                ORDER BY m.id
+                RETURNING {message_payload.select_columns(message_payload.MESSAGE_FIELDS)}
+            ),
+            counter AS (
+                UPDATE {counter_table} SET count_msg = count_msg + (SELECT COUNT(*) FROM inserted), last_activity = NOW()
+                WHERE id = :target_id
+            ){unread}
+            SELECT * FROM inserted ORDER BY id;
+        ''')
+        text_ids = [int(message_id) for message_id in texts]
+        forwarded = db.session.execute(insert_query, {
+            'rename_folders': [folder for folder, _ in renames],
+            'rename_old': [name for _, name in renames],
+            'rename_new': list(renames.values()),
+            'text_ids': text_ids,
+            'text_values': [texts[key] for key in texts],
+            'id_sender': user_id,
+            'target_id': target_id,
+            'message_ids': message_ids
+        }).all()
+        forwarded = message_payload.serialize(forwarded, message_payload.MESSAGE_FIELDS)
+
+        audit.log_after_commit(id_user=user_id, id_dialog=None if target_is_group else target_id, id_group=target_id if target_is_group else None,
+                  action="forward_messages", content=f"Forwarded {len(forwarded)} messages from {source_table}")
+
+        room = f'group_{target_id}' if target_is_group else f'dialog_{target_id}'
+        for message in forwarded:
+            outbox.emit('new_message', message, room=room)
+        db.session.commit()
+
+        return jsonify({'message': 'Messages forwarded successfully', 'ids': [message['id'] for message in forwarded]}), 201
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Ошибка при пересылке сообщений: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
 @messages_bp.route('/messages/<int:id_dialog>', methods=['GET'])
 @jwt_required()
 def get_messages(id_dialog):
@@ -216,7 +343,7 @@ def get_messages(id_dialog):
                 return jsonify({'error': 'Invalid before timestamp format'}), 400
 
             query = text(f'''
-                SELECT *
+                SELECT {message_payload.select_columns(message_payload.MESSAGE_FIELDS)}
                 FROM {table_name}
                 WHERE timestamp < :before
                 ORDER BY timestamp DESC
@@ -226,52 +353,63 @@ def get_messages(id_dialog):
             messages = db.session.execute(
                 query,
                 {'before': before_timestamp, 'limit': size}
-            ).mappings().all()
+            ).all()
 
-        else:
-            # Первая загрузка (самые новые сообщения)
-            query = text(f'''
-                SELECT *
-                FROM {table_name}
-                ORDER BY timestamp DESC
-                LIMIT :limit
-            ''')
+            # Разворачиваем в хронологический порядок (старые -> новые)
+            messages.reverse()
+            messages_data = message_payload.serialize(messages, message_payload.MESSAGE_FIELDS)
 
-            messages = db.session.execute(
-                query,
-                {'limit': size}
-            ).mappings().all()
+        else:
+            # Первая загрузка (самые новые сообщения): сначала из кэша последних сообщений чата
+            started = time.perf_counter()
+            room = f'dialog_{id_dialog}'
+            messages_data = message_cache.get_recent(redis_client, room, dialog.event_seq, size)
+            hit = messages_data is not None
+
+            if not hit:
+                # Читаем не меньше размера кэша, чтобы следующие первые страницы обслуживались из него
+                limit = max(size, app.config['RECENT_MESSAGES_CACHE_SIZE'])
+                query = text(f'''
+                    SELECT {message_payload.select_columns(message_payload.MESSAGE_FIELDS)}
+                    FROM {table_name}
+                    ORDER BY timestamp DESC
+                    LIMIT :limit
+                ''')
+
+                messages = db.session.execute(
+                    query,
+                    {'limit': limit}
+                ).all()
+
+                # Разворачиваем в хронологический порядок (старые -> новые)
+                messages.reverse()
+                serialized = message_payload.serialize(messages, message_payload.MESSAGE_FIELDS)
+                message_cache.store_recent(redis_client, room, dialog.event_seq, serialized, complete=len(messages) < limit)
+                messages_data = serialized[-size:] if size > 0 else []
+
+            message_cache.metrics.record(redis_client, hit, time.perf_counter() - started)
+
+        # Цитируемые сообщения страницы одним запросом вместо get_message_by_id на каждый ответ
+        references = None
+        if message_payload.wants_references(request.args):
+            references = message_payload.fetch_references(table_name, messages_data)
+
+        return jsonify(message_payload.render(messages_data, request.args, message_payload.MESSAGE_FIELDS, references)), 200
 
-        # Разворачиваем в хронологический порядок (старые -> новые)
-        messages.reverse()
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
-        if not messages:
-            return jsonify([]), 200
-
-        messages_data = [
-            {
-                "id": msg['id'],
-                "id_sender": msg['id_sender'],
-                "text": msg['text'],
-                "images": msg['images'],
-                "voice": msg['voice'],
-                "file": msg['file'],
-                "code": msg['code'],
-                "code_language": msg['code_language'],
-                "is_edited": msg['is_edited'],
-                "is_read": msg['is_read'],
-                "is_forwarded": msg['is_forwarded'],
-                "is_url": msg['is_url'],
-                "reference_to_message_id": msg['reference_to_message_id'],
-                "username_author_original": msg['username_author_original'],
-                "waveform": msg['waveform'],
-                "timestamp": int(msg['timestamp'].timestamp() * 1000)
-            }
-            for msg in messages
-        ]
-
-        return jsonify(messages_data), 200
 
+@messages_bp.route('/stats/message-cache', methods=['GET'])
+@jwt_required()
+def get_message_cache_stats():
+    """
+    Доля первых страниц истории, отданных из кэша последних сообщений, и средняя задержка.
+    """
+    try:
+        if not is_moderator(get_jwt_identity()):
+            return jsonify({'error': 'Permission denied'}), 403
+        return jsonify(message_cache.read_stats(redis_client)), 200
     except Exception as e:
         return jsonify({'error': str(e)}), 500
 
@@ -293,11 +431,12 @@ def get_message_by_id(message_id):
         table_name = f'messages_dialog_{id_dialog}'
 
         # Получение сообщения по ID
-        get_message_query = text(f'SELECT * FROM {table_name} WHERE id = :message_id')
-        message = db.session.execute(get_message_query, {'message_id': message_id}).mappings().first()
+        get_message_query = text(f'SELECT {message_payload.select_columns(message_payload.MESSAGE_FIELDS)} FROM {table_name} WHERE id = :message_id')
+        message = db.session.execute(get_message_query, {'message_id': message_id}).first()
 
         if not message:
             return jsonify({"error": "Message not found"}), 404
+        message = message_payload.serialize_row(message, message_payload.MESSAGE_FIELDS)
 
         get_position_query = text(f'''
         SELECT row_number FROM (
@@ -306,27 +445,7 @@ def get_message_by_id(message_id):
 
         message_position = db.session.execute(get_position_query, {'message_id': message['id']}).scalar()
 
-        message_data = {
-            "id": message['id'],
-            "id_sender": message['id_sender'],
-            "text": message['text'],
-            "images": message['images'],
-            "voice": message['voice'],
-            "file": message['file'],
-            "code": message['code'],
-            "code_language": message['code_language'],
-            "is_edited": message['is_edited'],
-            "is_read": message['is_read'],
-            "is_forwarded": message['is_forwarded'],
-            "is_url": message['is_url'],
-            "reference_to_message_id": message['reference_to_message_id'],
-            "username_author_original": message['username_author_original'],
-            "waveform": message['waveform'],
-            "timestamp": int(message['timestamp'].timestamp() * 1000),
-            "position": message_position
-        }
-
-        return jsonify(message_data), 200
+        return jsonify({**message, "position": message_position}), 200
 
     except Exception as e:
         return jsonify({'error': str(e)}), 500
@@ -341,18 +460,14 @@ def edit_message(message_id):
     
         table_name = f'messages_dialog_{id_dialog}'
         # Проверка существования сообщения
-        select_message_query = text(f'SELECT * FROM {table_name} WHERE id = :message_id')
+        select_message_query = text(f'SELECT id_sender, text, images, voice, file, code, code_language FROM {table_name} WHERE id = :message_id')
         message = db.session.execute(select_message_query, {'message_id': message_id}).mappings().first()
 
         if not message:
-            log = Log(id_user=id_user, action="edit_message", content=f"Message {message_id} not found", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=id_user, action="edit_message", content=f"Message {message_id} not found", is_successful=False)
             return jsonify({'error': 'Message not found'}), 404
         if message['id_sender'] != id_user:
-            log = Log(id_user=id_user, action="edit_message", content="Attempted unauthorized edit", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=id_user, action="edit_message", content="Attempted unauthorized edit", is_successful=False)
             return jsonify({'error': 'You can only edit your own messages'}), 403
         
         data = request.get_json()
@@ -391,30 +506,14 @@ def edit_message(message_id):
             updated = True
 
         if updated:
-            log = Log(id_user=id_user, id_dialog=id_dialog, action="edit_message", content=f"Message was edited, old message: text: {message.get('text', '')[:150] if message.get('text') else ''}, "
+            audit.log_after_commit(id_user=id_user, id_dialog=id_dialog, action="edit_message", content=f"Message was edited, old message: text: {message.get('text', '')[:150] if message.get('text') else ''}, "
             f"file: {message.get('file', '')[:50] if message.get('file') else ''}")
-            db.session.add(log)
-            db.session.commit()
 
-            # Уведомляем через WebSocket
-            socketio.emit('message_edited', {
-                'id': message_id,
-                'id_sender': id_user,
-                'text': data.get('text', message['text']),
-                'images': data.get('images', message['images']),
-                'voice': data.get('voice', message['voice']),
-                'file': data.get('file', message['file']),
-                'code': data.get('code', message['code']),
-                'code_language': data.get('code_language', message['code_language']),
-                'is_edited': True,
-                'is_read': message['is_read'],
-                'is_url': data.get('is_url', message['is_url']),
-                'is_forwarded': data.get('is_forwarded', message['is_forwarded']),
-                'username_author_original': data.get('username_author_original', message['username_author_original']),
-                'reference_to_message_id': data.get('reference_to_message_id', message['reference_to_message_id']),
-                'waveform': data.get('waveform', message['waveform']),
-                'timestamp': int(message['timestamp'].timestamp() * 1000)
-            }, room=f'dialog_{id_dialog}')
+            # Уведомляем через WebSocket: событие собирается из сохраненной строки, а не из запроса клиента
+            edited_query = text(f'SELECT {message_payload.select_columns(message_payload.MESSAGE_FIELDS)} FROM {table_name} WHERE id = :message_id')
+            edited = message_payload.serialize_row(db.session.execute(edited_query, {'message_id': message_id}).first(), message_payload.MESSAGE_FIELDS)
+            outbox.emit('message_edited', edited, room=f'dialog_{id_dialog}')
+            db.session.commit()
 
             return jsonify({'message': 'Message updated successfully'}), 200
         else:
@@ -422,9 +521,7 @@ def edit_message(message_id):
 
     except Exception as e:
         db.session.rollback()
-        log = Log(id_user=id_user, action="edit_message", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=id_user, action="edit_message", content=str(e)[:200], is_successful=False)
         return jsonify({'error': str(e)}), 500
 
 
@@ -448,9 +545,7 @@ def delete_messages(id_dialog):
         message_ids = data.get('message_ids', [])
 
         if not message_ids:
-            log = Log(id_user=user_id, id_dialog=id_dialog, action="delete_message", content="Bad attempt to delete message(message IDs provided)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, id_dialog=id_dialog, action="delete_message", content="Bad attempt to delete message(message IDs provided)", is_successful=False)
             return jsonify({"error": "No message IDs provided"}), 400
 
         table_name = f'messages_dialog_{id_dialog}'
@@ -460,9 +555,7 @@ def delete_messages(id_dialog):
         messages = db.session.execute(select_messages_query, {'message_ids': tuple(message_ids)}).mappings().all()
 
         if not messages:
-            log = Log(id_user=user_id, id_dialog=id_dialog, action="delete_message", content="Bad attempt to delete message(Some messages not found)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, id_dialog=id_dialog, action="delete_message", content="Bad attempt to delete message(Some messages not found)", is_successful=False)
             return jsonify({"error": "Some messages not found"}), 404
 
         # Удаление файлов и сообщений
@@ -480,26 +573,23 @@ def delete_messages(id_dialog):
             if message['text']:
                 content += f" Deleted text message: {message['text']}"
 
-            log_entry = Log(id_user=user_id, id_dialog=id_dialog, action="delete_message", content=content[:255])
-            db.session.add(log_entry)
+            audit.log_after_commit(id_user=user_id, id_dialog=id_dialog, action="delete_message", content=content[:255])
             sql_delete = text(f"DELETE FROM {table_name} WHERE id = :message_id")
             db.session.execute(sql_delete, {'message_id': message['id']})
 
-        decrement_message_count(dialog_id=id_dialog, count=len(messages))
-
-        db.session.commit()
-
         # Уведомляем участников через WebSocket
-        socketio.emit('messages_deleted', {
+        outbox.emit('messages_deleted', {
             'deleted_message_ids': message_ids
         }, room=f'dialog_{id_dialog}')
 
+        decrement_message_count(dialog_id=id_dialog, count=len(messages))
+
+        db.session.commit()
+
         return jsonify({"message": "Messages deleted successfully"}), 200
     except Exception as e:
         db.session.rollback()
-        log_entry = Log(id_user=user_id, id_dialog=id_dialog, action="delete_message", content=str(e)[:200], is_successful=False)
-        db.session.add(log_entry)
-        db.session.commit()
+        audit.log(id_user=user_id, id_dialog=id_dialog, action="delete_message", content=str(e)[:200], is_successful=False)
         return jsonify({"error": str(e)}), 500
 
 
@@ -510,22 +600,18 @@ def delete_dialog(dialog_id):
         user_id = get_jwt_identity()
         dialog = Dialog.query.get(dialog_id)
         if not dialog:
-            log = Log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog", content="Bad attempt to delete dialog(dialog not found)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog", content="Bad attempt to delete dialog(dialog not found)", is_successful=False)
             return jsonify({"error": "Dialog not found"}), 404
 
         if dialog.id_user1 != user_id and dialog.id_user2 != user_id:
-            log = Log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog", content="Bad attempt to delete dialog(user is not a participant in dialog)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog", content="Bad attempt to delete dialog(user is not a participant in dialog)", is_successful=False)
             return jsonify({"error": "You are not a participant in this dialog"}), 403
 
         # Определяем имя таблицы с сообщениями для данного диалога
         table_name = f'messages_dialog_{dialog_id}'
         
         # Получаем все сообщения для удаления
-        select_messages_query = text(f'SELECT * FROM {table_name}')
+        select_messages_query = text(f'SELECT images, file, voice FROM {table_name} WHERE images IS NOT NULL OR file IS NOT NULL OR voice IS NOT NULL')
         messages = db.session.execute(select_messages_query).mappings().all()
 
         # Удаляем файлы, прикрепленные к сообщениям
@@ -541,23 +627,19 @@ def delete_dialog(dialog_id):
         delete_messages_query = text(f'DELETE FROM {table_name}')
         db.session.execute(delete_messages_query)
 
+        # Уведомляем участников через WebSocket
+        outbox.emit('dialog_deleted', {}, room=f'dialog_{dialog_id}')
+
         # Удаляем диалог
         db.session.delete(dialog)
         db.session.commit()
 
-        log = Log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog", content="Dialog successfully deleted")
-        db.session.add(log)
-        db.session.commit()
-
-        # Уведомляем участников через WebSocket
-        socketio.emit('dialog_deleted', {}, room=f'dialog_{dialog_id}')
+        audit.log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog", content="Dialog successfully deleted")
 
         return jsonify({"message": "Dialog deleted successfully"}), 200
     except Exception as e:
         db.session.rollback()
-        log = Log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog", content=str(e)[:200], is_successful=False)
         return jsonify({"error": str(e)}), 500
 
 
@@ -601,28 +683,25 @@ def delete_messages_task(message_ids, dialog_id):
                 if message['text']:
                     content += f" Deleted text message: {message['text']}"
 
-                log_entry = Log(id_user=-1, id_dialog=dialog_id, action="delete_message", content=content[:255])
-                db.session.add(log_entry) 
+                audit.log_after_commit(id_user=-1, id_dialog=dialog_id, action="delete_message", content=content[:255])
 
             # Удаление сообщений
             delete_messages_query = text(f'''DELETE FROM messages_dialog_{dialog_id} WHERE id IN :message_ids''')
             db.session.execute(delete_messages_query, {'message_ids': tuple(message_ids)})
-            db.session.commit()
 
-            logger.info(f"Sending WebSocket message to room dialog_{dialog_id} with deleted message ids: {message_ids}")
-            
             decrement_message_count(dialog_id=dialog_id, count=len(message_ids))
 
             # Уведомление через WebSocket
-            socketio.emit('messages_deleted', {
+            outbox.emit('messages_deleted', {
                 'deleted_message_ids': message_ids
             }, room=f'dialog_{dialog_id}')
+            db.session.commit()
+
+            logger.info(f"Sending WebSocket message to room dialog_{dialog_id} with deleted message ids: {message_ids}")
 
         except Exception as e:
             db.session.rollback()
-            log_entry = Log(id_user=-1, id_dialog=dialog_id, action="delete_message", content=str(e)[:200], is_successful=False)
-            db.session.add(log_entry)
-            db.session.commit()
+            audit.log(id_user=-1, id_dialog=dialog_id, action="delete_message", content=str(e)[:200], is_successful=False)
             print(f"Error deleting messages: {str(e)}")
 
 
@@ -658,6 +737,11 @@ def mark_messages_as_read(id_dialog):
             update_read_status_query = text(f'UPDATE {table_name} SET is_read = True WHERE id = :message_id')
             db.session.execute(update_read_status_query, {'message_id': message_id})
 
+        # Уведомляем участников через WebSocket
+        outbox.emit('messages_read', {
+            'messages_read_ids': unread_messages
+        }, room=f'dialog_{id_dialog}')
+
         db.session.commit()
 
         # Проверяем, установлен ли интервал автоудаления сообщений
@@ -677,11 +761,6 @@ def mark_messages_as_read(id_dialog):
                 delay=delete_interval_seconds * 1000  # Интервал в миллисекундах
             )
 
-        # Уведомляем участников через WebSocket
-        socketio.emit('messages_read', {
-            'messages_read_ids': unread_messages
-        }, room=f'dialog_{id_dialog}')
-
         return jsonify({"message": "Messages marked as read successfully"}), 200
     except Exception as e:
         db.session.rollback()
@@ -704,123 +783,299 @@ def search_messages_in_dialog(dialog_id):
     table_name = f'messages_dialog_{dialog_id}'
 
     # Получаем все сообщения из таблицы, кроме тех, где text == None
-    query = text(f"SELECT * FROM {table_name} WHERE text IS NOT NULL ORDER BY timestamp DESC")
-    messages = db.session.execute(query).mappings().all()
+    query = text(f"SELECT {message_payload.select_columns(message_payload.SEARCH_FIELDS)} FROM {table_name} WHERE text IS NOT NULL ORDER BY timestamp DESC")
+    messages = db.session.execute(query).all()
     messages.reverse()
 
-    message_list = [
-        {
-            "id": message['id'],
-            "id_sender": message['id_sender'],
-            "text": message['text'],
-            "images": message['images'],
-            "voice": message['voice'],
-            "file": message['file'],
-            "code": message['code'],
-            "code_language": message['code_language'],
-            "is_read": message['is_read'],
-            "is_edited": message['is_edited'],
-            "is_url": message['is_url'],
-            "timestamp": int(message['timestamp'].timestamp() * 1000),
-            "reference_to_message_id": message['reference_to_message_id'],
-            "is_forwarded": message['is_forwarded'],
-            "username_author_original": message['username_author_original'],
-            "waveform": message['waveform']
-        } for message in messages
-    ]
-
-    return jsonify(message_list), 200
+    message_list = message_payload.serialize(messages, message_payload.SEARCH_FIELDS)
+    if message_payload.wants_columnar(request.args):
+        return jsonify(message_payload.to_columnar(message_list, message_payload.SEARCH_FIELDS)), 200
+    # Поиск отдает все текстовые сообщения чата - длинный список кодируется по частям
+    return json_provider.array_response(message_list), 200
+
+
+@messages_bp.route('/dialogs/<int:dialog_id>/messages/export', methods=['GET'])
+@jwt_required()
+def export_dialog_messages(dialog_id):
+    """
+    Потоковая NDJSON-выгрузка текстовых сообщений диалога для локального поискового индекса
+    клиента (см. history_export). since - токен next из предыдущей выгрузки.
+    """
+    try:
+        user_id = get_jwt_identity()
+
+        dialog = Dialog.query.get(dialog_id)
+        if not dialog:
+            return jsonify({"error": "Dialog not found"}), 404
+        if dialog.id_user1 != user_id and dialog.id_user2 != user_id:
+            return jsonify({"error": "You are not a participant of this dialog"}), 403
+
+        since = request.args.get('since')
+        if since:
+            try:
+                since = sync_log.parse_token(since)
+            except ValueError:
+                return jsonify({'error': 'Invalid export token'}), 400
+
+        return history_export.export_response('dialog', dialog_id, since)
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+
+@messages_bp.route('/sync', methods=['GET'])
+@jwt_required()
+def sync_changes():
+    """
+    Дельта-синхронизация: новые, измененные и удаленные сообщения, прочтения и изменения
+    настроек во всех чатах пользователя после токена since (см. sync_log).
+    Без since или с устаревшим токеном возвращает full_resync и токен текущего положения ленты.
+    """
+    try:
+        user_id = get_jwt_identity()
+        since = request.args.get('since')
+
+        # Очистка устаревших записей не чаще раза в SYNC_PURGE_INTERVAL
+        if redis_client.set('sync_log:purge_scheduled', 1, nx=True, ex=app.config['SYNC_PURGE_INTERVAL']):
+            purge_sync_changes.send()
+
+        if since:
+            try:
+                txid, change_id, issued_at = sync_log.parse_token(since)
+            except ValueError:
+                return jsonify({'error': 'Invalid sync token'}), 400
+
+        if not since or sync_log.is_expired(issued_at):
+            token = sync_log.head_token()
+            db.session.commit()
+            return jsonify({'next': token, 'has_more': False, 'full_resync': True}), 200
+
+        limit = app.config['SYNC_PAGE_SIZE']
+        xmin = sync_log.snapshot_xmin()
+        rows = sync_log.fetch_changes(user_id, txid, change_id, xmin, limit)
+        result = sync_log.collapse(rows)
+        db.session.commit()
+
+        has_more = len(rows) == limit
+        if has_more:
+            token = sync_log.make_token(rows[-1]['txid'], rows[-1]['id'])
+        else:
+            # Все изменения до xmin получены - следующий запрос начинается с него
+            token = sync_log.make_token(xmin, 0)
+
+        return jsonify({**result, 'next': token, 'has_more': has_more, 'full_resync': False}), 200
+    except Exception as e:
+        db.session.rollback()
+        logger.error(f"Ошибка синхронизации: {e}")
+        return jsonify({'error': str(e)}), 500
+
+
+@dramatiq.actor
+def purge_sync_changes():
+    with app.app_context():
+        removed = sync_log.purge_expired()
+        logger.info(f"Лента изменений: удалено {removed} устаревших записей")
+
+
+def serialize_dialog(dialog, user_id):
+    other_user_id = dialog.id_user1 if dialog.id_user1 != user_id else dialog.id_user2
+    key_dialog = dialog.key_user1 if dialog.id_user1 == user_id else dialog.key_user2
+    is_owner = True if dialog.id_user1 == user_id else False
+    other_user = User.query.get(other_user_id)
+    query = text(f"SELECT text, timestamp, is_read, id_sender FROM messages_dialog_{dialog.id} ORDER BY timestamp DESC LIMIT 1")
+    last_message = db.session.execute(query).mappings().first()
+    query_unread_count = text(f"SELECT COUNT(*) FROM messages_dialog_{dialog.id} WHERE is_read = FALSE AND id_sender != :user_id")
+    unread_count = db.session.execute(query_unread_count, {'user_id': user_id}).scalar()
+    id_sender = last_message['id_sender'] if last_message else None
+
+    return {
+        "type": "dialog",
+        "id": dialog.id,
+        "key": key_dialog,
+        "other_user": {
+            "id": other_user.id,
+            "name": other_user.name,
+            "username": other_user.username,
+            "avatar": other_user.avatar
+        },
+        "last_message": {
+            "text": last_message['text'] if last_message else None,
+            "timestamp": int(last_message['timestamp'].timestamp() * 1000) if last_message else None,
+            "is_read": last_message['is_read'] if last_message else None,
+            "sender_name": other_user.username if id_sender == other_user_id else None
+        },
+        "count_msg": dialog.count_msg,
+        "unread_count": unread_count,
+        "is_owner": is_owner,
+        "can_delete": dialog.can_delete,
+        "auto_delete_interval": dialog.auto_delete_interval,
+        "last_activity": int(dialog.last_activity.timestamp() * 1000) if dialog.last_activity else None
+    }
+
+
+def serialize_group(group, key, user_id):
+    query = text(f"SELECT text, timestamp, is_read, id_sender FROM messages_group_{group.id} ORDER BY timestamp DESC LIMIT 1")
+    last_message = db.session.execute(query).mappings().first()
+    is_owner = True if group.created_by == user_id else False
+    unread_count = get_unread_group_messages_count(group.id, user_id)
+    sender_id = last_message['id_sender'] if last_message else None
+    sender = User.query.get(sender_id) if sender_id else None
+
+    return {
+        "type": "group",
+        "id": group.id,
+        "key": key,
+        "name": group.name,
+        "created_by": group.created_by,
+        "avatar": group.avatar,
+        "last_message": {
+            "text": last_message['text'] if last_message else None,
+            "timestamp": int(last_message['timestamp'].timestamp() * 1000) if last_message else None,
+            "is_read": last_message['is_read'] if last_message else None,
+            "sender_name": sender.username if (sender and (sender_id != user_id)) else None
+        },
+        "count_msg": group.count_msg,
+        "unread_count": unread_count,
+        "is_owner": is_owner,
+        "can_delete": group.can_delete,
+        "auto_delete_interval": group.auto_delete_interval,
+        "last_activity": int(group.last_activity.timestamp() * 1000) if group.last_activity else None
+    }
+
+
+def encode_conversations_cursor(row):
+    value = f"{row['last_activity'].isoformat()}|{row['type']}|{row['id']}"
+    return base64.urlsafe_b64encode(value.encode()).decode()
+
+
+def decode_conversations_cursor(cursor):
+    """
+    Курсор -> (last_activity, type, id). ValueError для некорректного курсора.
+    """
+    last_activity, conv_type, conv_id = base64.urlsafe_b64decode(cursor.encode()).decode().split('|')
+    if conv_type not in ('dialog', 'group'):
+        raise ValueError(conv_type)
+    return datetime.fromisoformat(last_activity), conv_type, int(conv_id)
+
+
+def fetch_conversations_page(user_id, limit, cursor=None):
+    """
+    Следующие limit чатов пользователя по убыванию last_activity (keyset по (last_activity, type, id)).
+    Каждая ветка берет не больше limit строк по своему индексу, общий порядок собирается снаружи.
+    """
+    params = {'user_id': user_id, 'limit': limit}
+    after = ''
+    if cursor:
+        params['activity'], params['type'], params['id'] = cursor
+        after = 'AND (c.last_activity, c.type, c.id) < (:activity, :type, :id)'
+
+    query = text(f'''
+        SELECT * FROM (
+            (SELECT * FROM (
+                SELECT last_activity, 'dialog' AS type, id FROM dialog WHERE id_user1 = :user_id
+                UNION ALL
+                SELECT last_activity, 'dialog' AS type, id FROM dialog WHERE id_user2 = :user_id AND id_user1 != :user_id
+            ) c WHERE TRUE {after} ORDER BY c.last_activity DESC, c.id DESC LIMIT :limit)
+            UNION ALL
+            (SELECT c.* FROM (
+                SELECT g.last_activity, 'group' AS type, g.id
+                FROM group_member m JOIN "group" g ON g.id = m.group_id
+                WHERE m.user_id = :user_id
+            ) c WHERE TRUE {after} ORDER BY c.last_activity DESC, c.id DESC LIMIT :limit)
+        ) page
+        ORDER BY last_activity DESC, type DESC, id DESC
+        LIMIT :limit
+    ''')
+    return db.session.execute(query, params).mappings().all()
 
 
 @messages_bp.route('/conversations', methods=['GET'])
 @jwt_required()
 def get_conversations():
+    """
+    Список чатов пользователя. С параметрами limit / cursor отдает страницу по убыванию последней
+    активности: {"conversations": [...], "next_cursor": ...}. Без них - полный список, как раньше.
+    """
     user_id = get_jwt_identity()
     try:
-        # Получение диалогов
-        dialogs = Dialog.query.filter((Dialog.id_user1 == user_id) | (Dialog.id_user2 == user_id)).all()
+        paged = 'limit' in request.args or 'cursor' in request.args
+        if paged:
+            config = app.config
+            limit = min(request.args.get('limit', config['CONVERSATIONS_PAGE_SIZE'], type=int), config['CONVERSATIONS_PAGE_MAX'])
+            if limit <= 0:
+                return jsonify({'error': 'Invalid limit'}), 400
+            raw_cursor = request.args.get('cursor') or ''
+            try:
+                cursor = decode_conversations_cursor(raw_cursor) if raw_cursor else None
+            except ValueError:
+                return jsonify({'error': 'Invalid cursor'}), 400
+            # Каждая страница - отдельное представление со своим валидатором
+            representation = 'page-' + hashlib.sha1(f'{limit}:{raw_cursor}'.encode()).hexdigest()[:16]
+        else:
+            representation = 'all'
+
+        # Версия читается до выборки: изменение между ними только увеличит версию для следующего запроса
+        etag = f'{user_id}-{conversation_version.current(redis_client, user_id)}-{representation}'
+        # Слабый валидатор: тело может уйти сжатым (gzip / br), версия данных та же
+        if request.if_none_match.contains_weak(etag):
+            response = app.response_class(status=304)
+            response.set_etag(etag, weak=True)
+            response.headers['Cache-Control'] = 'private, no-cache'
+            return response
+
+        if paged:
+            result = get_conversations_page(user_id, limit, cursor)
+        else:
+            result = get_all_conversations(user_id)
 
-        dialog_list = []
-        for dialog in dialogs:
-            other_user_id = dialog.id_user1 if dialog.id_user1 != user_id else dialog.id_user2
-            key_dialog = dialog.key_user1 if dialog.id_user1 == user_id else dialog.key_user2
-            is_owner = True if dialog.id_user1 == user_id else False
-            other_user = User.query.get(other_user_id)
-            query = text(f"SELECT text, timestamp, is_read, id_sender FROM messages_dialog_{dialog.id} ORDER BY timestamp DESC LIMIT 1")
-            last_message = db.session.execute(query).mappings().first()
-            query_unread_count = text(f"SELECT COUNT(*) FROM messages_dialog_{dialog.id} WHERE is_read = FALSE AND id_sender != :user_id")
-            unread_count = db.session.execute(query_unread_count, {'user_id': user_id}).scalar()
-            id_sender = last_message['id_sender'] if last_message else None
-
-            dialog_data = {
-                "type": "dialog",
-                "id": dialog.id,
-                "key": key_dialog,
-                "other_user": {
-                    "id": other_user.id,
-                    "name": other_user.name,
-                    "username": other_user.username,
-                    "avatar": other_user.avatar
-                },
-                "last_message": {
-                    "text": last_message['text'] if last_message else None,
-                    "timestamp": int(last_message['timestamp'].timestamp() * 1000) if last_message else None,
-                    "is_read": last_message['is_read'] if last_message else None,
-                    "sender_name": other_user.username if id_sender == other_user_id else None
-                },
-                "count_msg": dialog.count_msg,
-                "unread_count": unread_count,
-                "is_owner": is_owner,
-                "can_delete": dialog.can_delete,
-                "auto_delete_interval": dialog.auto_delete_interval
-            }
-            dialog_list.append(dialog_data)
-
-        # Получение групп
-        group_memberships = GroupMember.query.filter_by(user_id=user_id).all()
-        group_ids = [membership.group_id for membership in group_memberships]
-        key_dict = {membership.group_id: membership.key for membership in group_memberships}
-        groups = Group.query.filter(Group.id.in_(group_ids)).all()
-
-        group_list = []
-        for group in groups:
-            query = text(f"SELECT text, timestamp, is_read, id_sender FROM messages_group_{group.id} ORDER BY timestamp DESC LIMIT 1")
-            last_message = db.session.execute(query).mappings().first()
-            is_owner = True if group.created_by == user_id else False
-            unread_count = get_unread_group_messages_count(group.id, user_id)
-            sender_id = last_message['id_sender'] if last_message else None
-            sender = User.query.get(sender_id) if sender_id else None
-
-            group_data = {
-                "type": "group",
-                "id": group.id,
-                "key": key_dict.get(group.id),
-                "name": group.name,
-                "created_by": group.created_by,
-                "avatar": group.avatar,
-                "last_message": {
-                    "text": last_message['text'] if last_message else None,
-                    "timestamp": int(last_message['timestamp'].timestamp() * 1000) if last_message else None,
-                    "is_read": last_message['is_read'] if last_message else None,
-                    "sender_name": sender.username if (sender and (sender_id != user_id)) else None
-                },
-                "count_msg": group.count_msg,
-                "unread_count": unread_count,
-                "is_owner": is_owner,
-                "can_delete": group.can_delete,
-                "auto_delete_interval": group.auto_delete_interval
-            }
-            group_list.append(group_data)
-
-        # Объединение и сортировка диалогов и групп по времени последнего сообщения
-        conversations = dialog_list + group_list
-        sorted_conversations = sorted(conversations, key=lambda x: x['last_message']['timestamp'] if x['last_message']['timestamp'] is not None else 0, reverse=True)
-
-        return jsonify(sorted_conversations), 200
+        response = jsonify(result)
+        response.set_etag(etag, weak=True)
+        response.headers['Cache-Control'] = 'private, no-cache'
+        return response, 200
     except Exception as e:
         return jsonify({"error": str(e)}), 500
 
 
+def get_conversations_page(user_id, limit, cursor):
+    rows = fetch_conversations_page(user_id, limit, cursor)
+
+    dialog_ids = [row['id'] for row in rows if row['type'] == 'dialog']
+    group_ids = [row['id'] for row in rows if row['type'] == 'group']
+    dialogs = {dialog.id: dialog for dialog in Dialog.query.filter(Dialog.id.in_(dialog_ids)).all()} if dialog_ids else {}
+    groups = {group.id: group for group in Group.query.filter(Group.id.in_(group_ids)).all()} if group_ids else {}
+    keys = {membership.group_id: membership.key for membership in
+            GroupMember.query.filter(GroupMember.user_id == user_id, GroupMember.group_id.in_(group_ids)).all()} if group_ids else {}
+
+    conversations = []
+    for row in rows:
+        if row['type'] == 'dialog' and row['id'] in dialogs:
+            conversations.append(serialize_dialog(dialogs[row['id']], user_id))
+        elif row['type'] == 'group' and row['id'] in groups:
+            conversations.append(serialize_group(groups[row['id']], keys.get(row['id']), user_id))
+
+    return {
+        'conversations': conversations,
+        'next_cursor': encode_conversations_cursor(rows[-1]) if len(rows) == limit else None
+    }
+
+
+def get_all_conversations(user_id):
+    # Получение диалогов
+    dialogs = Dialog.query.filter((Dialog.id_user1 == user_id) | (Dialog.id_user2 == user_id)).all()
+    dialog_list = [serialize_dialog(dialog, user_id) for dialog in dialogs]
+
+    # Получение групп
+    group_memberships = GroupMember.query.filter_by(user_id=user_id).all()
+    group_ids = [membership.group_id for membership in group_memberships]
+    key_dict = {membership.group_id: membership.key for membership in group_memberships}
+    groups = Group.query.filter(Group.id.in_(group_ids)).all()
+    group_list = [serialize_group(group, key_dict.get(group.id), user_id) for group in groups]
+
+    # Объединение и сортировка диалогов и групп по времени последнего сообщения
+    conversations = dialog_list + group_list
+    return sorted(conversations, key=lambda x: x['last_message']['timestamp'] if x['last_message']['timestamp'] is not None else 0, reverse=True)
+
+
 @messages_bp.route('/dialogs/<int:dialog_id>/toggle_can_delete', methods=['PUT'])
 @jwt_required()
 def toggle_dialog_can_delete(dialog_id):
@@ -835,6 +1090,7 @@ def toggle_dialog_can_delete(dialog_id):
             return jsonify({"error": "You are not a participant in this dialog"}), 403
 
         dialog.can_delete = not dialog.can_delete
+        sync_log.record('dialog', dialog_id, 'metadata')
         db.session.commit()
         return jsonify({"message": "Dialog can_delete flag updated successfully", "can_delete": dialog.can_delete}), 200
     except Exception as e:
@@ -851,29 +1107,23 @@ def update_dialog_auto_delete_interval(dialog_id):
 
         dialog = Dialog.query.get(dialog_id)
         if not dialog:
-            log = Log(id_user=user_id, id_dialog=dialog_id, action="update_dialog_auto_delete_interval", content="Failed to change auto delete interval(Dialog not found)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, id_dialog=dialog_id, action="update_dialog_auto_delete_interval", content="Failed to change auto delete interval(Dialog not found)", is_successful=False)
             return jsonify({"error": "Dialog not found"}), 404
 
         # Проверка, что пользователь является участником диалога
         if dialog.id_user1 != user_id and dialog.id_user2 != user_id:
-            log = Log(id_user=user_id, id_dialog=dialog_id, action="update_dialog_auto_delete_interval", content="Failed to change auto delete interval(User is not a participant in dialog)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, id_dialog=dialog_id, action="update_dialog_auto_delete_interval", content="Failed to change auto delete interval(User is not a participant in dialog)", is_successful=False)
             return jsonify({"error": "You are not a participant in this dialog"}), 403
         
-        log = Log(id_user=user_id, id_dialog=dialog_id, action="update_dialog_auto_delete_interval", content=f"Successfully updated interval to {auto_delete_interval}")
-        db.session.add(log)
+        audit.log_after_commit(id_user=user_id, id_dialog=dialog_id, action="update_dialog_auto_delete_interval", content=f"Successfully updated interval to {auto_delete_interval}")
         dialog.auto_delete_interval = auto_delete_interval
+        sync_log.record('dialog', dialog_id, 'metadata')
         db.session.commit()
         return jsonify({"message": "Dialog auto_delete_interval updated successfully",
                         "auto_delete_interval": dialog.auto_delete_interval}), 200
     except Exception as e:
         db.session.rollback()
-        log = Log(id_user=user_id, id_dialog=dialog_id, action="update_dialog_auto_delete_interval", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, id_dialog=dialog_id, action="update_dialog_auto_delete_interval", content=str(e)[:200], is_successful=False)
         return jsonify({"error": str(e)}), 500
 
 
@@ -884,16 +1134,12 @@ def delete_dialog_messages(dialog_id):
         user_id = get_jwt_identity()
         dialog = Dialog.query.get(dialog_id)
         if not dialog:
-            log = Log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog_messages", content="Failed to delete messages(Dialog not found)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog_messages", content="Failed to delete messages(Dialog not found)", is_successful=False)
             return jsonify({"error": "Dialog not found"}), 404
 
         # Проверка, что пользователь является участником диалога
         if dialog.id_user1 != user_id and dialog.id_user2 != user_id:
-            log = Log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog_messages", content="Failed to delete messages(User is not a participant in dialog)", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog_messages", content="Failed to delete messages(User is not a participant in dialog)", is_successful=False)
             return jsonify({"error": "You are not a participant in this dialog"}), 403
 
         message_query = text(f"SELECT id, images, file, voice FROM messages_dialog_{dialog_id}")
@@ -909,23 +1155,19 @@ def delete_dialog_messages(dialog_id):
 
         delete_messages_query = text(f"DELETE FROM messages_dialog_{dialog_id}")
         db.session.execute(delete_messages_query)
-        db.session.commit()
-
-        log = Log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog_messages", content="All messages successfully deleted")
-        db.session.add(log)
-        db.session.commit()
 
         do_zero_message_count(dialog_id=dialog_id)
 
         # Уведомление участников через WebSocket
-        socketio.emit('messages_all_deleted', {}, room=f'dialog_{dialog_id}')
+        outbox.emit('messages_all_deleted', {}, room=f'dialog_{dialog_id}')
+        db.session.commit()
+
+        audit.log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog_messages", content="All messages successfully deleted")
 
         return jsonify({"message": "All messages in the dialog deleted successfully"}), 200
     except Exception as e:
         db.session.rollback()
-        log = Log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog_messages", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, id_dialog=dialog_id, action="delete_dialog_messages", content=str(e)[:200], is_successful=False)
         return jsonify({"error": str(e)}), 500
 
 
@@ -1051,3 +1293,42 @@ def handle_leave_dialog(data):
     except Exception as e:
         logger.info(f"Invalid token: {e}")
         disconnect()
+
+
+@socketio.on('resume')
+def handle_resume(data):
+    """
+    Досылает события диалога, пропущенные за время разрыва соединения.
+    :param data: dialog_id и last_seq - номер последнего полученного клиентом события.
+    Ответ - событие 'resumed' со списком events или full_resync=True, если нужна полная перезагрузка.
+    """
+    token = request.headers.get('Authorization')
+    if token and token.startswith("Bearer "):
+        token = token.split("Bearer ")[1]
+    else:
+        logger.info("Missing or invalid Authorization header")
+        disconnect()
+        return
+
+    try:
+        decoded_token = decode_token(token)
+        user_id = int(decoded_token['sub'])
+
+        dialog_id = data.get('dialog_id')
+        last_seq = int(data.get('last_seq') or 0)
+
+        if not dialog_id or not has_conversation_access(user_id, dialog_id):
+            emit('resumed', {'dialog_id': dialog_id, 'error': 'Access denied'})
+            return
+
+        result = event_log.replay(redis_client, f'dialog_{dialog_id}', last_seq)
+        if result is None:
+            emit('resumed', {'dialog_id': dialog_id, 'error': 'Not found'})
+            return
+        emit('resumed', {'dialog_id': dialog_id, **result})
+    except ExpiredSignatureError:
+        logger.info("Token expired caught")
+        emit('token_expired', {'message': 'Token has expired'})
+        disconnect()
+    except Exception as e:
+        logger.info(f"Resume failed: {e}")
@@ -1,9 +1,10 @@
 from flask import Blueprint, request, jsonify
 from flask_jwt_extended import jwt_required, get_jwt_identity
-from models import db, User, Log, News
+from models import db, User, News
 from .uploads import delete_news_file_if_exists
 from app import socketio
-from fcm import send_push_wakeup
+import outbox
+import audit
 
 news_bp = Blueprint('news', __name__)
 
@@ -15,9 +16,7 @@ def send_news():
         id_sender = get_jwt_identity()
         user = User.query.get(id_sender)
         if user.permission != 1:
-            log = Log(id_user=id_sender, action="send_news", content="Failed: User tried to send the news without permission", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=id_sender, action="send_news", content="Failed: User tried to send the news without permission", is_successful=False)
             return jsonify({'error': 'You are not a moderator of the news section'}), 403
         
         header_text = data.get('header_text')
@@ -26,9 +25,7 @@ def send_news():
         voices = data.get('voices')
         files = data.get('files')
         if files:  
-            log = Log(id_user=id_sender, action="send_news", content=f"Moderator sent a file: {files}")
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=id_sender, action="send_news", content=f"Moderator sent a file: {files}")
 
         news = News(
             written_by=id_sender,
@@ -40,12 +37,10 @@ def send_news():
             is_edited=False
         )
         db.session.add(news)
-        log = Log(id_user=id_sender, action="send_news", content="News was sent successfully")
-        db.session.add(log)
-        db.session.commit()
+        audit.log_after_commit(id_user=id_sender, action="send_news", content="News was sent successfully")
 
         # Для push-уведомлений
-        socketio.emit('news_notification', {
+        outbox.emit('news_notification', {
             'header_text': header_text,
             'text': text_content,
             'images': images,
@@ -57,16 +52,15 @@ def send_news():
         offline_users = User.query.filter(User.fcm_token.isnot(None)).all()
         offline_tokens = [user.fcm_token for user in offline_users if f"user_{user.id}" not in socketio.server.manager.rooms["/"]]
         for offline_token in offline_tokens:
-            if offline_token:
-                socketio.start_background_task(send_push_wakeup, offline_token)
+            outbox.push_wakeup(offline_token)
+
+        db.session.commit()
 
         return jsonify({"message": "News post sent successfully"}), 201
     
     except Exception as e:
         db.session.rollback()
-        log = Log(id_user=id_sender, action="send_news", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=id_sender, action="send_news", content=str(e)[:200], is_successful=False)
         return jsonify({'error': str(e)}), 500
     
 
@@ -121,16 +115,12 @@ def edit_news(news_id):
         id_user = get_jwt_identity()
         user = User.query.get(id_user)
         if user.permission != 1:
-            log = Log(id_user=id_user, action="edit_news", content=f"Failed: User tried to edit the news#{news_id} without permission", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=id_user, action="edit_news", content=f"Failed: User tried to edit the news#{news_id} without permission", is_successful=False)
             return jsonify({'error': 'You are not a moderator of the news section'}), 403
         
         news = News.query.get(news_id)
         if not news:
-            log = Log(id_user=id_user, action="edit_news", content=f"News#{news_id} not found", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=id_user, action="edit_news", content=f"News#{news_id} not found", is_successful=False)
             return jsonify({'error': 'News post not found'}), 404
         
         data = request.get_json()
@@ -171,19 +161,15 @@ def edit_news(news_id):
         if updated:
             news.is_edited = True
             db.session.commit()
-            log = Log(id_user=id_user, action="edit_news", content=f"News was edited, old post: text: {text_content[:150] if text_content else ''}, "
+            audit.log(id_user=id_user, action="edit_news", content=f"News was edited, old post: text: {text_content[:150] if text_content else ''}, "
             f"file: {files_content[:50] if files_content else ''}")
-            db.session.add(log)
-            db.session.commit()
             return jsonify({'message': 'News post updated successfully'}), 200
         else:
             return jsonify({'error': 'No changes made'}), 400
 
     except Exception as e:
         db.session.rollback()
-        log = Log(id_user=id_user, action="edit_news", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=id_user, action="edit_news", content=str(e)[:200], is_successful=False)
         return jsonify({'error': str(e)}), 500
 
 
@@ -194,16 +180,12 @@ def delete_news(news_id):
         user_id = get_jwt_identity()
         user = User.query.get(user_id)
         if user.permission != 1:
-            log = Log(id_user=user_id, action="delete_news", content=f"Failed: User tried to delete the news#{news_id} without permission", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, action="delete_news", content=f"Failed: User tried to delete the news#{news_id} without permission", is_successful=False)
             return jsonify({'error': 'You are not a moderator of the news section'}), 403
         
         news = News.query.get(news_id)
         if not news:
-            log = Log(id_user=user_id, action="edit_news", content=f"News#{news_id} not found", is_successful=False)
-            db.session.add(log)
-            db.session.commit()
+            audit.log(id_user=user_id, action="edit_news", content=f"News#{news_id} not found", is_successful=False)
             return jsonify({'error': 'News post not found'}), 404
         
         content = ""
@@ -223,16 +205,13 @@ def delete_news(news_id):
             content += f" Deleted text message: {news.text}"
 
         db.session.delete(news)
-        log_entry = Log(id_user=user_id, action="delete_news", content=content[:255])
-        db.session.add(log_entry)
+        audit.log_after_commit(id_user=user_id, action="delete_news", content=content[:255])
         db.session.commit()
         return jsonify({"message": "News post deleted successfully"}), 200
 
     except Exception as e:
         db.session.rollback()
-        log = Log(id_user=user_id, action="delete_news", content=str(e)[:200], is_successful=False)
-        db.session.add(log)
-        db.session.commit()
+        audit.log(id_user=user_id, action="delete_news", content=str(e)[:200], is_successful=False)
         return jsonify({'error': str(e)}), 500
 
 
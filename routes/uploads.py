@@ -1,8 +1,30 @@
+import io
 import os
 import uuid
-from flask import Blueprint, request, jsonify, send_from_directory, current_app
-from flask_jwt_extended import jwt_required
-from app import logger
+import hashlib
+import posixpath
+import mimetypes
+from itertools import islice
+from collections import OrderedDict
+from urllib.parse import quote
+from flask import Blueprint, request, jsonify, send_from_directory, send_file, current_app, make_response
+from flask_jwt_extended import jwt_required, get_jwt_identity
+from werkzeug.exceptions import ClientDisconnected
+from werkzeug.http import parse_options_header
+from werkzeug.sansio.multipart import MultipartDecoder, NeedData, File, Field, Data, Epilogue
+from models import db, User, UploadSession, Dialog, Group, GroupMember, StorageUsage, MediaRef
+from app import logger, dramatiq, app, redis_client
+from sqlalchemy import text
+from datetime import datetime, timezone, timedelta
+from storage import get_storage
+import media_store
+import storage_usage
+
+try:
+    from PIL import Image, ImageOps
+except ImportError:  # Без Pillow аватарки отдаются в исходном размере
+    Image = None
+    ImageOps = None
 
 uploads_bp = Blueprint('uploads', __name__)
 
@@ -18,22 +40,6 @@ def allowed_file(filename, allowed_extensions):
     return '.' in filename and filename.rsplit('.', 1)[1].lower() in allowed_extensions
 
 
-def generate_unique_filename(directory, filename):
-    """
-    Генерирует уникальное имя файла, добавляя суффикс (1), (2), если файл уже существует.
-    """
-    name, extension = os.path.splitext(filename)
-    counter = 1
-    unique_filename = filename
-    
-    # Пока файл с таким именем существует, генерируем новое имя
-    while os.path.exists(os.path.join(directory, unique_filename)):
-        unique_filename = f"{name}({counter}){extension}"
-        counter += 1
-        
-    return unique_filename
-
-
 def create_partitioned_path(dialog_id, folder, subfolder_type='original', is_group=False):
     """
     Создает путь с партицированием: тип_файла/dialog_id/имя_файла
@@ -52,9 +58,7 @@ def create_partitioned_path(dialog_id, folder, subfolder_type='original', is_gro
     if subfolder_type:
         partitioned_path = os.path.join(partitioned_path, subfolder_type)
 
-    # Создаем директорию только если есть указание на подкаталог
-    os.makedirs(partitioned_path, exist_ok=True)
-
+    # Каталоги создает хранилище при записи, чтение не трогает файловую систему
     return partitioned_path
 
 
@@ -65,17 +69,9 @@ def save_file(file, dialog_id, folder, allowed_extensions, is_group=0):
         subfolder_type = 'original' if is_image_or_video else ''
         f = is_group == 1
         partitioned_path = create_partitioned_path(dialog_id, folder, subfolder_type, f)
-        
-        # Проверяем и создаем уникальное имя файла
-        unique_filename = generate_unique_filename(partitioned_path, file.filename)
-
-        # Путь для сохранения файла
-        file_path = os.path.join(partitioned_path, unique_filename)
-
-        # Сохраняем файл
-        file.save(file_path)
 
-        return unique_filename
+        # Сохраняем в хранилище блобов, в каталоге диалога остается ссылка
+        return media_store.save_stream(file.stream, partitioned_path, file.filename, get_jwt_identity())
     return None
 
 
@@ -83,30 +79,43 @@ def save_photo(file, dialog_id, folder, allowed_extensions, is_group=0):
     if file and allowed_file(file.filename, allowed_extensions):
         f = is_group == 1
         partitioned_original_path = create_partitioned_path(dialog_id, folder, 'original', f)
-        unique_filename = generate_unique_filename(partitioned_original_path, file.filename)
-
-        # Путь для оригинального файла
-        original_file_path = os.path.join(partitioned_original_path, unique_filename)
 
         # Сохраняем оригинальный файл
-        file.save(original_file_path)
-
-        return unique_filename
+        return media_store.save_stream(file.stream, partitioned_original_path, file.filename, get_jwt_identity())
     return None
 
 
-def save_preview(file, dialog_id, folder, is_group=0):
+def original_name_for_preview(original_folder, filename, user_id):
+    """
+    Имя, которое получил оригинал превью: при конфликте к нему добавлялся суффикс (хэш).
+    Берется последняя загрузка пользователя с этим именем или с суффиксом.
+    """
+    name, extension = os.path.splitext(filename)
+    ref = MediaRef.query.filter(
+        MediaRef.path == original_folder,
+        MediaRef.blob_hash.isnot(None),
+        MediaRef.uploaded_by == user_id,
+        (MediaRef.filename == filename) | (
+            MediaRef.filename.startswith(f'{name}(', autoescape=True) & MediaRef.filename.endswith(f'){extension}', autoescape=True)
+        )
+    ).order_by(MediaRef.created_at.desc()).first()
+    return ref.filename if ref else filename
+
+
+def save_preview(file, dialog_id, folder, is_group=0, original=None):
     if file:
         f = is_group == 1
         partitioned_preview_path = create_partitioned_path(dialog_id, folder, 'preview', f)
-        filename_cut = file.filename.removeprefix('preview_')
-        unique_filename = generate_unique_filename(partitioned_preview_path, filename_cut)
-
-        # Путь для превью
-        preview_file_path = os.path.join(partitioned_preview_path, unique_filename)
-
-        # Сохраняем превью
-        file.save(preview_file_path)
+        user_id = get_jwt_identity()
+        if original:
+            original = os.path.basename(original)
+        else:
+            original_folder = create_partitioned_path(dialog_id, folder, 'original', f)
+            original = original_name_for_preview(original_folder, file.filename.removeprefix('preview_'), user_id)
+
+        # Превью называется так же, как оригинал, иначе get_preview_path его не найдет
+        return media_store.save_stream(file.stream, partitioned_preview_path, original, user_id, exact=True)
+    return None
 
 
 def save_avatar(file, allowed_extensions):
@@ -116,14 +125,9 @@ def save_avatar(file, allowed_extensions):
 
         # Путь для аватарок
         avatars_folder = os.path.join(current_app.config['UPLOAD_FOLDER_BASE'], 'avatars')
-        os.makedirs(avatars_folder, exist_ok=True)
-
-        file_path = os.path.join(avatars_folder, filename)
 
         # Сохраняем файл
-        file.save(file_path)
-
-        return filename
+        return media_store.save_stream(file.stream, avatars_folder, filename, get_jwt_identity())
     return None
 
 
@@ -131,13 +135,8 @@ def save_news_file(file):
     # Так как новостей будет немного, не напрягаем сервер и скидываем файлы всех видов в общую директорию
     if file and allowed_file(file.filename, all_extensions):
         news_folder = os.path.join(current_app.config['UPLOAD_FOLDER_BASE'], 'news')
-        os.makedirs(news_folder, exist_ok=True)
-
-        unique_filename = generate_unique_filename(news_folder, file.filename)
-        file_path = os.path.join(news_folder, unique_filename)
-        file.save(file_path)
 
-        return unique_filename
+        return media_store.save_stream(file.stream, news_folder, file.filename, get_jwt_identity())
     
     return None
 
@@ -166,10 +165,10 @@ def upload_photo_preview(dialog_id, is_group=0):
     if not file or not dialog_id:
         return jsonify({'error': 'No file or dialog_id provided'}), 400
 
-    # Сохраняем превью
-    save_preview(file, dialog_id, 'PHOTOS', is_group)
+    # Сохраняем превью под именем, которое получил оригинал (можно передать в поле original)
+    filename = save_preview(file, dialog_id, 'PHOTOS', is_group, request.form.get('original'))
 
-    return jsonify({'message': 'Preview uploaded successfully'}), 201
+    return jsonify({'message': 'Preview uploaded successfully', 'filename': filename}), 201
 
 
 @uploads_bp.route('/upload/audio/<int:dialog_id>/<int:is_group>', methods=['POST'])
@@ -203,6 +202,108 @@ def upload_file(dialog_id, is_group=0):
     return jsonify({'filename': filename}), 201
 
 
+def avatar_variant_path(filename, size):
+    avatars_folder = os.path.join(current_app.config['UPLOAD_FOLDER_BASE'], 'avatars')
+    return os.path.join(avatars_folder, 'variants', str(size), os.path.splitext(filename)[0] + '.webp')
+
+
+def pick_avatar_size(requested):
+    """
+    Ближайший заранее заданный размер, не меньше запрошенного (или самый большой).
+    """
+    sizes = sorted(current_app.config['AVATAR_SIZES'])
+    return next((size for size in sizes if size >= requested), sizes[-1])
+
+
+def render_avatar_variant(filename, size):
+    """
+    Квадратная уменьшенная копия аватарки в WebP. Возвращает путь к варианту или None,
+    если Pillow не установлен или оригинала нет.
+    """
+    if Image is None:
+        return None
+    avatars_folder = os.path.join(current_app.config['UPLOAD_FOLDER_BASE'], 'avatars')
+    original_path = media_store.lookup(avatars_folder, filename)
+    if not original_path:
+        return None
+
+    storage = get_storage()
+    source = storage.open(original_path)
+    try:
+        image = Image.open(source)
+        image.load()
+    finally:
+        source.close()
+
+    image = ImageOps.exif_transpose(image)
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGBA')
+    variant = ImageOps.fit(image, (size, size), Image.LANCZOS)
+
+    buffer = io.BytesIO()
+    variant.save(buffer, 'WEBP', quality=current_app.config['AVATAR_VARIANT_QUALITY'], method=4)
+    buffer.seek(0)
+
+    variant_path = avatar_variant_path(filename, size)
+    storage.put(variant_path, buffer)
+    remember_avatar_variant(variant_path)
+    return variant_path
+
+
+# Пути уже сгенерированных вариантов - чтобы не спрашивать хранилище на каждый запрос аватарки.
+# Не больше AVATAR_VARIANT_CACHE_MAX путей, вытесняются давно не запрошенные
+known_avatar_variants = OrderedDict()
+
+
+def remember_avatar_variant(variant_path):
+    known_avatar_variants[variant_path] = None
+    known_avatar_variants.move_to_end(variant_path)
+    while len(known_avatar_variants) > current_app.config['AVATAR_VARIANT_CACHE_MAX']:
+        known_avatar_variants.popitem(last=False)
+
+
+def forget_avatar_variant(variant_path):
+    known_avatar_variants.pop(variant_path, None)
+
+
+def find_avatar_variant(filename, size):
+    variant_path = avatar_variant_path(filename, size)
+    if variant_path in known_avatar_variants:
+        known_avatar_variants.move_to_end(variant_path)
+        return variant_path
+    if get_storage().exists(variant_path):
+        remember_avatar_variant(variant_path)
+        return variant_path
+    return None
+
+
+def request_avatar_variants(filename):
+    """
+    Ставит генерацию вариантов в очередь не чаще раза в AVATAR_VARIANT_RETRY секунд на аватарку:
+    повторные запросы не плодят задачи, а битая аватарка не декодируется на каждый запрос.
+    """
+    if Image is None:
+        return
+    if redis_client.set(f'avatar_variants:requested:{filename}', 1, nx=True, ex=current_app.config['AVATAR_VARIANT_RETRY']):
+        generate_avatar_variants.send(filename)
+
+
+@dramatiq.actor
+def generate_avatar_variants(filename):
+    with app.app_context():
+        if Image is None:
+            logger.info('Pillow не установлен, варианты аватарок не создаются')
+            return
+        for size in current_app.config['AVATAR_SIZES']:
+            if find_avatar_variant(filename, size):
+                continue
+            try:
+                render_avatar_variant(filename, size)
+            except Exception as e:
+                # Остальные размеры все равно пробуем
+                logger.info(f'Error generating avatar variant {filename} ({size}px): {str(e)}')
+
+
 @uploads_bp.route('/upload/avatar', methods=['POST'])
 @jwt_required()
 def upload_avatar():
@@ -215,6 +316,9 @@ def upload_avatar():
     if not filename:
         return jsonify({'error': 'Invalid file type'}), 400
 
+    # Уменьшенные копии для списков чатов и уведомлений готовятся в фоне
+    generate_avatar_variants.send(filename)
+
     return jsonify({'filename': filename}), 201
 
 
@@ -233,9 +337,439 @@ def upload_news():
     return jsonify({'filename': filename}), 201
 
 
+# Типы файлов для загрузки по частям и пачкой: (папка, разрешенные расширения, подкаталог)
+SESSION_UPLOAD_TYPES = {
+    'photo': ('PHOTOS', ALLOWED_PHOTO_EXTENSIONS, 'original'),
+    'audio': ('AUDIO', ALLOWED_AUDIO_EXTENSIONS, ''),
+    'file': ('FILES', ALLOWED_FILE_EXTENSIONS, '')
+}
+
+
+def stage_multipart(stream, boundary, max_files):
+    """
+    Разбирает multipart-тело по мере чтения и пишет каждую файловую часть сразу во временный
+    файл, считая sha256. Возвращает (поля формы, [(имя поля, имя файла, путь, хэш, размер)]).
+    """
+    decoder = MultipartDecoder(boundary.encode(), max_form_memory_size=64 * 1024, max_parts=max_files + 8)
+    fields = {}
+    parts = []
+    current = None
+    out = None
+    sha = None
+    size = 0
+
+    try:
+        while True:
+            event = decoder.next_event()
+            if isinstance(event, NeedData):
+                chunk = stream.read(media_store.CHUNK_SIZE)
+                decoder.receive_data(chunk or None)
+            elif isinstance(event, File):
+                if len(parts) >= max_files:
+                    raise ValueError(f'Too many files, max {max_files}')
+                tmp_path = os.path.join(media_store.staging_folder(), uuid.uuid4().hex)
+                current = [event.name, event.filename or '', tmp_path]
+                out = open(tmp_path, 'wb')
+                sha = hashlib.sha256()
+                size = 0
+            elif isinstance(event, Field):
+                current = [event.name]
+                fields[event.name] = b''
+            elif isinstance(event, Data):
+                if out:
+                    out.write(event.data)
+                    sha.update(event.data)
+                    size += len(event.data)
+                    if not event.more_data:
+                        out.close()
+                        out = None
+                        parts.append((*current, sha.hexdigest(), size))
+                else:
+                    fields[current[0]] += event.data
+            elif isinstance(event, Epilogue):
+                break
+    except Exception:
+        if out:
+            out.close()
+            parts.append((*current, None, size))
+        discard_staged(parts)
+        raise
+
+    return {name: value.decode() for name, value in fields.items()}, parts
+
+
+def discard_staged(parts):
+    for _, _, tmp_path, _, _ in parts:
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+
+
+def preview_key(filename):
+    # preview_IMG_1.jpg -> IMG_1, превью видео может иметь другое расширение
+    return os.path.splitext(filename.removeprefix('preview_'))[0]
+
+
+@uploads_bp.route('/upload/batch/<int:dialog_id>/<int:is_group>', methods=['POST'])
+@jwt_required()
+def upload_batch(dialog_id, is_group=0):
+    """
+    Загрузка альбома одним запросом: части 'file' - оригиналы, части 'preview' - их превью
+    (сопоставляются по имени preview_<имя>, иначе по порядку). Поле 'type': photo / audio / file.
+    """
+    user_id = get_jwt_identity()
+    if not has_conversation_access(user_id, dialog_id, is_group):
+        return jsonify({'error': 'You are not a participant in this conversation'}), 403
+
+    mimetype, options = parse_options_header(request.headers.get('Content-Type', ''))
+    if mimetype != 'multipart/form-data' or not options.get('boundary'):
+        return jsonify({'error': 'Expected multipart/form-data'}), 400
+
+    max_files = current_app.config['UPLOAD_BATCH_MAX_FILES']
+    try:
+        # Оригиналы плюс столько же превью
+        fields, parts = stage_multipart(request.stream, options['boundary'], 2 * max_files)
+    except ClientDisconnected:
+        return jsonify({'error': 'Upload interrupted'}), 400
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+
+    try:
+        upload_type = fields.get('type', 'photo')
+        if upload_type not in SESSION_UPLOAD_TYPES:
+            discard_staged(parts)
+            return jsonify({'error': 'Invalid upload type'}), 400
+        folder, allowed_extensions, subfolder_type = SESSION_UPLOAD_TYPES[upload_type]
+
+        originals = [part for part in parts if part[0] == 'file']
+        previews = [part for part in parts if part[0] == 'preview']
+        if not originals or len(originals) > max_files:
+            discard_staged(parts)
+            return jsonify({'error': f'Expected from 1 to {max_files} files'}), 400
+        if any(not allowed_file(part[1], allowed_extensions) for part in originals):
+            discard_staged(parts)
+            return jsonify({'error': 'Invalid file type'}), 400
+
+        f = is_group == 1
+        target_folder = create_partitioned_path(dialog_id, folder, subfolder_type, f)
+        preview_folder = create_partitioned_path(dialog_id, folder, 'preview', f)
+
+        # Превью сопоставляем с оригиналом по имени, оставшиеся - по порядку
+        original_keys = {preview_key(part[1]) for part in originals}
+        previews_by_key = {preview_key(part[1]): part for part in previews if preview_key(part[1]) in original_keys}
+        spare_previews = [part for part in previews if preview_key(part[1]) not in original_keys]
+
+        results = []
+        for _, client_name, tmp_path, digest, size in originals:
+            filename = media_store.ingest_file(tmp_path, digest, size, target_folder, client_name, user_id)
+            result = {'original': client_name, 'filename': filename, 'preview': None}
+
+            preview = previews_by_key.pop(preview_key(client_name), None)
+            if preview is None and spare_previews:
+                preview = spare_previews.pop(0)
+            if preview:
+                # Превью называем по имени, которое получил оригинал, чтобы get_preview_path его нашел
+                _, preview_name, preview_tmp, preview_digest, preview_size = preview
+                preview_filename = os.path.splitext(filename)[0] + os.path.splitext(preview_name)[1].lower()
+                result['preview'] = media_store.ingest_file(preview_tmp, preview_digest, preview_size, preview_folder, preview_filename, user_id, exact=True)
+            results.append(result)
+
+        # Превью без пары не сохраняем
+        discard_staged(parts)
+
+        logger.info(f"Uploaded batch of {len(results)} files in dialog: {dialog_id}")
+        return jsonify({'files': results}), 201
+    except Exception as e:
+        db.session.rollback()
+        discard_staged(parts)
+        return jsonify({'error': str(e)}), 500
+
+
+def session_deadline():
+    return datetime.now(timezone.utc) + timedelta(seconds=current_app.config['UPLOAD_SESSION_TTL'])
+
+
+def session_tmp_path(session):
+    """
+    Временный файл сессии всегда на локальном диске, в каталоге временных файлов хранилища блобов.
+    """
+    return os.path.join(media_store.staging_folder(), f'{session.id}.part')
+
+
+def write_chunk(stream, file_path, offset, length):
+    """
+    Пишет тело запроса в файл с позиции offset, не буферизуя его целиком.
+    При обрыве соединения возвращает число реально записанных байт.
+    """
+    written = 0
+    mode = 'r+b' if os.path.exists(file_path) else 'wb'
+    with open(file_path, mode) as out:
+        out.seek(offset)
+        out.truncate()  # Отбрасываем хвост от прерванной попытки
+        try:
+            while written < length:
+                chunk = stream.read(min(media_store.CHUNK_SIZE, length - written))
+                if not chunk:
+                    break
+                out.write(chunk)
+                written += len(chunk)
+        except ClientDisconnected:
+            pass
+    return written
+
+
+def remove_upload_session(session):
+    tmp_path = session_tmp_path(session)
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    db.session.delete(session)
+
+
+@dramatiq.actor
+def expire_upload_session(session_id):
+    with app.app_context():
+        try:
+            # Ждем окончания записи куска: она продлевает срок сессии
+            session = UploadSession.query.filter_by(id=session_id).with_for_update().first()
+            if not session:
+                return
+
+            now = datetime.now(timezone.utc)
+            if session.expires_at > now:
+                # Сессия продлевалась - проверим снова к новому сроку
+                delay = int((session.expires_at - now).total_seconds() * 1000) + 1000
+                expire_upload_session.send_with_options(args=[session_id], delay=delay)
+                return
+
+            received, size = session.received, session.size
+            remove_upload_session(session)
+            db.session.commit()
+            logger.info(f"Upload session {session_id} expired after {received} of {size} bytes")
+        except Exception as e:
+            db.session.rollback()
+            logger.error(f"Error expiring upload session {session_id}: {str(e)}")
+
+
+@uploads_bp.route('/upload/session/<int:dialog_id>/<int:is_group>', methods=['POST'])
+@jwt_required()
+def create_upload_session(dialog_id, is_group=0):
+    try:
+        user_id = get_jwt_identity()
+        data = request.get_json()
+        upload_type = data.get('type')
+        filename = data.get('filename')
+        size = data.get('size')
+        checksum = data.get('sha256')
+
+        if upload_type not in SESSION_UPLOAD_TYPES:
+            return jsonify({'error': 'Invalid upload type'}), 400
+
+        folder, allowed_extensions, _ = SESSION_UPLOAD_TYPES[upload_type]
+        if not filename or not allowed_file(filename, allowed_extensions):
+            return jsonify({'error': 'Invalid file type'}), 400
+
+        if not isinstance(size, int) or size <= 0 or size > current_app.config['UPLOAD_MAX_SIZE']:
+            return jsonify({'error': 'Invalid file size'}), 400
+
+        if not checksum or len(checksum) != 64:
+            return jsonify({'error': 'Invalid checksum'}), 400
+
+        session = UploadSession(
+            id=uuid.uuid4().hex,
+            user_id=user_id,
+            dialog_id=dialog_id,
+            is_group=is_group == 1,
+            folder=folder,
+            filename=filename,
+            size=size,
+            checksum=checksum.lower(),
+            received=0,
+            expires_at=session_deadline()
+        )
+        db.session.add(session)
+        db.session.commit()
+
+        # Заброшенная сессия удалится после UPLOAD_SESSION_TTL без активности
+        expire_upload_session.send_with_options(
+            args=[session.id],
+            delay=current_app.config['UPLOAD_SESSION_TTL'] * 1000
+        )
+
+        return jsonify({'session_id': session.id, 'offset': 0}), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+
+@uploads_bp.route('/upload/session/<session_id>', methods=['GET'])
+@jwt_required()
+def get_upload_session(session_id):
+    user_id = get_jwt_identity()
+    session = UploadSession.query.get(session_id)
+    if not session or session.user_id != user_id:
+        return jsonify({'error': 'Upload session not found'}), 404
+
+    return jsonify({'session_id': session.id, 'offset': session.received, 'size': session.size}), 200
+
+
+@uploads_bp.route('/upload/session/<session_id>', methods=['PUT'])
+@jwt_required()
+def upload_session_chunk(session_id):
+    try:
+        user_id = get_jwt_identity()
+        # Строка сессии заблокирована до коммита: offset занят до записи в файл,
+        # параллельный PUT не пишет во временный файл, а сразу получает 409
+        session = UploadSession.query.filter_by(id=session_id).with_for_update(skip_locked=True).first()
+        if not session:
+            session = UploadSession.query.get(session_id)
+            if not session or session.user_id != user_id:
+                return jsonify({'error': 'Upload session not found'}), 404
+            return jsonify({'error': 'Chunk upload in progress', 'offset': session.received}), 409
+        if session.user_id != user_id:
+            return jsonify({'error': 'Upload session not found'}), 404
+
+        offset = request.args.get('offset', type=int)
+        length = request.content_length
+        if offset is None or not length:
+            return jsonify({'error': 'offset and Content-Length are required'}), 400
+
+        # Клиент должен продолжать ровно с того места, где сервер остановился
+        if offset != session.received:
+            return jsonify({'error': 'Offset mismatch', 'offset': session.received}), 409
+
+        if offset + length > session.size:
+            return jsonify({'error': 'Chunk exceeds declared file size'}), 400
+
+        written = write_chunk(request.stream, session_tmp_path(session), offset, length)
+
+        session.received = offset + written
+        session.expires_at = session_deadline()
+        db.session.commit()
+
+        return jsonify({'offset': offset + written}), 200
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+
+@uploads_bp.route('/upload/session/<session_id>/finalize', methods=['POST'])
+@jwt_required()
+def finalize_upload_session(session_id):
+    try:
+        user_id = get_jwt_identity()
+        # Ждем кусок, который пишется сейчас, и не даем начать новый до конца финализации
+        session = UploadSession.query.filter_by(id=session_id).with_for_update().first()
+        if not session or session.user_id != user_id:
+            return jsonify({'error': 'Upload session not found'}), 404
+
+        if session.received != session.size:
+            return jsonify({'error': 'Upload is not complete', 'offset': session.received}), 400
+
+        tmp_path = session_tmp_path(session)
+        digest, size = media_store.hash_file(tmp_path)
+
+        if digest != session.checksum or size != session.size:
+            remove_upload_session(session)
+            db.session.commit()
+            logger.info(f"Upload session {session_id} failed checksum verification")
+            return jsonify({'error': 'Checksum mismatch'}), 422
+
+        subfolder_type = 'original' if session.folder == 'PHOTOS' else ''
+        directory = create_partitioned_path(session.dialog_id, session.folder, subfolder_type, session.is_group)
+        original_filename, dialog_id = session.filename, session.dialog_id
+        db.session.delete(session)
+        # Удаление сессии коммитится вместе с записью ссылки на блоб
+        filename = media_store.ingest_file(tmp_path, digest, size, directory, original_filename, user_id)
+        logger.info(f"Uploaded new file by session: {filename} in dialog: {dialog_id}")
+
+        return jsonify({'filename': filename}), 201
+    except Exception as e:
+        db.session.rollback()
+        return jsonify({'error': str(e)}), 500
+
+
+def has_conversation_access(user_id, dialog_id, is_group=0):
+    """
+    Проверяет, что пользователь участник диалога или группы.
+    """
+    if is_group == 1:
+        return GroupMember.query.filter_by(group_id=dialog_id, user_id=user_id).first() is not None
+    dialog = Dialog.query.get(dialog_id)
+    return dialog is not None and user_id in (dialog.id_user1, dialog.id_user2)
+
+
+def set_media_cache_headers(response):
+    """
+    Содержимое медиа по одному URL никогда не меняется (см. media_store), поэтому
+    клиент может кэшировать его без повторной проверки. private - файлы доступны только по JWT.
+    """
+    response.cache_control.no_cache = None
+    response.cache_control.public = False
+    response.cache_control.private = True
+    response.cache_control.max_age = current_app.config['MEDIA_CACHE_MAX_AGE']
+    response.cache_control.immutable = True
+    return response
+
+
+def send_media(file_path):
+    """
+    Отдает файл клиенту. В режиме x-accel/x-sendfile приложение только проверяет права,
+    а сами байты отдает Nginx по внутреннему редиректу - воркер не занят на время скачивания.
+    Range, ETag и If-None-Match в этих режимах обрабатывает веб-сервер.
+    X-Sendfile работает только с локальным хранилищем.
+    """
+    mode = current_app.config['MEDIA_DELIVERY']
+
+    if mode == 'x-accel':
+        relative_path = os.path.relpath(file_path, current_app.config['UPLOAD_FOLDER_BASE'])
+        response = make_response('')
+        response.headers['X-Accel-Redirect'] = quote(posixpath.join(current_app.config['MEDIA_ACCEL_PREFIX'], *relative_path.split(os.sep)))
+        response.headers['Content-Type'] = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        return set_media_cache_headers(response)
+
+    if mode == 'x-sendfile':
+        response = make_response('')
+        response.headers['X-Sendfile'] = os.path.abspath(file_path)
+        response.headers['Content-Type'] = mimetypes.guess_type(file_path)[0] or 'application/octet-stream'
+        return set_media_cache_headers(response)
+
+    storage = get_storage()
+    local_path = storage.local_path(file_path)
+
+    # Локальная разработка без Nginx - отдаем сами.
+    # conditional: ответы 206 на Range и 304 на If-None-Match / If-Modified-Since
+    if local_path:
+        response = send_from_directory(
+            os.path.dirname(local_path),
+            os.path.basename(local_path),
+            conditional=True,
+            etag=True,
+            last_modified=os.path.getmtime(local_path)
+        )
+        return set_media_cache_headers(response)
+
+    # Удаленное хранилище (S3) - проксируем поток объекта. Range здесь не поддерживается,
+    # в продакшене запросы к бакету лучше отдать Nginx через x-accel
+    stat = storage.stat(file_path)
+    response = send_file(
+        storage.open(file_path),
+        mimetype=mimetypes.guess_type(file_path)[0] or 'application/octet-stream',
+        download_name=os.path.basename(file_path),
+        conditional=True,
+        etag=stat['etag'],
+        last_modified=stat['mtime']
+    )
+    if response.status_code == 200:
+        response.content_length = stat['size']
+    return set_media_cache_headers(response)
+
+
 @uploads_bp.route('/files/<folder>/<int:dialog_id>/<filename>/<int:is_group>', methods=['GET'])
 @jwt_required()
 def get_file(folder, dialog_id, filename, is_group=0):
+    user_id = get_jwt_identity()
+    if not has_conversation_access(user_id, dialog_id, is_group):
+        return jsonify({'error': 'You are not a participant in this conversation'}), 403
+
     folder_mapping = {
         'photos': current_app.config['UPLOAD_FOLDER_PHOTOS'],
         'audio': current_app.config['UPLOAD_FOLDER_AUDIO'],
@@ -266,39 +800,54 @@ def get_file(folder, dialog_id, filename, is_group=0):
             filename
         )
 
-    if not os.path.exists(file_path):
+    file_path = media_store.lookup(os.path.dirname(file_path), filename)
+    if not file_path:
         return jsonify({'error': 'File not found'}), 404
 
-    return send_from_directory(os.path.dirname(file_path), filename)
+    return send_media(file_path)
 
 
 @uploads_bp.route('/media/preview/<int:dialog_id>/<filename>/<int:is_group>', methods=['GET'])
 @jwt_required()
 def get_media_preview(dialog_id, filename, is_group=0):
+    user_id = get_jwt_identity()
+    if not has_conversation_access(user_id, dialog_id, is_group):
+        return jsonify({'error': 'You are not a participant in this conversation'}), 403
+
     # Построение партицированного пути для превью
     f = is_group == 1
     partitioned_folder = create_partitioned_path(dialog_id, 'PHOTOS', 'preview', f)
-    file_path = os.path.join(partitioned_folder, filename)
+    file_path = media_store.lookup(partitioned_folder, filename)
 
     # Проверка существования файла
-    if not os.path.exists(file_path):
+    if not file_path:
         return jsonify({'error': 'Preview file not found'}), 404
 
     # Возвращаем превью файл
-    return send_from_directory(os.path.dirname(file_path), filename)
+    return send_media(file_path)
 
 
 @uploads_bp.route('/avatars/<filename>', methods=['GET'])
 @jwt_required()
 def get_avatar(filename):
     avatars_folder = os.path.join(current_app.config['UPLOAD_FOLDER_BASE'], 'avatars')
+
+    # ?size=N - уменьшенная копия. Для старых аватарок без вариантов она ставится в очередь
+    # при первом запросе, а пока отдается оригинал
+    requested_size = request.args.get('size', type=int)
+    if requested_size:
+        size = pick_avatar_size(requested_size)
+        variant_path = find_avatar_variant(filename, size)
+        if variant_path:
+            return send_media(variant_path)
+        request_avatar_variants(filename)
+
+    file_path = media_store.lookup(avatars_folder, filename)
     
-    file_path = os.path.join(avatars_folder, filename)
-    
-    if not os.path.exists(file_path):
+    if not file_path:
         return jsonify({'error': 'File not found'}), 404
 
-    return send_from_directory(avatars_folder, filename)
+    return send_media(file_path)
 
     
 @uploads_bp.route('/news/<filename>', methods=['GET'])
@@ -306,12 +855,12 @@ def get_avatar(filename):
 def get_news(filename):
     news_folder = os.path.join(current_app.config['UPLOAD_FOLDER_BASE'], 'news')
     
-    file_path = os.path.join(news_folder, filename)
+    file_path = media_store.lookup(news_folder, filename)
     
-    if not os.path.exists(file_path):
+    if not file_path:
         return jsonify({'error': 'File not found'}), 404
 
-    return send_from_directory(news_folder, filename)
+    return send_media(file_path)
 
 
 def get_preview_path(base_folder_path, filename):
@@ -322,15 +871,37 @@ def get_preview_path(base_folder_path, filename):
     
     preview_folder = os.path.join(base_folder_path, 'preview')
 
-    if os.path.exists(preview_folder):
-        preview_filename_prefix = os.path.splitext(filename)[0]
-        preview_file = next((f for f in os.listdir(preview_folder) if f.startswith(preview_filename_prefix)), None)
-        if preview_file:
-            return os.path.join(preview_folder, preview_file)
+    preview_filename_prefix = os.path.splitext(filename)[0]
+    preview_file = next((f for f in media_store.list_files(preview_folder) if f.startswith(preview_filename_prefix)), None)
+    if preview_file:
+        return os.path.join(preview_folder, preview_file)
     
     return None
 
 
+def forward_attachment(folder, filename, source_id, source_is_group, target_id, target_is_group, user_id):
+    """
+    Привязывает вложение пересылаемого сообщения к другому чату без передачи содержимого.
+    Для фото заодно переносится превью. Возвращает имя файла в целевом чате или None.
+    Ссылки коммитятся вместе с транзакцией вызывающего кода.
+    """
+    subfolder_type = 'original' if folder == 'PHOTOS' else ''
+    source_folder = create_partitioned_path(source_id, folder, subfolder_type, source_is_group)
+    target_folder = create_partitioned_path(target_id, folder, subfolder_type, target_is_group)
+
+    new_filename = media_store.link_existing(source_folder, filename, target_folder, user_id, commit=False)
+    if new_filename and folder == 'PHOTOS':
+        preview_path = get_preview_path(os.path.dirname(source_folder), filename)
+        if preview_path:
+            preview_filename = os.path.basename(preview_path)
+            media_store.link_existing(
+                os.path.dirname(preview_path), preview_filename,
+                create_partitioned_path(target_id, folder, 'preview', target_is_group), user_id,
+                os.path.splitext(new_filename)[0] + os.path.splitext(preview_filename)[1], commit=False
+            )
+    return new_filename
+
+
 def delete_file_from_disk(folder, dialog_id, filename, is_group=False):
     folder_mapping = {
         'photos': current_app.config['UPLOAD_FOLDER_PHOTOS'],
@@ -353,44 +924,48 @@ def delete_file_from_disk(folder, dialog_id, filename, is_group=False):
         errors = []
 
         for path in [original_path, preview_path]:
-            if os.path.exists(path):
-                try:
-                    os.remove(path)
-                except Exception as e:
-                    errors.append(f"Error deleting {path}: {str(e)}")
-            else:
-                errors.append(f"File not found: {path}")
+            if not path:
+                errors.append(f"Preview not found for: {filename}")
+                continue
+            try:
+                # Убираем ссылку, блоб удаляется после последней ссылки
+                if not media_store.release(os.path.dirname(path), os.path.basename(path)):
+                    errors.append(f"File not found: {path}")
+            except Exception as e:
+                errors.append(f"Error deleting {path}: {str(e)}")
         
         if errors:
             return False, 'Some files could not be deleted: ' + '; '.join(errors)
         return True, 'Original and preview photos deleted successfully'
 
     # Файлы и аудио
-    file_path = os.path.join(base_folder_path, filename)
-    
-    if not os.path.exists(file_path):
-        return False, 'File not found'
-
     try:
-        os.remove(file_path)
+        if not media_store.release(base_folder_path, filename):
+            return False, 'File not found'
         return True, 'File deleted successfully'
     except Exception as e:
         return False, str(e)
 
 
+def delete_avatar_variants(filename):
+    for size in current_app.config['AVATAR_SIZES']:
+        variant_path = avatar_variant_path(filename, size)
+        forget_avatar_variant(variant_path)
+        get_storage().delete(variant_path)
+
+
 def delete_avatar_file_if_exists(filename):
     if not filename:
         return
 
     avatars_folder = os.path.join(current_app.config['UPLOAD_FOLDER_BASE'], 'avatars')
-    file_path = os.path.join(avatars_folder, filename)
 
-    if os.path.exists(file_path):
-        try:
-            os.remove(file_path)
+    try:
+        if media_store.release(avatars_folder, filename):
             logger.info(f'Avatar {filename} deleted successfully')
-        except Exception as e:
-            logger.info(f'Error deleting avatar {filename}: {str(e)}')
+        delete_avatar_variants(filename)
+    except Exception as e:
+        logger.info(f'Error deleting avatar {filename}: {str(e)}')
 
 
 def delete_news_file_if_exists(filename):
@@ -398,14 +973,431 @@ def delete_news_file_if_exists(filename):
         return
     
     news_folder = os.path.join(current_app.config['UPLOAD_FOLDER_BASE'], 'news')
-    file_path = os.path.join(news_folder, filename)
 
-    if os.path.exists(file_path):
-        try:
-            os.remove(file_path)
+    try:
+        if media_store.release(news_folder, filename):
             logger.info(f'News {filename} deleted successfully')
+    except Exception as e:
+        logger.info(f'Error deleting news {filename}: {str(e)}')
+
+
+# Каталоги загрузок одного чата: (папка, подкаталог)
+CONVERSATION_FOLDERS = [('PHOTOS', 'original'), ('PHOTOS', 'preview'), ('AUDIO', ''), ('FILES', '')]
+
+
+def conversation_directories():
+    """
+    Все каталоги загрузок чатов: [(is_group, id чата, каталог)].
+    """
+    directories = []
+    for is_group, model in [(False, Dialog), (True, Group)]:
+        for (conv_id,) in db.session.query(model.id):
+            for folder, subfolder_type in CONVERSATION_FOLDERS:
+                directories.append((is_group, conv_id, create_partitioned_path(conv_id, folder, subfolder_type, is_group)))
+    return directories
+
+
+def is_moderator(user_id):
+    user = User.query.get(user_id)
+    return user is not None and user.permission == 1
+
+
+@dramatiq.actor
+def migrate_upload_layout(batch_size=500):
+    """
+    Ставит в очередь перенос всех каталогов загрузок из плоской раскладки в шардированную.
+    """
+    with app.app_context():
+        if current_app.config['UPLOAD_SHARD_DEPTH'] == 0:
+            logger.info('Шардирование каталогов выключено (UPLOAD_SHARD_DEPTH = 0), перенос не нужен')
+            return
+
+        base = current_app.config['UPLOAD_FOLDER_BASE']
+        directories = [os.path.join(base, 'avatars'), os.path.join(base, 'news')]
+        directories += [directory for _, _, directory in conversation_directories()]
+
+        for directory in directories:
+            migrate_upload_directory.send(directory, batch_size)
+        logger.info(f'Перенос раскладки: в очередь поставлено {len(directories)} каталогов')
+
+
+@dramatiq.actor
+def migrate_upload_directory(directory, batch_size=500):
+    """
+    Переносит пачку файлов каталога и ставит себя в очередь снова, пока в плоском каталоге есть файлы.
+    """
+    with app.app_context():
+        names = get_storage().list(directory)
+        if not names:
+            return
+
+        moved = 0
+        for filename in names[:batch_size]:
+            try:
+                if media_store.migrate_file(directory, filename):
+                    moved += 1
+            except Exception as e:
+                db.session.rollback()
+                logger.info(f'Error migrating {directory}/{filename}: {str(e)}')
+
+        logger.info(f'Перенос раскладки: {directory} - перенесено {moved} из {min(len(names), batch_size)}')
+
+        # Если в пачке ничего не перенеслось, повтор ничего не даст - не зацикливаемся
+        if moved and len(names) > batch_size:
+            migrate_upload_directory.send(directory, batch_size)
+
+
+@uploads_bp.route('/upload/migrate-layout', methods=['POST'])
+@jwt_required()
+def start_upload_layout_migration():
+    try:
+        if not is_moderator(get_jwt_identity()):
+            return jsonify({'error': 'Permission denied'}), 403
+
+        batch_size = request.args.get('batch_size', 500, type=int)
+        migrate_upload_layout.send(batch_size)
+        return jsonify({'message': 'Layout migration started'}), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@dramatiq.actor
+def reconcile_storage_usage():
+    """
+    Сверяет счетчики занятого места с хранилищем: чаты пересчитываются по одному отдельными задачами,
+    пользователи - по карте ссылок.
+    """
+    with app.app_context():
+        conversations = {(is_group, conv_id) for is_group, conv_id, _ in conversation_directories()}
+        for is_group, conv_id in conversations:
+            reconcile_conversation_usage.send(conv_id, is_group)
+
+        users = storage_usage.reconcile_user_usage()
+        logger.info(f'Сверка места: в очередь поставлено {len(conversations)} чатов, пересчитано {users} счетчиков пользователей')
+
+
+@dramatiq.actor
+def reconcile_conversation_usage(conv_id, is_group):
+    """
+    Пересчитывает место одного чата обходом его каталогов и записывает точные значения.
+    """
+    with app.app_context():
+        try:
+            storage = get_storage()
+            totals = {}
+            for folder, subfolder_type in CONVERSATION_FOLDERS:
+                directory = create_partitioned_path(conv_id, folder, subfolder_type, is_group)
+                media_type = current_app.config[f'UPLOAD_FOLDER_{folder}']
+                size, files = totals.get(media_type, (0, 0))
+                for filename in media_store.list_files(directory):
+                    file_path = media_store.lookup(directory, filename)
+                    stat = storage.stat(file_path) if file_path else None
+                    if stat:
+                        size += stat['size']
+                        files += 1
+                totals[media_type] = (size, files)
+
+            scope = 'group' if is_group else 'dialog'
+            for media_type, (size, files) in totals.items():
+                storage_usage.set_usage(scope, conv_id, media_type, size, files)
+            db.session.commit()
         except Exception as e:
-            logger.info(f'Error deleting news {filename}: {str(e)}')
+            db.session.rollback()
+            logger.info(f'Error reconciling storage usage for {conv_id}: {str(e)}')
+
+
+@uploads_bp.route('/storage/usage', methods=['GET'])
+@jwt_required()
+def get_storage_usage():
+    """
+    Занятое место. Параметры: scope (dialog / group / user), id - конкретный чат или пользователь,
+    без id - самые крупные по сумме байт (limit).
+    """
+    try:
+        if not is_moderator(get_jwt_identity()):
+            return jsonify({'error': 'Permission denied'}), 403
+
+        scope = request.args.get('scope', 'dialog')
+        scope_id = request.args.get('id', type=int)
+        limit = min(request.args.get('limit', 50, type=int), 500)
+        if scope not in ('dialog', 'group', 'user'):
+            return jsonify({'error': 'Invalid scope'}), 400
+
+        if scope_id is not None:
+            rows = StorageUsage.query.filter_by(scope=scope, scope_id=scope_id).all()
+            return jsonify({
+                'scope': scope,
+                'id': scope_id,
+                'bytes': sum(row.bytes for row in rows),
+                'files': sum(row.files for row in rows),
+                'by_type': {row.media_type: {'bytes': row.bytes, 'files': row.files} for row in rows}
+            }), 200
+
+        rows = db.session.execute(text('''
+            SELECT scope_id, SUM(bytes) AS bytes, SUM(files) AS files
+            FROM storage_usage
+            WHERE scope = :scope
+            GROUP BY scope_id
+            ORDER BY SUM(bytes) DESC
+            LIMIT :limit
+        '''), {'scope': scope, 'limit': limit}).fetchall()
+        return jsonify([{'id': row.scope_id, 'bytes': int(row.bytes), 'files': int(row.files)} for row in rows]), 200
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+@uploads_bp.route('/storage/usage/reconcile', methods=['POST'])
+@jwt_required()
+def start_storage_usage_reconcile():
+    try:
+        if not is_moderator(get_jwt_identity()):
+            return jsonify({'error': 'Permission denied'}), 403
+
+        reconcile_storage_usage.send()
+        return jsonify({'message': 'Reconciliation started'}), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
+
+
+def find_referenced(table_name, names):
+    """
+    Какие из имен упоминаются в сообщениях чата (images, file, voice). Таблица читается
+    один раз на пачку имен: все вложения сообщения разворачиваются в строки и сверяются с пачкой.
+    """
+    rows = db.session.execute(text(f'''
+        SELECT DISTINCT name
+        FROM {table_name} m
+        CROSS JOIN LATERAL unnest(ARRAY[m.file, m.voice] || COALESCE(m.images, CAST('{{}}' AS TEXT[]))) AS name
+        WHERE (m.file IS NOT NULL OR m.voice IS NOT NULL OR m.images IS NOT NULL)
+          AND name = ANY(:names)
+    '''), {'names': names})
+    return {row.name for row in rows}
+
+
+def find_referenced_shared(directory, names):
+    """
+    То же для общих каталогов: новости ссылаются на файлы массивами, аватары - полем avatar.
+    """
+    if os.path.basename(directory) == 'news':
+        query = '''
+            SELECT DISTINCT name
+            FROM news n
+            CROSS JOIN LATERAL unnest(COALESCE(n.images, '{}') || COALESCE(n.voices, '{}') || COALESCE(n.files, '{}')) AS name
+            WHERE name = ANY(:names)
+        '''
+    else:
+        query = '''
+            SELECT avatar AS name FROM public.user WHERE avatar = ANY(:names)
+            UNION
+            SELECT avatar FROM "group" WHERE avatar = ANY(:names)
+        '''
+    return {row.name for row in db.session.execute(text(query), {'names': names})}
+
+
+def find_live_originals(original_folder, names):
+    """
+    Превью, у которых остался оригинал: имя превью совпадает с именем оригинала без расширения.
+    Оригиналы ищутся в карте ссылок одним запросом на пачку, старые файлы без ссылок - в хранилище.
+    """
+    stems = {os.path.splitext(name)[0]: name for name in names}
+    rows = db.session.execute(text(r'''
+        SELECT DISTINCT regexp_replace(filename, '\.[^.]*$', '') AS stem
+        FROM media_ref
+        WHERE path = :path AND blob_hash IS NOT NULL
+          AND regexp_replace(filename, '\.[^.]*$', '') = ANY(:stems)
+    '''), {'path': original_folder, 'stems': list(stems)})
+    live = {stems[row.stem] for row in rows}
+
+    extensions = ALLOWED_PHOTO_EXTENSIONS | {extension.upper() for extension in ALLOWED_PHOTO_EXTENSIONS}
+    for stem, name in stems.items():
+        if name not in live and any(media_store.lookup(original_folder, f'{stem}.{extension}') for extension in extensions):
+            live.add(name)
+    return live
+
+
+def collect_orphan(directory, filename, dry_run):
+    """
+    Убирает файл без ссылок: переносит в карантин (или удаляет) и освобождает ссылку на блоб.
+    Возвращает размер файла.
+    """
+    storage = get_storage()
+    file_path = media_store.lookup(directory, filename)
+    stat = storage.stat(file_path) if file_path else None
+    if not stat:
+        return 0
+    if dry_run:
+        return stat['size']
+
+    if current_app.config['UPLOAD_GC_MODE'] == 'quarantine':
+        base = current_app.config['UPLOAD_FOLDER_BASE']
+        quarantine_path = os.path.join(
+            base, 'quarantine', datetime.now().strftime('%Y%m%d'),
+            os.path.relpath(directory, base), filename
+        )
+        try:
+            storage.link(file_path, quarantine_path)
+        except FileExistsError:
+            pass
+
+    media_store.release(directory, filename)
+    db.session.commit()
+    if os.path.basename(directory) == 'avatars':
+        delete_avatar_variants(filename)
+    return stat['size']
+
+
+def collect_directory(directory, find_references, dry_run):
+    """
+    Проходит каталог пачками по UPLOAD_GC_BATCH имен и убирает файлы без ссылок старше UPLOAD_GC_GRACE.
+    Список каталога читается по пачкам, в памяти - только текущая. Возвращает (число файлов, байт).
+    """
+    batch_size = current_app.config['UPLOAD_GC_BATCH']
+    cutoff = datetime.now().timestamp() - current_app.config['UPLOAD_GC_GRACE']
+    removed, reclaimed = 0, 0
+
+    for batch in media_store.iter_files(directory, batch_size):
+        if not batch:
+            continue
+        referenced = find_references(batch)
+        for filename in batch:
+            if filename in referenced:
+                continue
+            file_path = media_store.lookup(directory, filename)
+            created = media_store.link_age(directory, filename, file_path) if file_path else None
+            if created is None or created > cutoff:
+                continue  # Свежая загрузка - сообщение с ней, возможно, еще не отправлено
+            try:
+                reclaimed += collect_orphan(directory, filename, dry_run)
+                removed += 1
+            except Exception as e:
+                db.session.rollback()
+                logger.info(f'Error collecting {directory}/{filename}: {str(e)}')
+
+    return removed, reclaimed
+
+
+def collect_avatar_variants(dry_run):
+    """
+    Убирает варианты аватарок, оригинал которых больше не стоит ни у пользователя, ни у группы.
+    Возвращает (число файлов, байт).
+    """
+    storage = get_storage()
+    batch_size = current_app.config['UPLOAD_GC_BATCH']
+    cutoff = datetime.now().timestamp() - current_app.config['UPLOAD_GC_GRACE']
+    removed, reclaimed = 0, 0
+
+    for size in current_app.config['AVATAR_SIZES']:
+        variants_folder = os.path.dirname(avatar_variant_path('', size))
+        names = storage.iter_names(variants_folder)
+        while True:
+            batch = list(islice(names, batch_size))
+            if not batch:
+                break
+            stems = [os.path.splitext(name)[0] for name in batch]
+            live = set(db.session.execute(text(r'''
+                SELECT regexp_replace(avatar, '\.[^.]*$', '') FROM public.user
+                WHERE regexp_replace(avatar, '\.[^.]*$', '') = ANY(:stems)
+                UNION
+                SELECT regexp_replace(avatar, '\.[^.]*$', '') FROM "group"
+                WHERE regexp_replace(avatar, '\.[^.]*$', '') = ANY(:stems)
+            '''), {'stems': stems}).scalars())
+            for name, stem in zip(batch, stems):
+                if stem in live:
+                    continue
+                variant_path = os.path.join(variants_folder, name)
+                stat = storage.stat(variant_path)
+                if not stat or stat['mtime'] > cutoff:
+                    continue  # Аватарка только загружена и еще не назначена
+                removed += 1
+                reclaimed += stat['size']
+                if not dry_run:
+                    forget_avatar_variant(variant_path)
+                    storage.delete(variant_path)
+
+    return removed, reclaimed
+
+
+@dramatiq.actor
+def collect_orphaned_uploads(dry_run=False):
+    """
+    Сборка файлов, на которые не ссылается ни одно сообщение или новость. Чаты проверяются
+    отдельными задачами, общие каталоги (новости, аватары) и временные файлы - здесь.
+    """
+    with app.app_context():
+        conversations = {(is_group, conv_id) for is_group, conv_id, _ in conversation_directories()}
+        for is_group, conv_id in conversations:
+            collect_conversation_orphans.send(conv_id, is_group, dry_run)
+
+        base = current_app.config['UPLOAD_FOLDER_BASE']
+        removed, reclaimed = 0, 0
+        for folder in ['news', 'avatars']:
+            directory = os.path.join(base, folder)
+            count, size = collect_directory(directory, lambda names, d=directory: find_referenced_shared(d, names), dry_run)
+            removed += count
+            reclaimed += size
+        count, size = collect_avatar_variants(dry_run)
+        removed += count
+        reclaimed += size
+
+        # Брошенные временные файлы загрузок (части сессий удаляет expire_upload_session)
+        staging = media_store.staging_folder()
+        cutoff = datetime.now().timestamp() - current_app.config['UPLOAD_GC_GRACE']
+        for entry in os.scandir(staging):
+            if entry.is_file() and not entry.name.endswith('.part') and entry.stat().st_mtime < cutoff:
+                removed += 1
+                reclaimed += entry.stat().st_size
+                if not dry_run:
+                    os.remove(entry.path)
+
+        logger.info(f'Сборка файлов: в очередь поставлено {len(conversations)} чатов, '
+                    f'общие каталоги - убрано {removed} файлов, {reclaimed} байт' + (' (dry run)' if dry_run else ''))
+
+
+@dramatiq.actor
+def collect_conversation_orphans(conv_id, is_group, dry_run=False):
+    """
+    Убирает файлы чата без ссылок из сообщений. Превью убирается, когда от оригинала ничего не осталось.
+    """
+    with app.app_context():
+        table_name = f"messages_group_{conv_id}" if is_group else f"messages_dialog_{conv_id}"
+        table_exists = db.session.execute(text('''
+            SELECT EXISTS (SELECT FROM information_schema.tables WHERE table_name = :table_name)
+        '''), {'table_name': table_name}).scalar()
+        if not table_exists:
+            return
+
+        removed, reclaimed = 0, 0
+        for folder, subfolder_type in CONVERSATION_FOLDERS:
+            if subfolder_type == 'preview':
+                continue
+            directory = create_partitioned_path(conv_id, folder, subfolder_type, is_group)
+            count, size = collect_directory(directory, lambda names: find_referenced(table_name, names), dry_run)
+            removed += count
+            reclaimed += size
+
+        # Превью без оригинала: имя превью совпадает с оригиналом без расширения
+        original_folder = create_partitioned_path(conv_id, 'PHOTOS', 'original', is_group)
+        preview_folder = create_partitioned_path(conv_id, 'PHOTOS', 'preview', is_group)
+        count, size = collect_directory(preview_folder, lambda names: find_live_originals(original_folder, names), dry_run)
+        removed += count
+        reclaimed += size
+
+        if removed:
+            logger.info(f'Сборка файлов: {table_name} - убрано {removed} файлов, {reclaimed} байт' + (' (dry run)' if dry_run else ''))
+
+
+@uploads_bp.route('/storage/gc', methods=['POST'])
+@jwt_required()
+def start_orphan_collection():
+    try:
+        if not is_moderator(get_jwt_identity()):
+            return jsonify({'error': 'Permission denied'}), 403
+
+        dry_run = request.args.get('dry_run', 0, type=int) == 1
+        collect_orphaned_uploads.send(dry_run)
+        return jsonify({'message': 'Orphan collection started', 'dry_run': dry_run}), 202
+    except Exception as e:
+        return jsonify({'error': str(e)}), 500
 
 
 def get_dialog_medias(dialog_id, is_group=0, page=0, page_size=12):
@@ -414,7 +1406,7 @@ def get_dialog_medias(dialog_id, is_group=0, page=0, page_size=12):
     all_files = []
     
     # Собираем все файлы с разрешенными расширениями
-    for filename in sorted(os.listdir(preview_folder), reverse=True):  # сортировка от новых к старым
+    for filename in sorted(media_store.list_files(preview_folder), reverse=True):  # сортировка от новых к старым
         if allowed_file(filename, ALLOWED_PHOTO_EXTENSIONS):
             all_files.append(filename)
     
@@ -433,7 +1425,7 @@ def get_dialog_files(dialog_id, is_group=0, page=0, page_size=10):
     all_files = []
     
     # Собираем все файлы с разрешенными расширениями
-    for filename in sorted(os.listdir(files_folder), reverse=True):
+    for filename in sorted(media_store.list_files(files_folder), reverse=True):
         if allowed_file(filename, ALLOWED_FILE_EXTENSIONS):
             all_files.append(filename)
     
@@ -451,7 +1443,7 @@ def get_dialog_audios(dialog_id, is_group=0, page=0, page_size=20):
     all_files = []
     
     # Собираем все аудиофайлы с разрешенными расширениями
-    for filename in sorted(os.listdir(audio_folder), reverse=True):
+    for filename in sorted(media_store.list_files(audio_folder), reverse=True):
         if allowed_file(filename, ALLOWED_AUDIO_EXTENSIONS):
             all_files.append(filename)
     
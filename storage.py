@@ -0,0 +1,257 @@
+import os
+import shutil
+import threading
+from flask import current_app
+
+try:
+    import boto3
+    from botocore.exceptions import ClientError
+except ImportError:  # S3 нужен только при STORAGE_BACKEND = 's3'
+    boto3 = None
+    ClientError = None
+
+CHUNK_SIZE = 64 * 1024
+S3_COPY_PART_SIZE = 1024 * 1024 * 1024  # Часть серверной копии в S3 (от 5 МБ до 5 ГБ)
+
+
+class LocalStorage:
+    """
+    Хранилище на локальном диске. Пути - те же, что строит приложение (uploads/...).
+    Созданные каталоги кэшируются, чтобы не вызывать os.makedirs на каждую запись.
+    """
+    def __init__(self, base_folder):
+        self.base_folder = base_folder
+        self._created_dirs = set()
+        self._lock = threading.Lock()
+
+    def local_path(self, path):
+        return path
+
+    def ensure_dir(self, directory):
+        if directory in self._created_dirs:
+            return
+        os.makedirs(directory, exist_ok=True)
+        with self._lock:
+            self._created_dirs.add(directory)
+
+    def put(self, path, stream):
+        self.ensure_dir(os.path.dirname(path))
+        size = 0
+        with open(path, 'wb') as out:
+            while True:
+                chunk = stream.read(CHUNK_SIZE)
+                if not chunk:
+                    break
+                out.write(chunk)
+                size += len(chunk)
+        return size
+
+    def put_file(self, local_file, path):
+        """
+        Перемещает готовый локальный файл в хранилище. Если путь уже занят - оставляет существующий.
+        """
+        self.ensure_dir(os.path.dirname(path))
+        try:
+            os.link(local_file, path)
+        except FileExistsError:
+            pass
+        except OSError:
+            os.replace(local_file, path)
+        finally:
+            if os.path.exists(local_file):
+                os.remove(local_file)
+
+    def link(self, source, destination):
+        """
+        Создает ссылку destination на source. Падает с FileExistsError, если имя занято.
+        """
+        self.ensure_dir(os.path.dirname(destination))
+        try:
+            os.link(source, destination)
+        except FileExistsError:
+            raise
+        except OSError:
+            # Файловая система без хардлинков (или другой раздел) - копируем с эксклюзивным созданием
+            with open(source, 'rb') as src, open(destination, 'xb') as dst:
+                shutil.copyfileobj(src, dst, CHUNK_SIZE)
+
+    def open(self, path):
+        return open(path, 'rb')
+
+    def delete(self, path):
+        try:
+            os.remove(path)
+            return True
+        except FileNotFoundError:
+            return False
+
+    def exists(self, path):
+        return os.path.isfile(path)
+
+    def stat(self, path):
+        try:
+            st = os.stat(path)
+        except FileNotFoundError:
+            return None
+        return {'size': st.st_size, 'mtime': st.st_mtime, 'etag': None}
+
+    def list(self, directory):
+        """
+        Имена файлов (без подкаталогов) в каталоге directory.
+        """
+        return list(self.iter_names(directory))
+
+    def iter_names(self, directory):
+        """
+        То же, что list, но по одному имени, не читая весь каталог в память.
+        """
+        try:
+            with os.scandir(directory) as entries:
+                for entry in entries:
+                    if entry.is_file():
+                        yield entry.name
+        except FileNotFoundError:
+            return
+
+
+class S3Storage:
+    """
+    S3-совместимое хранилище (AWS S3, MinIO). Ключ объекта - путь относительно UPLOAD_FOLDER_BASE,
+    поэтому раскладка файлов совпадает с локальной. Ссылки реализованы серверным копированием.
+    """
+    def __init__(self, base_folder, bucket, endpoint_url=None, region=None, access_key=None, secret_key=None):
+        if boto3 is None:
+            raise RuntimeError('boto3 is required for STORAGE_BACKEND=s3')
+        self.base_folder = base_folder
+        self.bucket = bucket
+        self.client = boto3.client(
+            's3',
+            endpoint_url=endpoint_url,
+            region_name=region,
+            aws_access_key_id=access_key,
+            aws_secret_access_key=secret_key
+        )
+
+    def key(self, path):
+        return os.path.relpath(path, self.base_folder).replace(os.sep, '/')
+
+    def local_path(self, path):
+        return None
+
+    def ensure_dir(self, directory):
+        pass  # В S3 нет каталогов
+
+    def put(self, path, stream):
+        counter = _CountingReader(stream)
+        self.client.upload_fileobj(counter, self.bucket, self.key(path))
+        return counter.size
+
+    def put_file(self, local_file, path):
+        # Блоб адресуется хэшем содержимого: параллельная запись того же ключа кладет те же байты
+        try:
+            if not self.exists(path):
+                self.client.upload_file(local_file, self.bucket, self.key(path))
+        finally:
+            if os.path.exists(local_file):
+                os.remove(local_file)
+
+    def link(self, source, destination):
+        """
+        Серверная копия source в destination. Имя занимается атомарно: составная загрузка
+        из копий частей завершается с If-None-Match: *, и если ключ уже есть (или его
+        одновременно создает другой запрос), S3 отвечает 412/409 - FileExistsError.
+        """
+        key = self.key(destination)
+        copy_source = {'Bucket': self.bucket, 'Key': self.key(source)}
+        size = self.client.head_object(**copy_source)['ContentLength']
+        upload_id = self.client.create_multipart_upload(Bucket=self.bucket, Key=key)['UploadId']
+        try:
+            parts = []
+            # Одна копия части - не больше 5 ГБ, пустой объект - одна часть без диапазона
+            for number, start in enumerate(range(0, max(size, 1), S3_COPY_PART_SIZE), start=1):
+                byte_range = {'CopySourceRange': f'bytes={start}-{min(start + S3_COPY_PART_SIZE, size) - 1}'} if size else {}
+                part = self.client.upload_part_copy(
+                    Bucket=self.bucket, Key=key, UploadId=upload_id, PartNumber=number,
+                    CopySource=copy_source, **byte_range
+                )
+                parts.append({'PartNumber': number, 'ETag': part['CopyPartResult']['ETag']})
+            self.client.complete_multipart_upload(
+                Bucket=self.bucket, Key=key, UploadId=upload_id,
+                MultipartUpload={'Parts': parts}, IfNoneMatch='*'
+            )
+        except ClientError as e:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict'):
+                raise FileExistsError(destination)
+            raise
+        except Exception:
+            self.client.abort_multipart_upload(Bucket=self.bucket, Key=key, UploadId=upload_id)
+            raise
+
+    def open(self, path):
+        return self.client.get_object(Bucket=self.bucket, Key=self.key(path))['Body']
+
+    def delete(self, path):
+        if not self.exists(path):
+            return False
+        self.client.delete_object(Bucket=self.bucket, Key=self.key(path))
+        return True
+
+    def exists(self, path):
+        return self.stat(path) is not None
+
+    def stat(self, path):
+        try:
+            head = self.client.head_object(Bucket=self.bucket, Key=self.key(path))
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') in ('404', 'NoSuchKey', 'NotFound'):
+                return None
+            raise
+        return {
+            'size': head['ContentLength'],
+            'mtime': head['LastModified'].timestamp(),
+            'etag': head['ETag'].strip('"')
+        }
+
+    def list(self, directory):
+        return list(self.iter_names(directory))
+
+    def iter_names(self, directory):
+        prefix = self.key(directory).rstrip('/') + '/'
+        paginator = self.client.get_paginator('list_objects_v2')
+        for page in paginator.paginate(Bucket=self.bucket, Prefix=prefix, Delimiter='/'):
+            for item in page.get('Contents', []):
+                yield item['Key'][len(prefix):]
+
+
+class _CountingReader:
+    def __init__(self, stream):
+        self.stream = stream
+        self.size = 0
+
+    def read(self, size=-1):
+        chunk = self.stream.read(size)
+        self.size += len(chunk)
+        return chunk
+
+
+def get_storage():
+    """
+    Хранилище текущего приложения, создается один раз на процесс.
+    """
+    storage = current_app.extensions.get('storage')
+    if storage is None:
+        config = current_app.config
+        if config['STORAGE_BACKEND'] == 's3':
+            storage = S3Storage(
+                config['UPLOAD_FOLDER_BASE'],
+                config['S3_BUCKET'],
+                endpoint_url=config['S3_ENDPOINT_URL'],
+                region=config['S3_REGION'],
+                access_key=config['S3_ACCESS_KEY'],
+                secret_key=config['S3_SECRET_KEY']
+            )
+        else:
+            storage = LocalStorage(config['UPLOAD_FOLDER_BASE'])
+        current_app.extensions['storage'] = storage
+    return storage
@@ -0,0 +1,81 @@
+import os
+from flask import current_app
+from sqlalchemy import text
+from models import db
+
+
+def usage_scope(directory):
+    """
+    Разбирает каталог загрузок в (scope, scope_id, media_type):
+    uploads/dialogs/photos/5/original -> ('dialog', 5, 'photos'), uploads/avatars -> (None, None, 'avatars').
+    """
+    config = current_app.config
+    parts = os.path.relpath(directory, config['UPLOAD_FOLDER_BASE']).split(os.sep)
+
+    if parts[0] in (config['UPLOAD_FOLDER_DIALOGS'], config['UPLOAD_FOLDER_GROUPS']) and len(parts) >= 3:
+        scope = 'dialog' if parts[0] == config['UPLOAD_FOLDER_DIALOGS'] else 'group'
+        return scope, int(parts[2]), parts[1]
+    if parts[0] in ('avatars', 'news'):
+        return None, None, parts[0]
+    return None, None, None
+
+
+def add_usage(scope, scope_id, media_type, size, files):
+    db.session.execute(text('''
+        INSERT INTO storage_usage (scope, scope_id, media_type, bytes, files, updated_at)
+        VALUES (:scope, :scope_id, :media_type, :bytes, :files, NOW())
+        ON CONFLICT (scope, scope_id, media_type) DO UPDATE
+        SET bytes = storage_usage.bytes + :bytes, files = storage_usage.files + :files, updated_at = NOW()
+    '''), {'scope': scope, 'scope_id': scope_id, 'media_type': media_type, 'bytes': size, 'files': files})
+
+
+def set_usage(scope, scope_id, media_type, size, files):
+    db.session.execute(text('''
+        INSERT INTO storage_usage (scope, scope_id, media_type, bytes, files, updated_at)
+        VALUES (:scope, :scope_id, :media_type, :bytes, :files, NOW())
+        ON CONFLICT (scope, scope_id, media_type) DO UPDATE
+        SET bytes = :bytes, files = :files, updated_at = NOW()
+    '''), {'scope': scope, 'scope_id': scope_id, 'media_type': media_type, 'bytes': size, 'files': files})
+
+
+def record_usage(directory, user_id, size, files=1):
+    """
+    Учитывает добавление (size > 0) или удаление (size < 0) файла в каталоге directory:
+    счетчики чата и пользователя по типу медиа. Коммит выполняет вызывающий код.
+    """
+    scope, scope_id, media_type = usage_scope(directory)
+    if not media_type:
+        return
+
+    if scope:
+        add_usage(scope, scope_id, media_type, size, files)
+    if user_id:
+        add_usage('user', user_id, media_type, size, files)
+
+
+def reconcile_user_usage():
+    """
+    Пересчитывает счетчики пользователей по карте ссылок (владелец файла известен только там).
+    """
+    rows = db.session.execute(text('''
+        SELECT r.uploaded_by, r.path, SUM(COALESCE(r.size, b.size)) AS bytes, COUNT(*) AS files
+        FROM media_ref r
+        JOIN media_blob b ON b.hash = r.blob_hash
+        WHERE r.uploaded_by IS NOT NULL
+        GROUP BY r.uploaded_by, r.path
+    ''').execution_options(stream_results=True))
+
+    totals = {}
+    for row in rows:
+        media_type = usage_scope(row.path)[2]
+        if not media_type:
+            continue
+        size, files = totals.get((row.uploaded_by, media_type), (0, 0))
+        totals[(row.uploaded_by, media_type)] = (size + row.bytes, files + row.files)
+
+    # Обнуляем все и записываем точные значения в одной транзакции
+    db.session.execute(text("UPDATE storage_usage SET bytes = 0, files = 0, updated_at = NOW() WHERE scope = 'user'"))
+    for (user_id, media_type), (size, files) in totals.items():
+        set_usage('user', user_id, media_type, size, files)
+    db.session.commit()
+    return len(totals)
@@ -0,0 +1,191 @@
+"""
+Лента изменений чатов для дельта-синхронизации клиента (GET /sync).
+
+Изменения сообщений записываются из outbox.emit в той же транзакции, что и сами изменения.
+Удаленные сообщения хранятся как компактные tombstones (только id) SYNC_RETENTION секунд.
+
+Порядок ленты - (txid, id), где txid - номер транзакции PostgreSQL. Ответ содержит только
+записи транзакций старше самой старой незавершенной (pg_snapshot_xmin), поэтому запись
+транзакции, которая закоммитится позже, не окажется позади курсора клиента.
+"""
+import time
+from flask import current_app
+from sqlalchemy import text
+from models import db, ConversationChange
+import event_log
+import conversation_version
+
+# Событие Socket.IO -> (вид изменения, поле с id сообщений)
+MESSAGE_EVENTS = {
+    'new_message': ('new', 'id'),
+    'message_edited': ('edited', 'id'),
+    'messages_deleted': ('deleted', 'deleted_message_ids'),
+    'messages_read': ('read', 'messages_read_ids'),
+}
+
+
+def record(scope, conv_id, kind, message_ids=None, user_id=None):
+    db.session.add(ConversationChange(scope=scope, conv_id=conv_id, kind=kind, message_ids=message_ids, user_id=user_id))
+    if user_id:
+        conversation_version.mark_users(db.session, [user_id])
+    else:
+        conversation_version.mark_changed(db.session, scope, conv_id)
+
+
+def conversation_members(scope, conv_id):
+    if scope == 'dialog':
+        row = db.session.execute(text('SELECT id_user1, id_user2 FROM dialog WHERE id = :id'), {'id': conv_id}).first()
+        return list(row) if row else []
+    return db.session.execute(text('SELECT user_id FROM group_member WHERE group_id = :id'), {'id': conv_id}).scalars().all()
+
+
+def record_event(room, event_name, payload):
+    """
+    Переносит событие комнаты чата в ленту изменений.
+    """
+    scope, conv_id = event_log.parse_room(room)
+    if not scope:
+        return
+
+    if event_name in MESSAGE_EVENTS:
+        kind, key = MESSAGE_EVENTS[event_name]
+        message_ids = payload[key] if isinstance(payload[key], list) else [payload[key]]
+        record(scope, conv_id, kind, [int(message_id) for message_id in message_ids])
+    elif event_name == 'messages_all_deleted':
+        record(scope, conv_id, 'all_deleted')
+    elif event_name == 'dialog_deleted':
+        # После удаления чата участников уже не найти по членству - адресуем каждому
+        for user_id in conversation_members(scope, conv_id):
+            record(scope, conv_id, 'removed', user_id=user_id)
+
+
+def make_token(txid, change_id):
+    return f'{txid}.{change_id}.{int(time.time())}'
+
+
+def parse_token(token):
+    """
+    Курсор (txid, id) и время выдачи токена. ValueError для некорректного токена.
+    """
+    txid, change_id, issued_at = (int(part) for part in token.split('.'))
+    return txid, change_id, issued_at
+
+
+def snapshot_xmin():
+    return db.session.execute(text('SELECT pg_snapshot_xmin(pg_current_snapshot())::text::bigint')).scalar()
+
+
+def head_token():
+    """
+    Токен для клиента, который только что загрузил все чаты целиком.
+    """
+    return make_token(snapshot_xmin(), 0)
+
+
+def is_expired(issued_at):
+    # Запас в час: записи после курсора могли попасть под очистку на границе окна хранения
+    return time.time() - issued_at > current_app.config['SYNC_RETENTION'] - 3600
+
+
+def fetch_changes(user_id, txid, change_id, xmin, limit):
+    """
+    Изменения в чатах пользователя после курсора (txid, change_id) из транзакций старше xmin,
+    не больше limit записей.
+    """
+    return db.session.execute(text('''
+        SELECT id, txid, scope, conv_id, user_id, kind, message_ids
+        FROM conversation_change c
+        WHERE (c.txid, c.id) > (:txid, :change_id)
+          AND c.txid < :xmin
+          AND (c.user_id = :user_id
+               OR (c.user_id IS NULL AND c.scope = 'dialog' AND c.conv_id IN (
+                   SELECT id FROM dialog WHERE id_user1 = :user_id OR id_user2 = :user_id))
+               OR (c.user_id IS NULL AND c.scope = 'group' AND c.conv_id IN (
+                   SELECT group_id FROM group_member WHERE user_id = :user_id)))
+        ORDER BY c.txid, c.id
+        LIMIT :limit
+    '''), {'user_id': user_id, 'txid': txid, 'change_id': change_id, 'xmin': xmin, 'limit': limit}).mappings().all()
+
+
+def fetch_metadata(scope, conv_ids):
+    if not conv_ids:
+        return {}
+    if scope == 'dialog':
+        query = text('SELECT id, count_msg, can_delete, auto_delete_interval FROM dialog WHERE id = ANY(:ids)')
+    else:
+        query = text('SELECT id, name, avatar, count_msg, can_delete, auto_delete_interval FROM "group" WHERE id = ANY(:ids)')
+    return {row['id']: dict(row) for row in db.session.execute(query, {'ids': list(conv_ids)}).mappings()}
+
+
+def collapse(rows):
+    """
+    Сворачивает записи ленты в состояние по чатам: сообщение, созданное и удаленное за время
+    отсутствия клиента, попадает только в deleted; после all_deleted клиент очищает историю
+    и применяет остальные изменения.
+    """
+    conversations = {}
+    removed = {'dialog': [], 'group': []}
+
+    for row in rows:
+        key = (row['scope'], row['conv_id'])
+        if row['kind'] == 'removed':
+            removed[row['scope']].append(row['conv_id'])
+            conversations.pop(key, None)
+            continue
+
+        state = conversations.setdefault(key, {
+            'id': row['conv_id'], 'new': {}, 'edited': {}, 'deleted': {}, 'read': {},
+            'all_deleted': False, 'metadata': False
+        })
+        if key[1] in removed[key[0]]:
+            removed[key[0]].remove(key[1])
+
+        message_ids = row['message_ids'] or []
+        if row['kind'] == 'new':
+            state['new'].update(dict.fromkeys(message_ids))
+        elif row['kind'] == 'edited':
+            state['edited'].update(dict.fromkeys(i for i in message_ids if i not in state['new']))
+        elif row['kind'] == 'deleted':
+            for message_id in message_ids:
+                for kind in ('new', 'edited', 'read'):
+                    state[kind].pop(message_id, None)
+                state['deleted'][message_id] = None
+        elif row['kind'] == 'read':
+            state['read'].update(dict.fromkeys(i for i in message_ids if i not in state['deleted']))
+        elif row['kind'] == 'all_deleted':
+            for kind in ('new', 'edited', 'deleted', 'read'):
+                state[kind].clear()
+            state['all_deleted'] = True
+        elif row['kind'] == 'metadata':
+            state['metadata'] = True
+
+    result = {'dialogs': [], 'groups': [], 'removed_dialogs': removed['dialog'], 'removed_groups': removed['group']}
+    for scope in ('dialog', 'group'):
+        states = [state for (s, _), state in conversations.items() if s == scope]
+        metadata = fetch_metadata(scope, [state['id'] for state in states if state['metadata']])
+        for state in states:
+            for kind in ('new', 'edited', 'deleted', 'read'):
+                state[kind] = list(state[kind])
+            if state.pop('metadata'):
+                state['conversation'] = metadata.get(state['id'])
+            result[f'{scope}s'].append(state)
+    return result
+
+
+def purge_expired(batch_size=5000):
+    """
+    Удаляет записи старше SYNC_RETENTION пачками. Возвращает число удаленных записей.
+    """
+    total = 0
+    while True:
+        deleted = db.session.execute(text('''
+            DELETE FROM conversation_change WHERE id IN (
+                SELECT id FROM conversation_change
+                WHERE created_at < NOW() - make_interval(secs => :retention)
+                LIMIT :limit
+            )
+        '''), {'retention': current_app.config['SYNC_RETENTION'], 'limit': batch_size}).rowcount
+        db.session.commit()
+        total += deleted
+        if deleted < batch_size:
+            return total